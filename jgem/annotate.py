@@ -38,12 +38,94 @@ class ComparatorNames(EV.EvalNames):
     def __init__(self, sjexbase, code, outdir):
         super(ComparatorNames, self).__init__(sjexbase, code, outdir)
 
-    
+
+EXCOLS = ['chr','st','ed','cat','_id','_gidx','len','strand']
+GCOLS = ['chr','st','ed','strand','_gidx']
+
+def _gbed(ex):
+    gr = ex.groupby('_gidx')
+    g = gr[['chr','st','ed','strand']].first()
+    g['st'] = gr['st'].min()
+    g['ed'] = gr['ed'].max()
+    return g.reset_index()
+
+
+class RefIndex(object):
+    """Reference annotation index for annotating many targets with Comparator.
+
+    Holds sorted exon and gene intervals (BT.IntervalIndex), gene symbols and 
+    junction loci of the reference so that it is prepared once and the overlaps
+    are calculated in memory (no bedtools, no temporary files).
+
+    Usage:
+        >>> ri = RefIndex.get(cn_ref)
+        >>> for cn_tgt in cn_tgts:
+        >>>     Comparator(cn_ref, cn_tgt, refindex=ri).annotate()
+
+    """
+    def __init__(self, exidx, geneidx, g2s, loci):
+        """
+        Args:
+            exidx: BT.IntervalIndex of reference exons (EXCOLS)
+            geneidx: BT.IntervalIndex of reference genes (GCOLS)
+            g2s: Series _gidx => list of gene names
+            loci: set of reference junction loci (chr:st-ed:strand)
+
+        """
+        self.exidx = exidx
+        self.geneidx = geneidx
+        self.g2s = g2s
+        self.loci = loci
+
+    @classmethod
+    def from_model(cls, ex, sj, gnamecol='gene_name', gidxcol='gene_id'):
+        ex = ex.copy()
+        ex['_gidx'] = ex[gidxcol]
+        if 'len' not in ex.columns:
+            ex['len'] = ex['ed']-ex['st']
+        exidx = BT.IntervalIndex(ex, EXCOLS)
+        geneidx = BT.IntervalIndex(_gbed(ex), GCOLS)
+        g2s = ex.groupby('_gidx')[gnamecol].apply(lambda x: list(set(x)))
+        if 'locus' in sj.columns:
+            loci = set(sj['locus'].values)
+        else:
+            loci = set(UT.calc_locus_strand(sj).values)
+        return cls(exidx, geneidx, g2s, loci)
+
+    def save(self, prefix):
+        self.exidx.save(prefix+'.ex.txt.gz')
+        self.geneidx.save(prefix+'.gene.txt.gz')
+        g2s = PD.DataFrame([(k,z) for k,v in self.g2s.items() for z in v], columns=['_gidx','sym'])
+        UT.write_pandas(g2s, prefix+'.sym.txt.gz', 'h')
+        sj = PD.DataFrame({'locus':sorted(self.loci)})
+        UT.write_pandas(sj, prefix+'.sj.txt.gz', 'h')
+
+    @classmethod
+    def load(cls, prefix):
+        exidx = BT.IntervalIndex.load(prefix+'.ex.txt.gz')
+        geneidx = BT.IntervalIndex.load(prefix+'.gene.txt.gz')
+        g2s = UT.read_pandas(prefix+'.sym.txt.gz').groupby('_gidx')['sym'].apply(list)
+        loci = set(UT.read_pandas(prefix+'.sj.txt.gz')['locus'].values)
+        return cls(exidx, geneidx, g2s, loci)
+
+    @classmethod
+    def get(cls, cn_ref, gnamecol='gene_name', gidxcol='gene_id'):
+        """Load reference index from (outdir)/(code).refidx.(gidxcol).(gnamecol).*
+        or make and save one (if missing or older than the reference models)."""
+        prefix = cn_ref.fname('refidx.{0}.{1}'.format(gidxcol, gnamecol), category='output')
+        mpaths = [cn_ref.modelpath('ex'), cn_ref.modelpath('sj')]
+        if UT.notstale(mpaths, prefix+'.sj.txt.gz'):
+            return cls.load(prefix)
+        ri = cls.from_model(cn_ref.model('ex'), cn_ref.model('sj'), gnamecol, gidxcol)
+        ri.save(prefix)
+        return ri
+
+
 class Comparator(object):
     """ Compare to reference and annotate. 
 
     """
-    def __init__(self, cn_ref, cn_tgt, gnamecol='gene_name', gidxcol='gene_id'):
+    def __init__(self, cn_ref, cn_tgt, gnamecol='gene_name', gidxcol='gene_id', refindex=None):
         """
         Args:
             cn_ref: Reference ComparatorNames object
@@ -52,27 +134,38 @@ class Comparator(object):
              (default gene_name)
             gidxcol: name of the column containing gene id (gene_id for Gencode, 
              _gidx if using connected components as genes)
+            refindex: RefIndex of cn_ref (default None), if given reference models are 
+             not read and overlaps are calculated without bedtools
 
         """
         self.cn_ref = cn_ref
         self.cn_tgt = cn_tgt
         self.refgnamecol = gnamecol
         self.refgidxcol = gidxcol
+        self.refindex = refindex
 
     def calc_overlaps(self):
         cref = self.cn_ref
         ctgt = self.cn_tgt
+        cols = EXCOLS
+        self.ex_tgt = etgt = ctgt.model('ex') #UT.read_pandas(p1.ex)
+        if 'len' not in etgt.columns:
+            etgt['len'] = etgt['ed']-etgt['st']
+        gtgt = _gbed(etgt)
+        gcols2 = GCOLS
+        ri = self.refindex
+        if ri is not None:
+            self.ov = ri.exidx.wao(etgt[cols], side='b')
+            self.gov = ri.geneidx.wao(gtgt[gcols2], side='b')
+            return
+
         a = ctgt.fname('cptmp.ex.bed.gz')
         b = cref.fname('cptmp.ex.bed.gz')
         c = ctgt.fname2('cptmp.ex.ovl.txt.gz', cref.code)
-        cols = ['chr','st','ed','cat','_id','_gidx','len','strand']
-        self.ex_tgt = etgt = ctgt.model('ex') #UT.read_pandas(p1.ex)
         self.ex_ref = eref = cref.model('ex') #UT.read_pandas(p2.ex)
         
         eref['_gidx'] = eref[self.refgidxcol]
 
-        if 'len' not in etgt.columns:
-            etgt['len'] = etgt['ed']-etgt['st']
         if 'len' not in eref.columns:
             eref['len'] = eref['ed']-eref['st']
         a = UT.write_pandas(etgt[cols],a,'')
@@ -82,16 +175,7 @@ class Comparator(object):
         self.ov = UT.read_pandas(c, names=ocols)
 
         # gene overlap
-        gcols = ['chr','st','ed','strand']
-        def _gbed(ex):
-            gr = ex.groupby('_gidx')
-            g = gr[gcols].first()
-            g['st'] = gr['st'].min()
-            g['ed'] = gr['ed'].max()
-            return g.reset_index()
-        gtgt = _gbed(etgt)
         gref = _gbed(eref)
-        gcols2 = gcols+['_gidx']
         a2 = ctgt.fname('cptmp.gene.bed.gz')
         b2 = cref.fname('cptmp.gene.bed.gz')
         c2 = ctgt.fname2('gene.ovl.txt.gz', cref.code)
@@ -192,7 +276,10 @@ class Comparator(object):
         sfld = self.refgnamecol
         # self.e2g = e2g = self.ex_ref.groupby('_gidx')[sfld].apply(lambda x: list(set(x))).reset_index()
         # self.g2s = g2s = UT.df2dict(e2g, '_gidx', sfld) # gidx => list of syms
-        self.g2s = g2s = self.ex_ref.groupby('_gidx')[sfld].apply(lambda x: list(set(x)))
+        if self.refindex is not None:
+            self.g2s = g2s = self.refindex.g2s
+        else:
+            self.g2s = g2s = self.ex_ref.groupby('_gidx')[sfld].apply(lambda x: list(set(x)))
         # self.g2s = g2s = UT.df2dict(e2g, '_gidx', sfld) # gidx => list of syms
         # convert _gidx => sym
         try:
@@ -207,12 +294,15 @@ class Comparator(object):
         
     def assign_tcode_sj(self):
         self.sj_tgt = stgt = self.cn_tgt.model('sj') #UT.read_pandas(self.p1.sj)
-        self.sj_ref = sref = self.cn_ref.model('sj') #UT.read_pandas(self.p2.sj)
         if 'locus' not in stgt.columns:
             stgt['locus'] = UT.calc_locus_strand(stgt)
-        if 'locus' not in sref.columns:
-            sref['locus'] = UT.calc_locus_strand(sref)
-        l2c = dict([(x,'k.me') for x in sref['locus']])
+        if self.refindex is not None:
+            l2c = dict([(x,'k.me') for x in self.refindex.loci])
+        else:
+            self.sj_ref = sref = self.cn_ref.model('sj') #UT.read_pandas(self.p2.sj)
+            if 'locus' not in sref.columns:
+                sref['locus'] = UT.calc_locus_strand(sref)
+            l2c = dict([(x,'k.me') for x in sref['locus']])
         rcode = self.cn_ref.code
         setfld = 'etcode_'+rcode
         sgtfld = 'gtcode_'+rcode
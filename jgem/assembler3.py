@@ -36,6 +36,7 @@ from matplotlib.collections import BrokenBarHCollection
 from functools import partial, reduce
 from operator import iadd
 import bisect
+import heapq
 from scipy.optimize import nnls
 
 
@@ -875,11 +876,7 @@ LAPARAMS = dict(
      #covfactor=0.05, 
      tcovth=0,
      tcovfactor=0.1,
-     upperpathnum=100, # if num of paths larger than this increase stringency for sjs
-     maxraisecnt=2, 
-     minvmimadiff=1,
      trimth=150,
-     raisecntth=50,
      pathcheckth=200, # above this num of sjs check sc1(ucnt)==0 if >50% remove
      pathcheckratio=0.1, # ratio of ucnt==0 if above this remove these
      use_ef2=False, # whether to use slope edge detector
@@ -898,9 +895,6 @@ LAPARAMS = dict(
 MERGEPARAMS = LAPARAMS.copy()
 MERGEPARAMS.update(dict(
      tcovfactor=0.4,
-     maxraisecnt=1, 
-     minvmimadiff=5,     
-     raisecntth=150,
      use_ef2=True, # whether to use slope edge detector
      edgedelta=1000000, # disable getting 53exons from extruded edges
      use_sja_for_exon_detection=True,
@@ -1932,8 +1926,7 @@ class LocalAssembler(object):
             else:
                 preselected = []
             self._pg = pg = PathGenerator(gg, gsjdf, gexdf, chrom, strand, sjpaths, preselected,
-                self.params['upperpathnum'], self.params['maxraisecnt'], 
-                self.params['minvmimadiff'], self.params['trimth'], self.params['raisecntth'])
+                self.params['trimth'])
             paths.append(pg.select_paths(self.params['tcovth'], self.params['tcovfactor']))
         return PD.concat(paths, ignore_index=True)
 
@@ -2544,8 +2537,7 @@ def compress2(x0, y0, window, minbins):
 class PathGenerator(object):
     # gene level path generator
 
-    def __init__(self, gg, gsjdf, gexdf, chrom, strand, sjpaths, preselected,
-        upperpathnum=100, maxraisecnt=10,minvmimadiff=0.5,trimth=150,raisecntth=50):
+    def __init__(self, gg, gsjdf, gexdf, chrom, strand, sjpaths, preselected, trimth=150):
         self.gg = gg # GeneGraph
         self.preselected = preselected
         self.gexdf = gexdf # gene exons
@@ -2560,11 +2552,7 @@ class PathGenerator(object):
         idx = (sjpaths['tst']>=st)&(sjpaths['ted']<=ed)&(sjpaths['strand'].isin(STRS[strand]))&(sjpaths['chr']==chrom)
         self.sjpaths = sjpaths[idx]
         self.e5s = e5s = gexdf[gexdf['kind']=='5']
-        self.upperpathnum = upperpathnum
-        self.maxraisecnt = maxraisecnt
-        self.minvmimadiff = minvmimadiff
-        self.raisecntth = raisecntth
-        self.pg53s = [PathGenerator53(x,gg,gexdf,gsjdf,x['eid'],strand,upperpathnum,maxraisecnt,minvmimadiff) for i,x in e5s.iterrows()] # one unit
+        self.pg53s = [PathGenerator53(x,gg,gexdf,gsjdf,x['eid'],strand) for i,x in e5s.iterrows()] # one unit
         self.verbose = False
         self.sjrth = sjpaths['sjratio'].min() #0.001
         self.uth = sjpaths['sc1'].min()
@@ -2593,41 +2581,24 @@ class PathGenerator(object):
             self.tcovth1 = tcovth
             self.tcovth2 = th1
         # print('tth1:{0}, tth2:{1}'.format(self.tcovth1,self.tcovth2))
-        delta = vmax/3.
-        vmin = vmax - delta
-        raisecnt = 0
-        while vmax>0:
-            raised = False
-            l = []
-            tgts = [x for x in self.pg53s if not x.disable]
-            if len(tgts)==0:
-                # print('gid:{0} all disabled'.format(self.gid))
+        # merge best-first streams of each 5'exon unit (PathGenerator53) 
+        # => paths in decreasing tcov, paths below tcovth2 are never expanded
+        tpos = PATHCOLS.index('tcov')
+        heap = []
+        for i, x in enumerate(self.pg53s):
+            if x.disable:
+                continue
+            gen = x.best_first(self.tcovth2)
+            for rec in gen:
+                heap.append((-rec[tpos], i, rec, gen))
+                break
+        heapq.heapify(heap)
+        while len(heap)>0:
+            ntcov, i, rec, gen = heapq.heappop(heap)
+            yield rec
+            for rec in gen: # next from the same unit (stops if disabled)
+                heapq.heappush(heap, (-rec[tpos], i, rec, gen))
                 break
-            for x in tgts:
-                try:
-                    ps = x.get_paths_range(vmin,vmax)
-                    if ps is not None:
-                        ps['pgid'] = x.pgid
-                        l.append(ps)
-                except PathNumUpperLimit:
-                    raisecnt += 1
-                    raised = True
-            if len(l)>0:
-                paths = PD.concat(l, ignore_index=True)
-                paths.sort_values('tcov', ascending=False, inplace=True)
-                for rec in paths.values:
-                    yield rec
-            # else: # speed up?
-            #     delta = min(vmin, 2*delta)
-            if raised: # reduce interval range
-                vmin = (vmax+vmin)/2.
-                if self.verbose:
-                    print('raisecnt={0}'.format(raisecnt))
-                if raisecnt>self.raisecntth:
-                    raise TrimSJ
-            else: # go to next interval
-                vmax = vmin
-                vmin = max(0, vmax - delta)
 
     def trim(self, sjp, msg='Too many paths.'):
         # chrom = sjp.iloc[0]['chr']
@@ -2665,7 +2636,7 @@ class PathGenerator(object):
         self._gexdf = gexdf[gexdf['eid'].isin(eids)].copy()
         LOG.debug('gg.ede {0}=>{1} #eids {2}=>{3}'.format(len(self.gg.ede),len(gg.ede), n0,n1))
         # e5s  = self._gexdf[self._gexdf['kind']=='5']
-        self.pg53s = [PathGenerator53(x,gg,self._gexdf,self._gsjdf, i, self.strand, self.upperpathnum) for i,x in self.e5s.iterrows()]        
+        self.pg53s = [PathGenerator53(x,gg,self._gexdf,self._gsjdf, i, self.strand) for i,x in self.e5s.iterrows()]        
         return sjp
 
     def select_paths(self, tcovth=1, tcovfactor=0.1):
@@ -2678,64 +2649,45 @@ class PathGenerator(object):
             paths = list(self.preselected[PATHCOLS].values)
         def _select(sjp):
             sjnames = list(sjp['name'].values)
-            nsj = len(sjnames)
-            z = N.zeros(nsj)
-            # find index for each sub pg53 range
-            sjidx = {}
+            cover = SJPathCover(sjnames)
+            # sjpaths within each sub pg53 range => #uncovered sjpaths per pg53
+            tst = sjp['tst'].values
+            ted = sjp['ted'].values
+            s2pg = [[] for x in sjnames]
+            rem = {}
+            pg53s = {}
             for x in self.pg53s:
-                sjp0 = sjp[(sjp['tst']>=x.e5['tst'])&(sjp['ted']<=x.e5['ted'])]
-                sjidx[x.pgid] = [sjnames.index(y) for y in sjp0['name']]
+                idx = N.nonzero((tst>=x.e5['tst'])&(ted<=x.e5['ted']))[0]
+                rem[x.pgid] = len(idx)
+                pg53s[x.pgid] = x
+                for i in idx:
+                    s2pg[i].append(x.pgid)
+            done = [k for k,v in rem.items() if v==0] # pg53s to disable
+            def _add(p):
+                new = cover.add(p[npos])
+                for i in new:
+                    for k in s2pg[i]:
+                        rem[k] -= 1
+                        if rem[k]==0:
+                            done.append(k)
+                return len(new)
             for p in paths: # score from previously accumulated paths
-                for i,sjn in enumerate(sjnames):
-                    z[i] += (sjn in p[npos])
-            cscore = N.sum(z>0)
+                _add(p)
             for p in self.paths_from_highest_cov(tcovth, tcovfactor): # set th1,th2 according to tcovth,tcovfactor
                 if p[tpos]>=self.tcovth1: #tcovth: take if larger than tcovth set within paths_from_highest_cov
                     paths.append(p[:-1])
-                    for i,sjn in enumerate(sjnames):
-                        if z[i]==0:
-                            z[i] += (sjn in p[npos])
-                    cscore = N.sum(z>0)
-                    # if cscore==nsj:
-                    #     print('all covered break 1', cscore, nsj, z)
-                    #     break
+                    _add(p)
                 elif p[tpos]>=self.tcovth2: # check if it contributes
-                    if cscore==nsj: # all sjpaths covered
-                        # print('all covered break 2', cscore, nsj, z)
+                    if cover.complete(): # all sjpaths covered
                         break
-                    else:
-                        for i,sjn in enumerate(sjnames):
-                            if z[i]==0:
-                                z[i] += (sjn in p[npos])
-                        cscore1 = N.sum(z>0)
-                        if cscore1>cscore:
-                            paths.append(p[:-1])
-                            cscore = cscore1
+                    if _add(p)>0:
+                        paths.append(p[:-1])
                 else:
                     break
-                # check any sub pg53 is done
-                for x in self.pg53s:
-                    if not x.disable:
-                        cs = N.sum([z[i] for i in sjidx[x.pgid]])
-                        if cs == len(sjidx[x.pgid]):
-                            # print('gid{1}, pgid:{0} disabled (all covered)'.format(x.pgid, self.gid))
-                            x.disable = True
-            # if cscore<nsj:
-            #     gid = self.gexdf['gid'].values[0]
-            #     LOG.debug('gid:{0} terminated without covering all sj ({1}/{2} #paths:{3} th1:{4} th2:{5},#sjdf:{6})'\
-            #         .format(gid,cscore,nsj,len(paths),self.tcovth1,self.tcovth2,len(self.gsjdf)))
-            #     for i,zi in enumerate(z):
-            #         if zi==0:
-            #             print('  i:{0} name:{1}'.format(i, sjnames[i]))
-        while True:
-            try:
-                # paths = _select(sjnames)
-                _select(sjp)
-                break
-            except TrimSJ: # remove sj to cover # <== not used anymore
-                sjp = self.trim(sjp)
-
-        # _select(sjp)
+                # check any sub pg53 is done (all covered)
+                while len(done)>0:
+                    pg53s[done.pop()].disable = True
+        _select(sjp)
         df = PD.DataFrame(paths, columns=PATHCOLS)
 
         # add alt 3exons, 5exons
@@ -2827,9 +2779,52 @@ class PathGenerator(object):
         return df
 
 
+class SJPathCover(object):
+    """Tracks sjpaths covered by selected paths.
+
+    Sjpaths (junction chains 'd|a,d|a,...') and paths (exon chains 'st,ed|st,ed|...')
+    are tokenized into junction id sequences. A sjpath is covered by a path if its
+    junctions are a contiguous part of the path junctions. Candidates are looked up
+    from the first junction (inverted index), so adding a path costs O(path junctions).
+    """
+
+    def __init__(self, sjnames):
+        self.j2i = j2i = {}
+        self.seqs = []
+        self.first = {} # first junction id => sjpath indices
+        for i, name in enumerate(sjnames):
+            seq = tuple([j2i.setdefault(j, len(j2i)) for j in name.split(',')])
+            self.seqs.append(seq)
+            self.first.setdefault(seq[0], []).append(i)
+        self.z = N.zeros(len(sjnames), dtype=bool)
+        self.cscore = 0 # number of covered sjpaths
+        self.n = len(sjnames)
+
+    def path_jids(self, pname):
+        parts = pname.split('|')
+        return tuple([self.j2i.get(parts[k].split(',')[-1]+'|'+parts[k+1].split(',')[0], -1) 
+                      for k in range(len(parts)-1)])
+
+    def add(self, pname):
+        """Mark sjpaths covered by the path. Returns indices of newly covered sjpaths."""
+        jids = self.path_jids(pname)
+        new = []
+        for k, j in enumerate(jids):
+            for i in self.first.get(j, []):
+                s = self.seqs[i]
+                if (not self.z[i]) and (jids[k:k+len(s)]==s):
+                    self.z[i] = True
+                    new.append(i)
+        self.cscore += len(new)
+        return new
+
+    def complete(self):
+        return self.cscore==self.n
+
+
 class PathGenerator53(object):
 
-    def __init__(self, e5, gg, gexdf, gsjdf, pgid, strand,upperpathnum=100, maxraisecnt=10, minvmimadiff=0.5):
+    def __init__(self, e5, gg, gexdf, gsjdf, pgid, strand, maxqueue=200000):
         # edges
         self.e5 = e5
         self.gg = gg
@@ -2845,105 +2840,49 @@ class PathGenerator53(object):
         self.e2p = e2p = UT.df2dict(self.exdf, 'eid', 'pa')
         self.ede = ede = {e: [x for x in gg.ede[e] if x in eids] for e in eids if e in gg.ede}
         self.tcov = e5['tcov0']*e5['pd']
-        self.e2mima = {}
         self.e2ep = {e: [(y, e2p[y]*j2p[x]) for x in edj[e] for y in jae[x]] for e in eids}
         self.e2kind = UT.df2dict(self.exdf, 'eid', 'kind')
         self.e2name = UT.df2dict(self.exdf, 'eid', 'name')
-        self.upperpathnum = upperpathnum
-        self.maxraisecnt = maxraisecnt
-        self.minvmimadiff = minvmimadiff
-        self.raisecnt = 0
-        self.currvmax = None
         self.disable = False
         self.pgid = pgid
-
-        
-    def get_paths_range(self, vmin, vmax):
-        if self.tcov <= vmin:
-            return None
-        if vmax != self.currvmax:
-            self.currvmax = vmax
-            self.raisecnt = 0
-        # get paths whose tcov is >vmin & <=vmax
-        # do BFS, ignore branch whose tmax<=vmin or tmin>vmax
-        # (chr,st,ed,strand,name(pc),tcov0,tcov1,e5dp,tcov,tst,ted,tcov0a,tcov0b,tcov0c)
-        recs, pmax, pmin = self.dfs(self.e5['eid'], vmin, vmax, '', self.tcov)
-        if len(recs)==0:
-            return None
-        pathsdf = PD.DataFrame(recs, columns=['name','st','ed','tcov'])
-        # paths: st,ed,name,tcov
-        # name2strand = UT.df2dict(self.sjdf, 'name', 'strand')
-        # def _strand(name):
-        #     jids = name.split(',')[1:-1]
-        #     return Counter([name2strand.get(x,self.strand) for x in jids]).most_common()[0][0]
-        # pathsdf['strand'] = [_strand(x) for x in pathsdf['name']] #self.strand
-        pathsdf['strand'] = self.e5['strand']
-        # pathsdf['strand'] = self.strand
-        for f in ['chr','tst','ted','tcov0','tcov0a','tcov0b','tcov0c']:
-            pathsdf[f] = self.e5[f]
-        return pathsdf[PATHCOLS]
-
-    def dfs(self, eid, vmin, vmax, pathpre, ctcov):
-        if (self.e2kind[eid]=='3') or (len(self.e2ep.get(eid,[]))==0): # leaf
-            # print('   leaf', eid)
-            if (ctcov>vmax) or (ctcov<=vmin):
-                # print('   out of range')
-                return ([], 1, 1)
+        self.maxqueue = maxqueue # max number of partial paths in best_first
+
+    def best_first(self, vmin=0):
+        """Yields paths (PATHCOLS + [pgid]) in decreasing tcov.
+
+        Path tcov is 5'exon tcov multiplied by branch probabilities (<=1) along
+        the path, so a partial path bounds all its extensions. Partial paths are 
+        expanded from a priority queue (highest first), branches with tcov<vmin
+        (or zero) are pruned. Stops when disabled.
+        """
+        e5 = self.e5
+        const = dict(chr=e5['chr'], strand=e5['strand'], tst=e5['tst'], ted=e5['ted'],
+                     tcov0=e5['tcov0'], tcov0a=e5['tcov0a'], tcov0b=e5['tcov0b'], tcov0c=e5['tcov0c'])
+        if self.tcov<=0 or self.tcov<vmin:
+            return
+        heap = [(-self.tcov, 0, e5['eid'], '')]
+        cnt = 1
+        while len(heap)>0 and not self.disable:
+            ntcov, _, eid, pathpre = heapq.heappop(heap)
+            ctcov = -ntcov
             pathname = pathpre+'|'+self.e2name[eid] if pathpre else self.e2name[eid]
-            tmp = pathname.split(',')
-            st = int(tmp[0])
-            ed = int(tmp[-1])
-            if st>ed:
-                st,ed = ed,st
-            self.e2mima[eid] = (1,1)
-            return ([[pathname,st,ed,ctcov]],1, 1)
-        # non-leaf recurse
-        recs = []
-        pmins = []
-        pmaxs = []
-        pathpre0 = pathpre + '|' + self.e2name[eid] if pathpre else self.e2name[eid]
-        if len(self.e2ep[eid])==0:
-            print('wrong e2ep', eid, self.e2ep, self.e2kind, self.exdf, self.sjdf)
-            raise
-        for e, p in self.e2ep[eid]:
-            ctcov0 = ctcov*p
-            if e in self.e2mima:
-                pmin,pmax= self.e2mima[e]
-                if (ctcov0*pmax>vmin)&(ctcov0*pmin<=vmax):
-                    recs1, pmax, pmin = self.dfs(e, vmin, vmax, pathpre0, ctcov0)
-                    recs += recs1
-                pmins.append(pmin*p)
-                pmaxs.append(pmax*p)
-            else:
-                if ctcov0 > vmin:
-                    # print('-----recurse', eid, vmin, vmax, ctcov0)
-                    recs1, pmax, pmin = self.dfs(e, vmin, vmax, pathpre0, ctcov0)
-                    recs += recs1
-                    # print('-----recs:',eid, len(recs))
-                    pmins.append(pmin*p)
-                    pmaxs.append(pmax*p)
-                else:
-                    pmins.append(0)
-                    pmaxs.append(p)
-            if len(recs)>self.upperpathnum:
-                # self.upperpathnum = 2*self.upperpathnum # increase trigger threshold
-                self.raisecnt += 1
-                if (self.raisecnt>self.maxraisecnt)&((vmax-vmin)<self.minvmimadiff):
-                    self.disable = True
-                    gid = self.e5['gid']
-                    print('gid:{3}, pgid:{0} disabled (raisecnt>{1}, vmax:{2}, vmin:{3})'.format(self.pgid, self.raisecnt, vmax, vmin, gid))
-                raise PathNumUpperLimit
-
-        pmin0 = N.min(pmins)
-        pmax0 = N.max(pmaxs)
-        self.e2mima[eid] = (pmin0, pmax0)
-        return recs, pmax0, pmin0
-
-class PathNumUpperLimit(Exception):
-    pass
-
-class TrimSJ(Exception):
-    pass
+            if (self.e2kind[eid]=='3') or (len(self.e2ep.get(eid,[]))==0): # leaf
+                tmp = pathname.split(',')
+                st = int(tmp[0])
+                ed = int(tmp[-1])
+                if st>ed:
+                    st,ed = ed,st
+                rec = dict(const, name=pathname, st=st, ed=ed, tcov=ctcov)
+                yield [rec[f] for f in PATHCOLS]+[self.pgid]
+                continue
+            for e, p in self.e2ep[eid]:
+                ctcov0 = ctcov*p
+                if (ctcov0>0) and (ctcov0>=vmin):
+                    heapq.heappush(heap, (-ctcov0, cnt, e, pathname))
+                    cnt += 1
+            if len(heap)>self.maxqueue:
+                LOG.warning('gid:{0}, pgid:{1} disabled (#partial paths>{2})'.format(e5['gid'], self.pgid, self.maxqueue))
+                self.disable = True
 
 
 ####### Writers  #####################################################################
@@ -2957,16 +2896,8 @@ def path2bed12(paths, cmax=9, covfld='tcov'):
     idxu = bed['strand'].isin(['.+','.-'])
     bed.loc[idxu, 'strand']='.'
     # #exons, esizes, estarts
-    bed['exonsp'] = [[[int(z) for z in y.split(',')] for y in x.split('|')] for x in bed['name']]
-    bed['exonsn'] = [[y[::-1] for y in x][::-1] for x in bed['exonsp']]
-    idxp = bed['strand']!='-'
-    bed.loc[idxp, 'exons'] = bed[idxp]['exonsp']
-    bed.loc[~idxp, 'exons'] = bed[~idxp]['exonsn']
-    bed['#exons'] = [len(x) for x in bed['exons']]
-    estarts = [[str(y[0]-x[0][0]) for y in x] for x in bed['exons']]
-    esizes = [[str(y[1]-y[0]) for y in x] for x in bed['exons']]
-    bed['esizes'] = [','.join(x)+',' for x in esizes]
-    bed['estarts'] = [','.join(x)+',' for x in estarts]
+    idx, st, ed = GGB.pathcode_exons(bed['name'].values, bed['strand'].values)
+    _, _, _, bed['#exons'], bed['esizes'], bed['estarts'] = GGB.blocks_bed12(idx, st, ed)
     # sc1, sc2
     bed['ltcov'] = N.log2(bed[covfld]+2)
     # bed['sc1'] = N.ceil(bed['ltcov']*100).astype(int)
@@ -2989,26 +2920,21 @@ def path2tspan(paths, cmax=9, covfld='tcov0'):
     idxu = bed['strand'].isin(['.+','.-'])
     bed.loc[idxu, 'strand']='.'
     # #exons, esizes, estarts
-    bed['exonsp'] = [[[int(z) for z in y.split(',')] for y in x.split('|')] for x in bed['name']]
-    bed['exonsn'] = [[y[::-1] for y in x][::-1] for x in bed['exonsp']]
-    idxp = bed['strand']!='-'
-    bed.loc[idxp, 'exons'] = bed[idxp]['exonsp']
-    bed.loc[~idxp, 'exons'] = bed[~idxp]['exonsn']
+    idx, st, ed = GGB.pathcode_exons(bed['name'].values, bed['strand'].values)
 
     # group same (tst,ted) ##############
     bg = bed.groupby(['tst','ted'])
     bedg = bg.first()
-    bedg['exons'] = bg['exons'].apply(lambda g: sorted(set([tuple(x) for y in g for x in y])))
     bedg['st'] = bg['st'].min()
     bedg['ed'] = bg['ed'].max()
     bed = bedg.reset_index()
+    # union of exons in each group
+    ex = PD.DataFrame({'g':bg.ngroup().values[idx], 'st':st, 'ed':ed})
+    ex = ex.drop_duplicates().sort_values(['g','st','ed'])
     ######################################
 
-    bed['#exons'] = [len(x) for x in bed['exons']]
-    estarts = [[str(y[0]-x[0][0]) for y in x] for x in bed['exons']]
-    esizes = [[str(y[1]-y[0]) for y in x] for x in bed['exons']]
-    bed['esizes'] = [','.join(x)+',' for x in esizes]
-    bed['estarts'] = [','.join(x)+',' for x in estarts]
+    _, _, _, bed['#exons'], bed['esizes'], bed['estarts'] = \
+        GGB.blocks_bed12(ex['g'].values, ex['st'].values, ex['ed'].values)
     # sc1, sc2
     bed['ltcov'] = N.log2(bed[covfld]+2)
     # bed['sc1'] = N.ceil(bed['ltcov']*100).astype(int)
@@ -3026,25 +2952,20 @@ def sjpaths2tspan(sjpaths, cmax=9, strip53=False, sc2color=True):
     # bed12
     bed = sjpaths
     # #exons, esizes, estarts
-    bed['exonsp'] = [[[int(z) for z in y.split(',')] for y in x.split('|')] for x in bed['name']]
-    bed['exonsn'] = [[y[::-1] for y in x][::-1] for x in bed['exonsp']]
-    idxp = bed['strand']!='-'
-    bed.loc[idxp, 'exons'] = bed[idxp]['exonsp']
-    bed.loc[~idxp, 'exons'] = bed[~idxp]['exonsn']
+    idx, st, ed = GGB.pathcode_exons(bed['name'].values, bed['strand'].values)
 
     bg = sjpaths.groupby(['tst','ted'])
     bedg = bg.first()
-    bedg['exons'] = bg['exons'].apply(lambda g: sorted(set([tuple(x) for y in g for x in y])))
     bedg['st'] = bg['st'].min()
     bedg['ed'] = bg['ed'].max()
     bedg['sc1'] = bg['sc1'].sum()
     bed = bedg.reset_index()
+    # union of exons in each group
+    ex = PD.DataFrame({'g':bg.ngroup().values[idx], 'st':st, 'ed':ed})
+    ex = ex.drop_duplicates().sort_values(['g','st','ed'])
     
-    bed['#exons'] = [len(x) for x in bed['exons']]
-    estarts = [[str(y[0]-x[0][0]) for y in x] for x in bed['exons']]
-    esizes = [[str(y[1]-y[0]) for y in x] for x in bed['exons']]
-    bed['esizes'] = [','.join(x)+',' for x in esizes]
-    bed['estarts'] = [','.join(x)+',' for x in estarts]
+    _, _, _, bed['#exons'], bed['esizes'], bed['estarts'] = \
+        GGB.blocks_bed12(ex['g'].values, ex['st'].values, ex['ed'].values)
     if sc2color:
         bed['ltcov'] = N.log2(bed['sc1']+2)
         sm = {'+':Colors('R', cmax),
@@ -3159,8 +3080,20 @@ class GeneGraph(object):
                 visited.update(exx)
         return genes 
 
+    def allcomponents(self):
+        # union-find version of allcomponents_nr (same output, linear time)
+        # exon-junction-exon edges from j2 (restricted junctions if restrict()ed)
+        eids = self.exs['eid'].values
+        j2 = self.j2[self.j2['eid1'].notnull()&self.j2['eid2'].notnull()]
+        e2i = PD.Index(eids)
+        a = e2i.get_indexer(j2['eid1'].values.astype(int))
+        b = e2i.get_indexer(j2['eid2'].values.astype(int))
+        labels = GP.union_find(len(eids), a, b)
+        self.genes = genes = GP.label_components(labels, eids)
+        return genes
+
     def find_genes(self):
-        gene_eids = self.allcomponents_nr() # [set(eids), ...]
+        gene_eids = self.allcomponents() # [set(eids), ...]
         # find gene_sids
         gene_sids = []
         edj = self.edj
@@ -3311,30 +3244,15 @@ class GeneGraph(object):
 ####### Bundle Finder ################################################################
     
 def find_gaps(bwpre, chrom, csize, gsizeth=5e5, minbundlesize=10e6, sjbwpre=None, sjth=0):
+    # gaps between junction coverage (sj + and - strands, >sjth) over the whole chromosome
+    # from BIGWIG stored intervals (minbundlesize not used)
     sjexbw = SjExBigWigs(bwpre, sjbwpre, mixunstranded=False)
-    sts = []
-    eds = []
-    bsize = 2*minbundlesize
-    bnum = int(N.ceil(csize/float(bsize)))
-    with sjexbw:
-        for i in range(bnum):
-            st = i*bsize
-            ed = min((i+1)*bsize, csize)
-            arr = sjexbw.bws['sj']['+'].get(chrom,st,ed)
-            arr += sjexbw.bws['sj']['-'].get(chrom,st,ed)
-            idx = N.nonzero(arr<=sjth)[0]
-            if len(idx)==0:
-                continue
-            dif = idx[1:]-idx[:-1] # if continuous dif==1
-            idx2 = N.nonzero(dif>1)[0] # non contiguous    
-            # gap start idx2[x]+1 ==> gap end idx2[x+1]
-            gsize = idx[idx2[1:]]-idx[idx2[:-1]+1]
-            idx3 = N.nonzero(gsize>gsizeth)[0]
-            gst = idx[idx2[idx3]+1]+st
-            ged = idx[idx2[idx3+1]]+st
-            sts += list(gst)
-            eds += list(ged)
-    return sts,eds
+    cst, ced = BW.covered_runs(sjexbw.bwpaths['sj']['a']['p'], chrom, csize, sjth)
+    # gap: [ced[i], cst[i+1]-1] (last position inclusive)
+    gst = ced[:-1]
+    ged = cst[1:]-1
+    idx = N.nonzero(ged-gst>gsizeth)[0]
+    return list(gst[idx]), list(ged[idx])
 
 def find_bundles(bwpre, genome, dstpre, chrom=None, sjbwpre=None, mingap=5e5, minbundlesize=10e6, sjth=0):
     bundles = []
@@ -3459,18 +3377,18 @@ def concatenate_bundles(bundles, bundlestatus, chrom, dstpre):
         dstpath2 = '{0}.{1}'.format(dstpre, suf)
         if not os.path.exists(dstpath2):
             if not os.path.exists(dstpath):
-                with open(dstpath, 'wb') as dst:
-                    for chrom, st, ed in bundles:
-                        bname = bundle2bname((chrom,st,ed))
-                        srcpath = '{0}.{1}_{2}_{3}.{4}'.format(dstpre, chrom, st, ed, suf)
-                        if not os.path.exists(srcpath):
-                            if bundlestatus[bname] is None:
-                                continue
-                            else:
-                                raise RuntimeError('{0} does not exists'.format(srcpath))
-                        files.append(srcpath)
-                        with open(srcpath, 'rb') as src:
-                            shutil.copyfileobj(src, dst)
+                srcpaths = []
+                for chrom, st, ed in bundles:
+                    bname = bundle2bname((chrom,st,ed))
+                    srcpath = '{0}.{1}_{2}_{3}.{4}'.format(dstpre, chrom, st, ed, suf)
+                    if not os.path.exists(srcpath):
+                        if bundlestatus[bname] is None:
+                            continue
+                        else:
+                            raise RuntimeError('{0} does not exists'.format(srcpath))
+                    srcpaths.append(srcpath)
+                # gzip members, just byte copy
+                files += UT.concatenate_gz(srcpaths, dstpath)
         else:
             files+=['{0}.{1}_{2}_{3}.{4}'.format(dstpre, chrom, st, ed, suf) for chrom,st,ed in bundles]
     # cleanup
@@ -3492,13 +3410,8 @@ def concatenate_chroms(chroms, dstpre):
     for suf in sufs:
         dstpath = '{0}.{1}'.format(dstpre, suf)
         if not os.path.exists(dstpath):
-            with open(dstpath, 'wb') as dst:
-                for chrom in chroms:
-                    srcpath = '{0}.{1}.{2}'.format(dstpre, chrom, suf)
-                    if os.path.exists(srcpath):
-                        files.append(srcpath)
-                        with open(srcpath, 'rb') as src:
-                            shutil.copyfileobj(src, dst)
+            srcpaths = ['{0}.{1}.{2}'.format(dstpre, chrom, suf) for chrom in chroms]
+            files += UT.concatenate_gz(srcpaths, dstpath, skipmissing=True)
         else:
             files+=['{0}.{1}.{2}'.format(dstpre, chrom, suf) for chrom in chroms]
     # cleanup
@@ -3555,7 +3468,73 @@ def sample_assembler(bwpre, dstpre, genome, mingap=5e5, minbundlesize=10e6, np0=
     return dstpre
 
 
-def find_SE_chrom(bwpre, dstpre, genome, chrom, exstrands=['+'], minsizeth=200):
+def interval_mask(st, ed, wst, wed):
+    """Boolean mask of [wst,wed) covered by intervals [st,ed) (difference array)."""
+    st = N.clip(N.asarray(st, dtype=N.int64), wst, wed)-wst
+    ed = N.clip(N.asarray(ed, dtype=N.int64), wst, wed)-wst
+    d = N.zeros(wed-wst+1, dtype=N.int64)
+    N.add.at(d, st, 1)
+    N.add.at(d, ed, -1)
+    return N.cumsum(d)[:-1]>0
+
+def positive_segments(get, exst, exed, csize, winsize=int(10e6)):
+    """Segments of positive coverage outside of exons.
+
+    Coverage is read in windows of winsize, a segment touching the window end is 
+    carried over to the next window.
+
+    Args:
+        get: function(st,ed) returning coverage array 
+        exst, exed: exon intervals to mask
+        csize: chromosome size
+        winsize: window size
+
+    Returns:
+        (st, ed, mean coverage) arrays
+    """
+    sts, eds, sums = [], [], []
+    o = N.argsort(exst)
+    exst, exed = N.asarray(exst)[o], N.asarray(exed)[o]
+    emax = N.maximum.accumulate(exed) if len(exed)>0 else exed
+    carry = N.zeros(0) # coverage of the open segment at the previous window end
+    dtype = N.float64
+    for wst in range(0, csize, winsize):
+        wed = min(wst+winsize, csize)
+        a = get(wst, wed)
+        if len(a)==0:
+            a = N.zeros(wed-wst, dtype=dtype)
+        dtype = a.dtype
+        # exons overlapping the window
+        i0 = N.searchsorted(emax, wst, 'right')
+        i1 = N.searchsorted(exst, wed)
+        a[interval_mask(exst[i0:i1], exed[i0:i1], wst, wed)] = 0
+        # prepend carried over segment
+        ost = wst-len(carry)
+        if len(carry)>0:
+            a = N.concatenate([carry, a])
+        pos = N.concatenate([[0], (a>0).astype(N.int8), [0]])
+        dif = N.diff(pos)
+        sst = N.nonzero(dif==1)[0]
+        sed = N.nonzero(dif==-1)[0]
+        if (len(sst)>0) and (sed[-1]==len(a)) and (wed<csize): # open segment 
+            carry = a[sst[-1]:].copy()
+            sst, sed = sst[:-1], sed[:-1]
+        else:
+            carry = N.zeros(0)
+        if len(sst)>0:
+            # segment sums by reduceat on (st,ed) boundaries
+            bnd = N.ravel(N.column_stack([sst, sed]))
+            ssum = N.add.reduceat(N.concatenate([a, [0]]).astype(N.float64), bnd)[::2]
+            sts.append(sst+ost)
+            eds.append(sed+ost)
+            sums.append(ssum)
+    if len(sts)==0:
+        return N.zeros(0,dtype=N.int64), N.zeros(0,dtype=N.int64), N.zeros(0)
+    st = N.concatenate(sts)
+    ed = N.concatenate(eds)
+    return st, ed, (N.concatenate(sums)/(ed-st)).astype(dtype) # same as mean
+
+def find_SE_chrom(bwpre, dstpre, genome, chrom, exstrands=['+'], minsizeth=200, winsize=int(10e6)):
     # find SE candidates and calculate ecovs
     try:
         exdf = UT.read_pandas(dstpre+'.{0}.exdf.txt.gz'.format(chrom), names=EXDFCOLS)
@@ -3564,26 +3543,17 @@ def find_SE_chrom(bwpre, dstpre, genome, chrom, exstrands=['+'], minsizeth=200):
     exdf = exdf[exdf['chr']==chrom]
     sjexbw = SjExBigWigs(bwpre)
     chromdf = UT.chromdf(genome).set_index('chr')
-    csize = chromdf.ix[chrom]['size']
+    csize = int(chromdf.loc[chrom]['size'])
     def _do_strand(strand):
+        # stream the chromosome in windows (masking existing exons)
+        bw = sjexbw.bws['ex'][strand]
         with sjexbw:
-            exa = sjexbw.bws['ex'][strand].get(chrom,0,csize)
-        # mask existing exons
-        for st,ed in exdf[['st','ed']].values:
-            exa[st:ed] = 0
-        idx = N.nonzero(exa>0)[0]
-        # find continuous segments
-        dif = idx[1:]-idx[:-1] # if continuous dif==1
-        idx2 = N.nonzero(dif>1)[0] # non contiguous   
-        idxst = N.array([idx[0]]+list(idx[idx2+1]))
-        idxed = N.array(list(idx[idx2])+[idx[-1]])
-        # gap start idx2[x]+1 ==> gap end idx2[x+1]
-        gsize = idxed - idxst + 1
+            st, ed, ecov = positive_segments(lambda s,e: bw.get(chrom,s,e), 
+                exdf['st'].values, exdf['ed'].values, csize, winsize)
+        gsize = ed - st
         idx3 = N.nonzero(gsize>minsizeth)[0]
-        st = idxst[idx3]
-        ed = st + gsize[idx3]
-        df = PD.DataFrame({'st':st, 'ed':ed}, index=N.arange(len(st)))
-        df['ecov'] = [N.mean(exa[x:y]) for x,y in df[['st','ed']].values]
+        df = PD.DataFrame({'st':st[idx3], 'ed':ed[idx3]}, index=N.arange(len(idx3)))
+        df['ecov'] = ecov[idx3]
         df['len'] = df['ed']-df['st']
         df['chr'] = chrom
         return df
@@ -3598,12 +3568,8 @@ def find_SE(dstpre, chroms, exstrands=['+'], sestrand='.',
     # concatenate
     dstpath = dstpre+'.se0.txt.gz'
     if not os.path.exists(dstpath):
-        with open(dstpath,'wb')  as dst:
-            for chrom in chroms:
-                srcpath = dstpre+'.se.{0}.{1}.txt.gz'.format(chrom,'.'.join(exstrands))
-                with open(srcpath,'rb') as src:
-                    shutil.copyfileobj(src,dst)
-                os.unlink(srcpath)
+        srcpaths = [dstpre+'.se.{0}.{1}.txt.gz'.format(chrom,'.'.join(exstrands)) for chrom in chroms]
+        UT.concatenate_gz(srcpaths, dstpath, remove=True)
     # concatenate 
     if not os.path.exists(dstpre+'.exdf.txt.gz'):
         concatenate_chroms(chroms, dstpre)
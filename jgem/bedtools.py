@@ -180,27 +180,15 @@ def make_bw_from_bam0(bampath, chromsizes, bedpath, bwpath):
     make_bw_from_bed(bedpath, chromsizes, bwpath)
     
 def bed12_bed6(bed):
-    """ convert BED12 to BED6 uses cython helper """
+    """ convert BED12 to BED6 (vectorized, see gtfgffbed.bed12_blocks) """
     # BED12 ['chr', 'st', 'ed', 'name', 'sc1', 'strand', 'tst', 'ted', 'sc2', '#exons', 'esizes', 'estarts']
     # BED6 ['chr', 'st', 'ed', 'name', 'sc1', 'strand'] flatten exons, collect unique
     # BED12 tid => BED6 name=tid+exon_number
-    bed8 = bed[['chr','st','ed','name','sc1','strand','esizes','estarts']]
-    # def _gen():
-    #     for x in df.values:
-    #         esi = str(x[-2])
-    #         est = str(x[-1])
-    #         if esi[-1]==',':
-    #             esi = esi[:-1]
-    #             est = est[:-1]
-    #         for y,z in zip(esi.split(','), est.split(',')):
-    #             x[-2] = y
-    #             x[-1] = z
-    #             yield x
-    # fbed = PD.DataFrame([x for x in _gen()], columns = df.columns)
-    fbed = PD.DataFrame(cybw.flatten_bed8(bed8.values), columns=bed8.columns)
-    # adjust st, ed
-    fbed['st'] = fbed['st'] + fbed['estarts']
-    fbed['ed'] = fbed['st'] + fbed['esizes']
+    idx, st, ed = GGB.bed12_blocks(bed)
+    fbed = bed[['chr','name','sc1','strand']].iloc[idx].reset_index(drop=True)
+    fbed['st'] = st
+    fbed['ed'] = ed
+    fbed['esizes'] = ed-st
     return fbed[['chr','st','ed','name','sc1','strand','esizes']]
 
 
@@ -451,6 +439,118 @@ def calc_ovlratio(aname, bname, tname, nacol, nbcol, idcol=['chr','st','ed'], re
     UT.save_tsv_nidx_whead(dfa, tname)
     return dfa
 
+class IntervalIndex(object):
+    """Intervals of a DataFrame (chr,st,ed,...) sorted per chromosome for repeated 
+    overlap queries. In memory equivalent of bedtoolintersect(..., wao=True).
+
+    Usage:
+        >>> idx = IntervalIndex(ref, cols)
+        >>> ov = idx.wao(tgt[cols], side='b') # same as -a tgt -b ref -wao
+    """
+
+    def __init__(self, df, cols=None):
+        if cols is None:
+            cols = list(df.columns)
+        self.cols = cols
+        self.df = df = df[cols].reset_index(drop=True)
+        o = df.sort_values(['chr','st'], kind='mergesort').index.values
+        self.pos = o # sorted => original row
+        self.st = df['st'].values[o].astype(N.int64)
+        self.ed = df['ed'].values[o].astype(N.int64)
+        chrs = df['chr'].values[o]
+        self.bnd = {}
+        self.maxlen = {}
+        if len(o)>0:
+            chg = N.nonzero(chrs[1:]!=chrs[:-1])[0]+1
+            sts = N.concatenate([[0], chg])
+            eds = N.concatenate([chg, [len(o)]])
+            for s, e in zip(sts, eds):
+                self.bnd[chrs[s]] = (s, e)
+                self.maxlen[chrs[s]] = N.max(self.ed[s:e]-self.st[s:e])
+
+    def save(self, path):
+        return UT.write_pandas(self.df, path, 'h')
+
+    @classmethod
+    def load(cls, path):
+        return cls(UT.read_pandas(path, dtype={'chr':str}))
+
+    def pairs(self, q):
+        """Overlapping pairs (ovl>0) with query intervals q (chr,st,ed).
+
+        Returns:
+            (query row, index row, ovl) arrays sorted by (query row, index row)
+        """
+        qst = q['st'].values.astype(N.int64)
+        qed = q['ed'].values.astype(N.int64)
+        qis, iis = [], []
+        for chrom, qi in PD.Series(N.arange(len(q))).groupby(q['chr'].values).groups.items():
+            if chrom not in self.bnd:
+                continue
+            qi = N.asarray(qi)
+            s, e = self.bnd[chrom]
+            st, ed = self.st[s:e], self.ed[s:e]
+            # candidates: st > qst-maxlen (otherwise ed<=qst) and st < qed
+            lo = N.searchsorted(st, qst[qi]-self.maxlen[chrom], 'right')
+            hi = N.searchsorted(st, qed[qi], 'left')
+            cnt = N.maximum(hi-lo, 0)
+            rq = N.repeat(qi, cnt)
+            ri = N.arange(cnt.sum()) - N.repeat(N.cumsum(cnt)-cnt, cnt) + N.repeat(lo, cnt)
+            ok = ed[ri] > qst[rq]
+            qis.append(rq[ok])
+            iis.append(ri[ok]+s)
+        if len(qis)==0:
+            z = N.zeros(0, dtype=N.int64)
+            return z, z, z
+        rq = N.concatenate(qis)
+        ri = self.pos[N.concatenate(iis)]
+        o = N.lexsort((ri, rq))
+        rq, ri = rq[o], ri[o]
+        ovl = N.minimum(qed[rq], self.df['ed'].values[ri]) - N.maximum(qst[rq], self.df['st'].values[ri])
+        return rq, ri, ovl
+
+    def wao(self, q, side='b'):
+        """Overlap table as bedtools intersect -wao (a columns + b_ columns + ovl).
+
+        Args:
+            q: query DataFrame (chr,st,ed,...)
+            side: 'b': q is -a, this index is -b, 'a': this index is -a, q is -b
+
+        Returns:
+            DataFrame (all a rows in order, non overlapping a with b_chr='.',
+            b_st=b_ed=-1 and other b columns '.', ovl=0). As in the bedtools 
+            output read by UT.read_pandas, b columns containing '.' are strings.
+        """
+        q = q.reset_index(drop=True)
+        rq, ri, ovl = self.pairs(q)
+        if side=='b':
+            adf, bdf, ra, rb = q, self.df, rq, ri
+        else:
+            adf, bdf, ra, rb = self.df, q, ri, rq
+            o = N.lexsort((rb, ra))
+            ra, rb, ovl = ra[o], rb[o], ovl[o]
+        A = adf.iloc[ra].reset_index(drop=True)
+        B = bdf.iloc[rb].reset_index(drop=True)
+        B.columns = ['b_'+x for x in B.columns]
+        A = PD.concat([A, B], axis=1)
+        A['ovl'] = ovl
+        # a without overlaps
+        na = N.setdiff1d(N.arange(len(adf)), ra)
+        A0 = adf.iloc[na].reset_index(drop=True)
+        for c in bdf.columns:
+            A0['b_'+c] = -1 if c in ['st','ed'] else '.'
+        A0['ovl'] = 0
+        df = PD.concat([A, A0], ignore_index=True)
+        o = N.argsort(N.concatenate([ra, na]), kind='mergesort')
+        df = df.iloc[o].reset_index(drop=True)
+        for c in ['b_st','b_ed','ovl']:
+            df[c] = df[c].astype(N.int64)
+        if len(na)>0:
+            for c in bdf.columns:
+                if c not in ['st','ed']:
+                    df['b_'+c] = df['b_'+c].astype(str)
+        return df
+
 def fillgap(binfile, gapfile, gap=50):
     if gapfile[-3:]=='.gz':
         gapfile = gapfile[:-3]
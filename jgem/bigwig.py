@@ -292,6 +292,53 @@ def get_bigwig_as_array(bwfile, chrom, st, ed):
             a[N.isnan(a)]=0.
     return a
 
+def get_bigwig_intervals(bwfile, chrom, st, ed):
+    """Get BIGWIG coverage as constant intervals.
+
+    Args:
+        bwfile: path to BIGWIG
+        chrom (str): chromosome name
+        st (int): start position
+        ed (int): end position
+
+    Returns:
+        (st, ed, val) arrays
+    """
+    with open(bwfile, mode='rb') as fobj:
+        bw = BigWigFile(fobj)
+        it = bw.get(chrom, st, ed)
+        a = [] if it is None else [(s,e,v) for s,e,v in it]
+    if len(a)==0:
+        return N.array([], dtype=int), N.array([], dtype=int), N.array([])
+    a = N.array(a)
+    return a[:,0].astype(int), a[:,1].astype(int), a[:,2]
+
+def covered_runs(bwfiles, chrom, csize, th=0):
+    """Segments where summed coverage of BIGWIGs is larger than th.
+    Uses stored intervals of the BIGWIGs (no per base array).
+
+    Args:
+        bwfiles: list of BIGWIG paths
+        chrom (str): chromosome name
+        csize (int): chromosome size
+        th (float): threshold
+
+    Returns:
+        (st, ed) arrays of sorted non-overlapping segments
+    """
+    sts, eds, vals = [], [], []
+    for bwfile in bwfiles:
+        if os.path.exists(bwfile):
+            st, ed, val = get_bigwig_intervals(bwfile, chrom, 0, csize)
+            sts.append(st)
+            eds.append(ed)
+            vals.append(val)
+    if len(sts)==0:
+        return N.zeros(0,dtype=N.int64), N.zeros(0,dtype=N.int64)
+    rst, red, rval = intervals2runs(N.concatenate(sts), N.concatenate(eds), N.concatenate(vals))
+    idx = rval>th
+    return rst[idx], red[idx]
+
 def merge_bigwigs_chr(bwfiles, chrom, chromsize, dstpath, scale):
     # merge4-allsample.bw chr1 89026991 intervals ~50%
     # better to just use dense array than sparse array
@@ -341,6 +388,61 @@ def merge_bigwigs_mp(bwfiles, genome, dstpath, scale=None, np=7):
     if os.path.exists(wigpath):
         os.unlink(wigpath)
     
+def intervals2runs(st, ed, val):
+    """Sum of constant intervals as run-length segments (difference array in 
+    breakpoint coordinates, no chromosome size array).
+
+    Args:
+        st, ed: interval starts and ends (arrays)
+        val: value of each interval (array)
+
+    Returns:
+        (rst, red, rval) arrays of non-zero segments, adjacent segments with 
+        the same value are merged (same as array2wiggle_chr output)
+    """
+    st = N.asarray(st, dtype=N.int64)
+    ed = N.asarray(ed, dtype=N.int64)
+    val = N.asarray(val, dtype=N.float64)
+    idx = (ed>st)&(val!=0)
+    st, ed, val = st[idx], ed[idx], val[idx]
+    if len(st)==0:
+        return N.zeros(0,dtype=N.int64), N.zeros(0,dtype=N.int64), N.zeros(0)
+    bp = N.unique(N.concatenate([st, ed])) # breakpoints
+    ist = N.searchsorted(bp, st)
+    ied = N.searchsorted(bp, ed)
+    dv = N.zeros(len(bp))
+    dn = N.zeros(len(bp), dtype=N.int64) # number of intervals, to get exact 0
+    N.add.at(dv, ist, val)
+    N.add.at(dv, ied, -val)
+    N.add.at(dn, ist, 1)
+    N.add.at(dn, ied, -1)
+    v = N.cumsum(dv)[:-1]
+    v[N.cumsum(dn)[:-1]==0] = 0.
+    # cumsum leaves rounding residues (0.1+0.3-0.3 != 0.1) which differ from
+    # the per base sum and prevent merging of equal runs => round to 1e-9 relative
+    nz = v!=0
+    e = 10.**(N.floor(N.log10(N.abs(v[nz])))-9)
+    v[nz] = N.round(v[nz]/e)*e
+    # merge adjacent segments with the same value
+    chg = N.ones(len(v), dtype=bool)
+    chg[1:] = v[1:]!=v[:-1]
+    gi = N.nonzero(chg)[0]
+    rst = bp[gi]
+    red = N.concatenate([bp[gi[1:]], bp[-1:]])
+    rval = v[gi]
+    keep = rval!=0
+    return rst[keep], red[keep], rval[keep]
+
+def runs2wiggle_chr(rst, red, rval, chrom, dstpath, mode='w', chunk=100000):
+    """Write run-length segments (from intervals2runs) in the same (bedGraph) 
+    format as cybw.array2wiggle_chr."""
+    UT.makedirs(os.path.dirname(dstpath))
+    with open(dstpath, mode) as fobj:
+        for i in range(0, len(rst), chunk):
+            recs = zip(rst[i:i+chunk], red[i:i+chunk], rval[i:i+chunk])
+            fobj.write(''.join(['{0}\t{1}\t{2}\t{3}\n'.format(chrom,s,e,v) for s,e,v in recs]))
+    return dstpath
+
 # def array2wiggle_chr(a, chrom, dstpath):
     # possibly Cythonify
     # def _gen():
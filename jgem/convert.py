@@ -172,35 +172,26 @@ def gtf2exonsj(gtf, np=12, graphpre=None):
     exons['_id'] = N.arange(len(exons))
     exons.sort_values(['transcript_id','st','ed'],inplace=True)
     # 5',3'
-    ex_s = exons.groupby('transcript_id').size()
-    tid_s = ex_s[ex_s==1].index
-    id_m = ex_s[ex_s>1].index
-    ex_m = exons[exons['transcript_id'].isin(id_m)].copy()
-    ex_m.sort_values(['transcript_id','st','ed'], inplace=True)
-    ex_f = ex_m.groupby('transcript_id').first()
-    ex_l = ex_m.groupby('transcript_id').last()
-    if5 = list(ex_f[ex_f['strand']=='+']['_id'].values)
-    if3 = list(ex_f[ex_f['strand']=='-']['_id'].values)
-    il5 = list(ex_l[ex_l['strand']=='-']['_id'].values)
-    il3 = list(ex_l[ex_l['strand']=='+']['_id'].values)
-    exons['kind'] = 'i'
-    exons.loc[exons['transcript_id'].isin(tid_s),'kind'] = 's'
-    exons.loc[exons['_id'].isin(if5+il5),'kind'] = '5'
-    exons.loc[exons['_id'].isin(if3+il3),'kind'] = '3'
-
-    # find junctions
-    def _igen():
-        for k, g in exons.groupby('transcript_id'):
-            if len(g)<2:
-                continue
-            g = g.sort_values(['st','ed'])
-            chrom,strand,gid=g.iloc[0][['chr','strand','gene_id']]
-            ists = g['ed'].values[:-1] + 1
-            ieds = g['st'].values[1:] - 1
-            for st,ed in izip(ists,ieds):
-                # chr,st,ed,name=tid,sc1,strand,gene_id
-                yield (chrom,st,ed,gid,0,strand)
-    sj = PD.DataFrame([x for x in _igen()], columns=GGB.BEDCOLS[:6])
+    tidx = PD.factorize(exons['transcript_id'].values)[0] # consecutive, NaN => -1
+    valid = tidx>=0
+    first = valid & N.concatenate([[True], tidx[1:]!=tidx[:-1]])
+    last = valid & N.concatenate([tidx[1:]!=tidx[:-1], [True]])
+    strand = exons['strand'].values
+    kind = N.full(len(exons), 'i', dtype=object)
+    kind[first&last] = 's'
+    kind[(first&~last&(strand=='+'))|(last&~first&(strand=='-'))] = '5'
+    kind[(first&~last&(strand=='-'))|(last&~first&(strand=='+'))] = '3'
+    exons['kind'] = kind
+
+    # find junctions: (chr,strand,gene_id of the first exon in each transcript)
+    fpos = N.maximum.accumulate(N.where(first, N.arange(len(exons)), 0))
+    j = N.nonzero(valid & ~last)[0]
+    sj = PD.DataFrame({'chr':exons['chr'].values[fpos[j]],
+                       'st':exons['ed'].values[j]+1,
+                       'ed':exons['st'].values[j+1]-1,
+                       'name':exons['gene_id'].values[fpos[j]],
+                       'sc1':0,
+                       'strand':strand[fpos[j]]}, columns=GGB.BEDCOLS[:6])
     sj['locus'] = UT.calc_locus_strand(sj)
     sj = sj.groupby('locus').first().reset_index()
 
@@ -213,10 +204,7 @@ def gtf2exonsj(gtf, np=12, graphpre=None):
     # position id == locus converted to number
     ex.sort_values(['chr','st','ed'],inplace=True) 
     ex['_id'] = N.arange(len(ex))
-    exg = ex.groupby(['chr','st','ed'])[['_id','locus']].first()
-    exg['_pid'] = N.arange(len(exg)) # position id
-    cse2pid = dict(zip(exg.index,exg['_pid']))
-    ex['_pid'] = [cse2pid[tuple(x)] for x in ex[['chr','st','ed']].values]
+    ex['_pid'] = ex.groupby(['chr','st','ed']).ngroup().values # position id
 
     if len(sj)==0:
         ex['_gidx'] = N.arange(len(ex))
@@ -313,6 +301,29 @@ def gtf2exonsj(gtf, np=12, graphpre=None):
 
 #     return sj, ex
 
+def _blocks2exsj(df, idx, st, ed):
+    """Exons (kind 5,3,i,s) and junctions (kind j) of transcripts given as flat 
+    exon blocks (idx: row in df (chr,name,strand), sorted by idx then st).
+    Junction start is exon end+1 to match STAR SJ.tab.out."""
+    idx = N.asarray(idx)
+    first = N.concatenate([[True], idx[1:]!=idx[:-1]])
+    last = N.concatenate([idx[1:]!=idx[:-1], [True]])
+    chrom = df['chr'].values[idx]
+    name = df['name'].values[idx]
+    strand = df['strand'].values[idx]
+    plus = strand=='+'
+    kind = N.full(len(idx), 'i', dtype=object)
+    kind[(first&plus)|(last&~plus)] = '5'
+    kind[(first&~plus)|(last&plus)] = '3'
+    kind[first&last] = 's'
+    cols = GGB.BEDCOLS[:6]+['kind']
+    ex = PD.DataFrame({'chr':chrom,'st':st,'ed':ed,'name':name,'sc1':0,'strand':strand,
+                       'kind':kind}, columns=cols)
+    j = N.nonzero(~last)[0]
+    sj = PD.DataFrame({'chr':chrom[j],'st':ed[j]+1,'ed':st[j+1],'name':name[j],'sc1':0,
+                       'strand':strand[j],'kind':'j'}, columns=cols)
+    return ex, sj
+
 def bed2exonsj(bed12, np=4, graphpre=None):
     """Extract exons and junctions from BED12
 
@@ -323,38 +334,10 @@ def bed2exonsj(bed12, np=4, graphpre=None):
         sj, ex: Pandas.DataFrames containing junction and exons
 
     """
-    esizes = bed12['esizes'].apply(lambda x: N.array([int(y) for y in x.split(',') if y]))
-    estarts0 = bed12['estarts'].apply(lambda x: N.array([int(y) for y in x.split(',') if y]))
-    bed12['_estarts'] = bed12['st'] + estarts0
-    bed12['_eends'] = bed12['_estarts']+esizes
-    #istarts = eends[:-1]
-    #iends = estarts[1:]
-    cols =['chr','st','ed','tname','strand']
-    def _egen():
-        for chrom,tname,strand,est,eed in UT.izipcols(bed12,['chr','name','strand','_estarts','_eends']):
-            if len(est)==1:
-                yield (chrom,st,ed,tname,0,strand,'s')
-            else:
-                if strand=='+':
-                    yield (chrom,est[0],eed[0],tname,0,strand,'5')
-                    for st,ed in izip(est[1:-1],eed[1:-1]):
-                        yield (chrom,st,ed,tname,0,strand,'i')
-                    yield (chrom,est[-1],eed[-1],tname,0,strand,'3')
-                else: #'-'
-                    yield (chrom,est[0],eed[0],tname,0,strand,'3')
-                    for st,ed in izip(est[1:-1],eed[1:-1]):
-                        yield (chrom,st,ed,tname,0,strand,'i')
-                    yield (chrom,est[-1],eed[-1],tname,0,strand,'5')
-    def _igen():
-        for chrom,tname,strand,est,eed in UT.izipcols(bed12,['chr','name','strand','_estarts','_eends']):
-            #for st,ed in izip(eed[:-1],est[1:]):
-            for st,ed in izip(eed[:-1],est[1:]):
-                yield (chrom,st+1,ed,tname,0,strand,'j')
-                # add 1 to match STAR SJ.tab.out 
-    ex = PD.DataFrame([x for x in _egen()], columns=GGB.BEDCOLS[:6]+['kind'])
+    idx, st, ed = GGB.bed12_blocks(bed12)
+    ex, sj = _blocks2exsj(bed12, idx, st, ed)
     ex['locus'] = UT.calc_locus_strand(ex)
     ex = ex.groupby('locus').first().reset_index()
-    sj = PD.DataFrame([x for x in _igen()], columns=GGB.BEDCOLS[:6]+['kind'])
     sj['locus'] = UT.calc_locus_strand(sj)
     sj = sj.groupby('locus').first().reset_index()
 
@@ -383,34 +366,12 @@ def kg2exonsj(kg, np=4, graphpre=None):
         sj, ex: Pandas.DataFrames containing junction and exons
 
     """
-    kg['_ests'] = kg['exstarts'].apply(lambda x: N.array([int(y) for y in x.split(',') if y]))
-    kg['_eeds'] = kg['exends'].apply(lambda x: N.array([int(y) for y in x.split(',') if y]))
-    
-    cols =['chr','st','ed','tname','strand']
-    def _egen():
-        for chrom,tname,strand,est,eed in UT.izipcols(kg,['chr','name','strand','_ests','_eeds']):
-            if len(est)==1:
-                yield (chrom,st,ed,tname,0,strand,'s')
-            else:
-                if strand=='+':
-                    yield (chrom,est[0],eed[0],tname,0,strand,'5')
-                    for st,ed in izip(est[1:-1],eed[1:-1]):
-                        yield (chrom,st,ed,tname,0,strand,'i')
-                    yield (chrom,est[-1],eed[-1],tname,0,strand,'3')
-                else: #'-'
-                    yield (chrom,est[0],eed[0],tname,0,strand,'3')
-                    for st,ed in izip(est[1:-1],eed[1:-1]):
-                        yield (chrom,st,ed,tname,0,strand,'i')
-                    yield (chrom,est[-1],eed[-1],tname,0,strand,'5')
-    def _igen():
-        for chrom,tname,strand,est,eed in UT.izipcols(kg,['chr','name','strand','_ests','_eeds']):
-            for st,ed in izip(eed[:-1],est[1:]):
-                yield (chrom,st+1,ed,tname,0,strand,'j')
-                # add 1 to match STAR SJ.tab.out 
-    ex = PD.DataFrame([x for x in _egen()], columns=GGB.BEDCOLS[:6]+['kind'])
+    st, cnts = GGB.intlists(kg['exstarts'])
+    ed, _ = GGB.intlists(kg['exends'])
+    idx = N.repeat(N.arange(len(kg)), cnts)
+    ex, sj = _blocks2exsj(kg, idx, st, ed)
     ex['locus'] = UT.calc_locus_strand(ex)
     ex = ex.groupby('locus').first().reset_index() # remove dup
-    sj = PD.DataFrame([x for x in _igen()], columns=GGB.BEDCOLS[:6]+['kind'])
     sj['locus'] = UT.calc_locus_strand(sj)
     sj = sj.groupby('locus').first().reset_index() # remove dup
 
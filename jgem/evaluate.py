@@ -182,16 +182,22 @@ class EvalMatch(object):
         self.binsize = binsize
         self.exclude_se_from_completeness = exclude_se_from_completeness
 
-    def calculate(self, np=3, saveintermediates=False):
+    def calculate(self, np=3, saveintermediates=False, refindex=None):
         """Calculate necessary data.
 
         1. for en1 and en2 calculate ecov,gcov,jcnt (prep_sjex)
         2. calculate match between en1 and en2 (find_match)
         3. calculate length ratio, detected numbers, sensitivity, etc. (calc_stats)
 
+        Args:
+            refindex: BT.IntervalIndex of en1 exons (see EvalMatch.refindex), 
+              if given used instead of bedtools for exon overlaps and en1 is
+              assumed to be already prepared (prep_sjex, see load_prepared)
+
         """
         # calc exon, junction, gene coverage
-        self.prep_sjex(self.en1, np, True, True)
+        if refindex is None:
+            self.prep_sjex(self.en1, np, True, True)
         self.prep_sjex(self.en2, np, True, False)
         # register for deleting later, keep ref calc
         dcode = self.datacode
@@ -199,7 +205,7 @@ class EvalMatch(object):
         # self.en2.fname2('ecov.txt.gz',dcode)
         # self.en2.fname2('gcov.txt.gz',dcode)
 
-        self.find_match()
+        self.find_match(refindex)
         self.calc_stats()
         self.calc_completeness()
         if not saveintermediates:
@@ -284,7 +290,7 @@ class EvalMatch(object):
                     dstprefix=en.fname2('',self.datacode),  # cov is data dependent
                     override=False, # override previous?
                     np=np)
-                ex[ecovname] = ecov.set_index('eid').ix[ex['_id'].values]['ecov'].values
+                ex[ecovname] = ecov.set_index('eid').loc[ex['_id'].values]['ecov'].values
                 saveex = True
             # gcov, glen
             gcovname = self.colname('gcov')
@@ -296,7 +302,7 @@ class EvalMatch(object):
                     dstprefix=en.fname2('',self.datacode), 
                     override=False, # reuse covci from ecov calc
                     np=np)
-                tmp = gcov.set_index('_gidx').ix[ex['_gidx'].values]
+                tmp = gcov.set_index('_gidx').loc[ex['_gidx'].values]
                 ex[gcovname] = tmp['gcov'].values
                 if 'glen' in tmp:
                     ex['glen'] = tmp['glen'].values # glen is only dependent on model not data
@@ -332,22 +338,38 @@ class EvalMatch(object):
         if savesj and savesjex:
             en.savemodel('sj',dcode, category='output')
 
-    def find_match(self):
+    def excols(self):
+        return ['chr','st','ed','cat','_id',self.colname('ecov'),'_gidx','len','strand']
+
+    def refindex(self):
+        """Reference (en1) exon interval index (after prep_sjex), saved to 
+        (outdir)/(code1).(datacode).refindex.txt.gz and reused if exists."""
+        path = self.en1.fname2('refindex.txt.gz', self.datacode, category='output')
+        if os.path.exists(path):
+            return load_refindex(path)
+        idx = BT.IntervalIndex(self.en1.model('ex'), self.excols())
+        idx.save(path)
+        return idx
+
+    def find_match(self, refindex=None):
         en1 = self.en1
         en2 = self.en2
-        # write internal,3,5,se exons separately for finding match
-        a = en1.fname2('emtmp.ex.bed.gz', en2.code) # need to be unique to avoid parallel conflict (en1 ref shared)
-        b = en2.fname('emtmp.ex.bed.gz')
-        c = en1.fname2('emtmp.ex.ovl.txt.gz', en2.code)
         self.e1 = e1 = en1.model('ex')
         self.e2 = e2 = en2.model('ex')
         ecovname = self.colname('ecov')
-        cols = ['chr','st','ed','cat','_id',ecovname,'_gidx','len','strand']
-        a = UT.write_pandas(e1[cols],a,'')
-        b = UT.write_pandas(e2[cols],b,'')
-        c = BT.bedtoolintersect(a,b,c,wao=True)
-        ocols = cols + ['b_'+x for x in cols] + ['ovl']
-        self.ov = ov = UT.read_pandas(c, names=ocols) # overlaps of exons
+        cols = self.excols()
+        if refindex is not None: # shared reference index
+            self.ov = ov = refindex.wao(e2[cols], side='a')
+        else:
+            # write internal,3,5,se exons separately for finding match
+            a = en1.fname2('emtmp.ex.bed.gz', en2.code) # need to be unique to avoid parallel conflict (en1 ref shared)
+            b = en2.fname('emtmp.ex.bed.gz')
+            c = en1.fname2('emtmp.ex.ovl.txt.gz', en2.code)
+            a = UT.write_pandas(e1[cols],a,'')
+            b = UT.write_pandas(e2[cols],b,'')
+            c = BT.bedtoolintersect(a,b,c,wao=True)
+            ocols = cols + ['b_'+x for x in cols] + ['ovl']
+            self.ov = ov = UT.read_pandas(c, names=ocols) # overlaps of exons
         
         idxchr = ov['chr']==ov['b_chr'] # str vs. str
         idxstrand = ov['strand']==ov['b_strand'] # str vs. str
@@ -804,6 +826,54 @@ class EvalMatch(object):
 
 
 
+_REFINDEXCACHE = {} # path => BT.IntervalIndex (per process)
+
+def load_refindex(path):
+    if path not in _REFINDEXCACHE:
+        _REFINDEXCACHE[path] = BT.IntervalIndex.load(path)
+    return _REFINDEXCACHE[path]
+
+def load_prepared(en, datacode):
+    """Load exon, junction models saved by prep_sjex (with coverages, counts)."""
+    en.model('ex', datacode)
+    en.model('sj', datacode)
+    return en
+
+def _evaluate_one(sjexbase1, code1, outdir1, en2, bigwig, sjfile, datacode, binsize, 
+                  saveintermediates, refindexpath, exclude_se_from_completeness):
+    en1 = EvalNames(sjexbase1, code1, outdir1)
+    load_prepared(en1, datacode) # reference with coverages, no prep_sjex
+    em = EvalMatch(en1, en2, bigwig, sjfile, datacode, binsize, exclude_se_from_completeness)
+    em.calculate(np=1, saveintermediates=saveintermediates, refindex=load_refindex(refindexpath))
+    return em.stats
+
+def evaluate_batch(en1, en2s, bigwig, sjfile, datacode, binsize=500, np=3, 
+                   saveintermediates=False, exclude_se_from_completeness=True):
+    """Evaluate many models against one reference.
+
+    The reference (en1) coverages, junction counts (prep_sjex) and its exon interval
+    index are calculated once and saved, then targets (en2s) are evaluated in parallel.
+
+    Args:
+        en1: EvalNames object, reference
+        en2s: list of EvalNames objects
+        bigwig, sjfile, datacode, binsize, exclude_se_from_completeness: see EvalMatch
+        np: number of processes
+
+    Returns:
+        list of stats (dict) for en2s
+    """
+    em = EvalMatch(en1, en2s[0], bigwig, sjfile, datacode, binsize)
+    em.prep_sjex(en1, np, True, True)
+    # workers read these instead of prep_sjex 
+    en1.savemodel('ex', datacode, category='output')
+    en1.savemodel('sj', datacode, category='output')
+    em.refindex()
+    path = en1.fname2('refindex.txt.gz', datacode, category='output')
+    args = [(en1.sjexbase, en1.code, en1.outdir, en2, bigwig, sjfile, datacode, binsize, 
+             saveintermediates, path, exclude_se_from_completeness) for en2 in en2s]
+    return UT.process_mp(_evaluate_one, args, np=np, doreduce=False)
+
 def plot_elen_vs_tlen_gtf(gtf, ax=None, ms=1, alpha=0.1, title=''):
     gtf['tlen'] = gtf['ed']-gtf['st']
     tr = gtf[gtf['typ']=='transcript'][['transcript_id','tlen']].copy().set_index('transcript_id')
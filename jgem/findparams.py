@@ -217,15 +217,13 @@ class ParamFinder(object):
     
     def calc_flux_mp(self, beddf, np=10):
         chroms = UT.chroms(self.genome)
-        args = []
-        for c in chroms:
-            bedc = beddf[beddf['chr']==c]
-            if len(bedc)>0:
-                # args.append((bedc, self.bwpaths.copy()))
-                args.append((bedc, self.bwpre))
+        bed = beddf[beddf['chr'].isin(chroms)].sort_values(['chr','st'])
+        # balanced chunks of nearby exons instead of per chromosome
+        cost = (bed['ed']-bed['st']).values+2
+        args = [(c, self.bwpre) for c in UT.split_balanced(bed, cost, 4*np)]
         rslts = UT.process_mp2(calc_flux_chr, args, np=np, doreduce=True)
         df = PD.DataFrame(rslts, columns=CALCFLUXCOLS)
-        exdfi = beddf.set_index('_id').ix[df['_id'].values]
+        exdfi = beddf.set_index('_id').loc[df['_id'].values]
         for f in COPYCOLS:
             if f in exdfi:
                 df[f] =exdfi[f].values
@@ -618,15 +616,14 @@ class ParamFinder(object):
 
     def calc_params_mp(self, beddf,  win=600, siz=10, direction='>', gapmode='53', np=10, covfactor=0):
         chroms = UT.chroms(self.genome)
-        args = []
-        for c in chroms:
-            bedc = beddf[beddf['chr']==c]
-            if len(bedc)>0:
-                # args.append((bedc, self.bwpaths.copy(), win, siz, direction, gapmode, covfactor))
-                args.append((bedc, self.bwpre, win, siz, direction, gapmode, covfactor))
+        bed = beddf[beddf['chr'].isin(chroms)].sort_values(['chr','st'])
+        # balanced chunks of nearby exons instead of per chromosome
+        cost = (bed['ed']-bed['st']).values+2*win
+        args = [(c, self.bwpre, win, siz, direction, gapmode, covfactor) 
+                for c in UT.split_balanced(bed, cost, 4*np)]
         rslts = UT.process_mp2(calc_params_chr, args, np=np, doreduce=True)
         df = PD.DataFrame(rslts, columns=CALCPARAMCOLS)
-        exdfi = beddf.set_index('_id').ix[df['_id'].values]
+        exdfi = beddf.set_index('_id').loc[df['_id'].values]
         for f in COPYCOLS:
             if f in exdfi:
                 df[f] =exdfi[f].values
@@ -802,67 +799,150 @@ CALCPARAMCOLS = ['_id','emax','emin',
             'eOut','sOut','sdOut','gap', 'mp','chr','st','ed','strand']
             # 'gap000', 'gap001', 'gap002','gap005']#,'gap010','gap015','gap020']
 
-def calc_params_chr(exdf, bwp, win=300, siz=10,  direction='>', gapmode='i', covfactor=0):
-    # bws = make_bws(bwp)
+BLOCKSIZE = int(2**24) # max span of exons processed together (coverage loaded once per block)
+ROWSIZE = int(2**22) # max number of elements in 2-D flank window arrays
+
+def _blocks(exdf, blocksize=BLOCKSIZE):
+    """Split exons (sorted by st, same chrom) into blocks spanning < blocksize."""
+    st = exdf['st'].values
+    i = 0
+    while i<len(st):
+        j = max(N.searchsorted(st, st[i]+blocksize, 'left'), i+1)
+        yield exdf.iloc[i:j]
+        i = j
+
+def _getblock(bw, chrom, st, ed):
+    """Coverage [st,ed) with positions <0 as NaN, None if no coverage for chrom."""
+    c = bw.get(chrom, max(0,st), ed)
+    if len(c)==0:
+        return None
+    a = N.empty(ed-st, dtype=c.dtype)
+    a[:ed-st-len(c)] = N.nan
+    a[ed-st-len(c):] = c
+    return a
+
+def _windows(a, starts, size):
+    """2-D array of a[s:s+size] for s in starts."""
+    v = N.lib.stride_tricks.as_strided(a, shape=(len(a)-size+1, size), strides=(a.strides[0],)*2)
+    return v[starts]
+
+def _segments(a, st, ed):
+    """Concatenated a[s:e] for (s,e) in zip(st,ed) with offsets, lengths, segment ids and 
+    local positions."""
+    L = ed-st
+    o = N.cumsum(L)-L
+    sid = N.repeat(N.arange(len(L)), L)
+    loc = N.arange(L.sum()) - o[sid]
+    return a[st[sid]+loc], o, L, sid, loc
+
+def find_maxgap_segs(seg, L, emin, emax, th, win, gapmode):
+    """Vectorized find_maxgap over concatenated segments (lengths L, thresholds th)."""
+    n = len(L)
+    o = N.cumsum(L)-L
+    sid = N.repeat(N.arange(n), L)
+    loc = N.arange(len(seg)) - o[sid]
+    gt = seg>th[sid]
+    le = ~gt
+    if gapmode!='i': # only gaps before the furthest covered point
+        maxpos = N.full(n, -1, dtype=N.int64)
+        N.maximum.at(maxpos, sid[gt], loc[gt])
+        le &= loc<=maxpos[sid]
+    prev = N.concatenate([[False], le[:-1]])
+    prev[o] = False
+    rs = le & ~prev # run starts
+    rid = N.cumsum(rs)-1
+    cnt = N.bincount(rid[le], minlength=N.sum(rs))
+    gap = N.zeros(n, dtype=N.int64)
+    N.maximum.at(gap, sid[rs], cnt)
+    gap[emax<=th] = win
+    gap[emin>th] = 0
+    return gap
+
+def find_firstgap_rows(W, th, win):
+    """Vectorized find_firstgap over rows of W (NaN: outside of chromosome)."""
+    emin = N.nanmin(W, axis=1)
+    emax = N.nanmax(W, axis=1)
+    g = W<=th[:,None]
+    cst = N.argmax(g, axis=1)
+    ng = (~g) & (N.arange(W.shape[1])[None,:]>cst[:,None])
+    ced = N.where(N.any(ng, axis=1), N.argmax(ng, axis=1), W.shape[1])
+    gap, pos = ced-cst, cst
+    idx = emax<=th
+    gap[idx], pos[idx] = win, 0
+    idx = emin>th
+    gap[idx], pos[idx] = 0, win
+    return gap, pos, emin, emax
+
+def _params_block(ex, a, b, bst, strand, win, siz, direction, gapmode, covfactor):
+    st = ex['st'].values - bst # positions in a, b
+    ed = ex['ed'].values - bst
+    n = len(st)
+    exl10 = _windows(a, st, siz).mean(axis=1)
+    sjl10 = _windows(b, st-siz, siz).mean(axis=1)
+    exr10 = _windows(a, ed-siz, siz).mean(axis=1)
+    sjr10 = _windows(b, ed, siz).mean(axis=1)
+    sdifl = b[st]-b[st-1]
+    sdifr = b[ed]-b[ed-1]
+    seg, o, L, sid, loc = _segments(a, st, ed)
+    exmax = N.maximum.reduceat(seg, o)
+    exmin = N.minimum.reduceat(seg, o)
+    if gapmode=='i':
+        gapth = exmax*covfactor
+    else:
+        if direction=='>':
+            gapth = exl10*covfactor
+        else:
+            gapth = exr10*covfactor
+    mp = N.bincount(sid, weights=seg>gapth[sid], minlength=n)/L.astype(float)
+    if not (((direction=='>')&(strand=='+'))|((direction!='>')&(strand=='-'))):
+        seg = a[ed[sid]-1-loc] # reversed
+    gap = find_maxgap_segs(seg, L, exmin, exmax, gapth, win, gapmode)
+    # flanks
+    gapl, posl, minl, maxl = [N.empty(n) for x in range(4)]
+    gapr, posr, minr, maxr = [N.empty(n) for x in range(4)]
+    nb = max(1, ROWSIZE//win)
+    for i in range(0, n, nb):
+        j = min(n, i+nb)
+        W = _windows(a, st[i:j]-win, win)[:,::-1]
+        gapl[i:j], posl[i:j], minl[i:j], maxl[i:j] = find_firstgap_rows(W, gapth[i:j], win)
+        W = _windows(a, ed[i:j], win)
+        gapr[i:j], posr[i:j], minr[i:j], maxr[i:j] = find_firstgap_rows(W, gapth[i:j], win)
+    if strand=='+':
+        cols = [ex['_id'].values, exmax, exmin, maxl, minl, gapl, posl, maxr, minr, gapr, posr,
+                exl10, sjl10, sdifl, exr10, sjr10, sdifr]
+    else:
+        cols = [ex['_id'].values, exmax, exmin, maxr, minr, gapr, posr, maxl, minl, gapl, posl,
+                exr10, sjr10, sdifr, exl10, sjl10, sdifl]
+    cols += [gap, mp, ex['chr'].values, ex['st'].values, ex['ed'].values, ex['strand'].values]
+    df = PD.DataFrame(dict(zip(CALCPARAMCOLS, cols)), columns=CALCPARAMCOLS)
+    for c in ['gapIn','gposIn','gapOut','gposOut']:
+        df[c] = df[c].astype(int)
+    return df.values.tolist()
+
+def calc_params_chr(exdf, bwp, win=300, siz=10,  direction='>', gapmode='i', covfactor=0, blocksize=BLOCKSIZE):
+    """Coverage profile parameters around exons (CALCPARAMCOLS). 
+
+    Coverages are read once per block of nearby exons (blocksize) and the flank 
+    windows (win) are processed as 2-D arrays. Exons can be from multiple chromosomes.
+    """
     sjexbw = A3.SjExBigWigs(bwp)
 
     ebw = sjexbw.bws['ex']
     sbw = sjexbw.bws['sj']    
     recs = []
-    cols =CALCPARAMCOLS
     with sjexbw:
-        for strand in ['+','-','.']:
-            exdfsub = exdf[exdf['strand']==strand]
-            for chrom,st,ed,_id in exdfsub[['chr','st','ed','_id']].values:
-                #win = ed-st # same size as exon
-                left = max(0, st-win)
-                if left==0:
-                    print('st-win<0:{0}:{1}-{2}'.format(chrom,st,ed))
-                right = ed+win
-                stpos = st-left
-                edpos = ed-left
-                a1 = ebw[strand].get(chrom,left,right)
-                b1 = sbw[strand].get(chrom,left,right)
-                 
-                exl10 = N.mean(a1[stpos:stpos+siz])
-                sjl10 = N.mean(b1[stpos-siz:stpos])
-                exr10 = N.mean(a1[edpos-siz:edpos])
-                sjr10 = N.mean(b1[edpos:edpos+siz])
-                sdifl = b1[stpos]-b1[stpos-1]
-                sdifr = b1[edpos]-b1[edpos-1]
-                exmax = N.max(a1[stpos:edpos])
-                exmin = N.min(a1[stpos:edpos])
-                #gapth = sjl10*covfactor if strand=='+' else sjr10*covfactor
-                if gapmode=='i':
-                    gapth = exmax*covfactor
-                else:
-                    if direction=='>':
-                        gapth = exl10*covfactor
-                    else:
-                        gapth = exr10*covfactor
-                if ((direction=='>')&(strand=='+'))|((direction!='>')&(strand=='-')):
-                    gap = find_maxgap(a1[stpos:edpos],exmin, exmax, gapth, win, gapmode)
-                else:
-                    gap = find_maxgap(a1[stpos:edpos][::-1],exmin, exmax, gapth, win, gapmode)
-                maxl = N.max(a1[:stpos])
-                maxr = N.max(a1[edpos:])
-                minl = N.min(a1[:stpos])
-                minr = N.min(a1[edpos:])
-                gapl,posl = find_firstgap(a1[:stpos][::-1],minl,maxl,gapth,win)
-                gapr,posr = find_firstgap(a1[edpos:],minr,maxr,gapth,win)
-                mp = float(N.sum(a1[stpos:edpos]>gapth))/(ed-st)
-                if strand=='+':
-                    recs.append([_id,exmax,exmin,
-                                 maxl,minl,gapl,posl, 
-                                 maxr,minr,gapr,posr, 
-                                 exl10,sjl10,sdifl,
-                                 exr10,sjr10,sdifr, gap, mp,chrom,st,ed,strand]) #+[gaps[x] for x in cfs])
-                else:
-                    recs.append([_id,exmax,exmin,
-                                 maxr,minr,gapr,posr, 
-                                 maxl,minl,gapl,posl, 
-                                 exr10,sjr10,sdifr,
-                                 exl10,sjl10,sdifl, gap, mp,chrom,st,ed,strand]) #+[gaps[x] for x in cfs])
+        for (chrom, strand), exsub in exdf.groupby(['chr','strand']):
+            if strand not in ['+','-','.']:
+                continue
+            exsub = exsub.sort_values('st')
+            for ex in _blocks(exsub, blocksize):
+                bst = ex['st'].min()-win
+                bed = ex['ed'].max()+win
+                a = _getblock(ebw[strand], chrom, bst, bed)
+                b = _getblock(sbw[strand], chrom, bst, bed)
+                if a is None or b is None:
+                    continue
+                recs += _params_block(ex, a, b, bst, strand, win, siz, direction, gapmode, covfactor)
     return recs
 
 COPYCOLS = ['_gidx','locus','gene_id']#,'gene_type']
@@ -870,33 +950,45 @@ COPYCOLS = ['_gidx','locus','gene_id']#,'gene_type']
 CALCFLUXCOLS = ['_id', 'sdelta','ecovavg','ecovmin','ecovmax',
                 'sin','sout','ein','eout','sdin','sdout','chr','st','ed','strand']
 
-def calc_flux_chr(exdf, bwp):
-    # bws = make_bws(bwp)
+def _flux_block(ex, a, b, bst, strand):
+    st = ex['st'].values - bst # positions in a, b
+    ed = ex['ed'].values - bst
+    seg, o, L, sid, loc = _segments(a, st-1, ed+1)
+    ecovavg = N.add.reduceat(seg, o)/L.astype(float)
+    ecovmin = N.minimum.reduceat(seg, o)
+    ecovmax = N.maximum.reduceat(seg, o)
+    s0, s1, sm1, sm2 = b[st-1], b[st], b[ed], b[ed-1] # scov[0], scov[1], scov[-1], scov[-2]
+    e0, em1 = a[st-1], a[ed]
+    if strand=='+':
+        cols = [sm1-s0, ecovavg, ecovmin, ecovmax, s0, sm1, e0, em1, s1-s0, sm1-sm2]
+    else:
+        cols = [s0-sm1, ecovavg, ecovmin, ecovmax, sm1, s0, em1, e0, -sm1+sm2, -s1+s0]
+    cols = [ex['_id'].values] + cols + [ex['chr'].values, ex['st'].values, ex['ed'].values, ex['strand'].values]
+    df = PD.DataFrame(dict(zip(CALCFLUXCOLS, cols)), columns=CALCFLUXCOLS)
+    return df.values.tolist()
+
+def calc_flux_chr(exdf, bwp, blocksize=BLOCKSIZE):
+    """Junction/exon coverage flux at exon boundaries (CALCFLUXCOLS).
+
+    Coverages are read once per block of nearby exons (blocksize). Exons can be from 
+    multiple chromosomes.
+    """
     sjexbw = A3.SjExBigWigs(bwp)
 
     ebw = sjexbw.bws['ex']
     sbw = sjexbw.bws['sj']
     recs = []
-    cols = CALCFLUXCOLS
     with sjexbw:
-        for strand in ['+','-','.']:
-            exdfsub = exdf[exdf['strand']==strand]
-            for chrom, st, ed, _id in exdfsub[['chr','st','ed', '_id']].values:
-                ecov = ebw[strand].get(chrom,st-1,ed+1)
-                scov = sbw[strand].get(chrom,st-1,ed+1)
-                if len(ecov)>0 and len(scov)>0: # some samples do not have any read on dm6, chrY
-                    if strand=='+':
-                        sd = scov[-1]-scov[0]
-                        sin,sout = scov[0],scov[-1]
-                        ein,eout = ecov[0],ecov[-1]
-                        sdin= scov[1]-scov[0]
-                        sdout = scov[-1]-scov[-2]
-                    else:
-                        sd = scov[0]-scov[-1]
-                        sin,sout = scov[-1],scov[0]
-                        ein,eout = ecov[-1],ecov[0]
-                        sdout= -scov[1]+scov[0]
-                        sdin = -scov[-1]+scov[-2]
-                    recs.append([_id, sd, ecov.mean(), ecov.min(), ecov.max(),
-                                 sin,sout,ein,eout,sdin,sdout,chrom,st,ed,strand])
+        for (chrom, strand), exsub in exdf.groupby(['chr','strand']):
+            if strand not in ['+','-','.']:
+                continue
+            exsub = exsub.sort_values('st')
+            for ex in _blocks(exsub, blocksize):
+                bst = ex['st'].min()-1
+                bed = ex['ed'].max()+1
+                a = _getblock(ebw[strand], chrom, bst, bed)
+                b = _getblock(sbw[strand], chrom, bst, bed)
+                if a is None or b is None: # some samples do not have any read on dm6, chrY
+                    continue
+                recs += _flux_block(ex, a, b, bst, strand)
     return recs
@@ -0,0 +1,129 @@
+"""
+    Transitive closure of ontology DAGs (GO, MP) as CSR row arrays.
+
+"""
+import os
+
+import numpy as N
+
+from jgem.utils import notstale
+
+
+def topological_order(parents, children):
+    """Node indices ordered so that parents come before children (Kahn)."""
+    n = len(parents)
+    npar = N.array([len(x) for x in parents])
+    order = list(N.nonzero(npar==0)[0])
+    i = 0
+    while i < len(order):
+        for c in children[order[i]]:
+            npar[c] -= 1
+            if npar[c]==0:
+                order.append(c)
+        i += 1
+    if len(order) != n:
+        raise ValueError('cycle in ontology graph')
+    return N.array(order, dtype=N.int64)
+
+
+class Closure(object):
+    """Rows of a sparse 0/1 matrix in CSR form (indptr, indices).
+
+    closure[i] returns the column indices of row i (O(1) slice).
+    """
+
+    def __init__(self, indptr, indices):
+        self.indptr = indptr
+        self.indices = indices
+
+    def __getitem__(self, i):
+        return self.indices[self.indptr[i]:self.indptr[i+1]]
+
+    def __len__(self):
+        return len(self.indptr)-1
+
+    def counts(self):
+        return N.diff(self.indptr)
+
+    def matrix(self):
+        """scipy.sparse CSR matrix"""
+        from scipy.sparse import csr_matrix
+        n = len(self)
+        data = N.ones(len(self.indices), dtype=N.int8)
+        return csr_matrix((data, self.indices, self.indptr), shape=(n,n))
+
+    def transpose(self):
+        n = len(self)
+        rows = N.repeat(N.arange(n, dtype=N.int64), self.counts())
+        o = N.lexsort((rows, self.indices))
+        indptr = N.zeros(n+1, dtype=N.int64)
+        indptr[1:] = N.cumsum(N.bincount(self.indices, minlength=n))
+        return Closure(indptr, rows[o])
+
+    def save(self, prefix):
+        N.save(prefix+'.indptr.npy', self.indptr)
+        N.save(prefix+'.indices.npy', self.indices)
+
+    @classmethod
+    def load(cls, prefix, mmap_mode='r'):
+        indptr = N.load(prefix+'.indptr.npy', mmap_mode=mmap_mode)
+        indices = N.load(prefix+'.indices.npy', mmap_mode=mmap_mode)
+        return cls(indptr, indices)
+
+    @classmethod
+    def exists(cls, prefix):
+        return os.path.exists(prefix+'.indices.npy')
+
+
+def descendants_closure(parents, children):
+    """Descendants (including self) of all nodes, calculated once from the leaves up
+    (reverse topological order)."""
+    n = len(parents)
+    order = topological_order(parents, children)
+    rows = [None]*n
+    for i in order[::-1]:
+        if len(children[i])==0:
+            rows[i] = N.array([i], dtype=N.int64)
+        else:
+            rows[i] = N.unique(N.concatenate([[i]]+[rows[c] for c in children[i]]))
+    indptr = N.zeros(n+1, dtype=N.int64)
+    indptr[1:] = N.cumsum([len(x) for x in rows])
+    indices = N.concatenate(rows) if n>0 else N.zeros(0, dtype=N.int64)
+    return Closure(indptr, indices)
+
+
+def node_levels(parents, children, roots, func=min):
+    """Minimum (func=min) or maximum (func=max) depth from roots, -1 if not reachable."""
+    lvl = N.full(len(parents), -1, dtype=N.int64)
+    for r in roots:
+        lvl[r] = 0
+    for i in topological_order(parents, children):
+        if lvl[i]==0 and len(parents[i])==0:
+            continue
+        pl = [lvl[p] for p in parents[i] if lvl[p]>=0]
+        if len(pl)>0:
+            lvl[i] = func(pl)+1
+    return list(lvl)
+
+
+def load_closures(obo, parents, children):
+    """Descendants and ancestors (excluding self) Closures cached as (obo).desc.*.npy,
+    (obo).anc.*.npy and memory mapped. Caches older than obo or with a different
+    number of rows than parents are recalculated."""
+    dpre, apre = obo+'.desc', obo+'.anc'
+    def _fresh(pre):
+        if not (Closure.exists(pre) and notstale(obo, pre+'.indptr.npy')
+                and notstale(obo, pre+'.indices.npy')):
+            return False
+        return len(Closure.load(pre))==len(parents)
+    if not (_fresh(dpre) and _fresh(apre)):
+        desc = descendants_closure(parents, children)
+        desc.save(dpre)
+        anc = desc.transpose()
+        # exclude self from ancestors
+        rows = N.repeat(N.arange(len(anc), dtype=N.int64), anc.counts())
+        keep = anc.indices != rows
+        indptr = N.zeros(len(anc)+1, dtype=N.int64)
+        indptr[1:] = N.cumsum(N.bincount(rows[keep], minlength=len(anc)))
+        Closure(indptr, anc.indices[keep]).save(apre)
+    return Closure.load(dpre), Closure.load(apre)
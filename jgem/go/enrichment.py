@@ -16,6 +16,9 @@ from scipy.stats import chi2
 
 from bioinfo3.go.graphviz import Graphviz
 from scipy.stats import hypergeom
+from scipy import sparse as SPS
+
+from jgem.dataset.p_adjust import p_adjust
 from rpy2.robjects import r, FloatVector
 
 pmf = hypergeom.pmf
@@ -61,6 +64,84 @@ def compare_scipy_rpy():
 #     
 """
 
+def incidence(rows, cols, shape):
+    """Sparse (CSR) 0/1 matrix with ones at (rows, cols)."""
+    data = N.ones(len(rows), dtype=N.int32)
+    m = SPS.csr_matrix((data, (N.asarray(rows, dtype=int), N.asarray(cols, dtype=int))), shape=shape)
+    m.data[:] = 1 # duplicates are summed
+    return m
+
+def members(mat, rows, cols, names):
+    """For each row in rows, list of names[c] for c in cols with mat[row,c]>0."""
+    sub = mat[rows][:, cols].tocsr()
+    names = N.array(names, dtype=object)[cols]
+    return [list(names[sub.indices[sub.indptr[i]:sub.indptr[i+1]]]) for i in range(len(rows))]
+
+def selection_matrix(S, ids, id2x, tot):
+    """Gene set x gene 0/1 matrix S (dense or sparse, columns: ids) to CSR matrix 
+    with population columns (id2x: id => column, ids not in population are dropped)."""
+    S = SPS.coo_matrix(S)
+    cx = N.array([id2x.get(x,-1) for x in ids], dtype=int)[S.col]
+    idx = (cx>=0)&(S.data!=0)
+    return incidence(S.row[idx], cx[idx], (S.shape[0], tot))
+
+def hypergeom_batch(X, M, n1, num, tot):
+    """Counts, p-values and odds for all set x term pairs.
+
+    Args:
+        X: sets x ids selection matrix (CSR)
+        M: terms x ids incidence matrix (CSR)
+        n1: population counts of terms
+        num: number of selected (with association) in each set
+        tot: population total
+
+    Returns:
+        (counts, p-values, odds) arrays (sets x terms)
+    """
+    n0 = N.asarray(X.dot(M.T).todense()).astype(int)
+    num = num[:,None]
+    n1 = n1[None,:]
+    pval = hypergeom.sf(n0-1, tot, n1, num)
+    with N.errstate(divide='ignore', invalid='ignore'):
+        odds = (n0/n1.astype(float))/(num/float(tot))
+    return n0, pval, odds
+
+def adjust_rows(pval, tested, method='BH'):
+    """p_adjust each row (set) over tested terms, NaN for untested."""
+    q = N.where(tested, pval, N.nan)
+    for i in range(len(q)):
+        q[i] = p_adjust(q[i], method)
+    return q
+
+
+class BatchResult(object):
+    """Enrichment of many selected sets against one population.
+
+    Attributes:
+        sets: names of the sets (rows)
+        terms: term ids (columns)
+        num: number of selected with association for each set
+        tot: population total
+        flds: names of the arrays (sets x terms, population counts: terms)
+    """
+
+    def __init__(self, sets, terms, num, tot, **arrays):
+        self.sets = sets
+        self.terms = terms
+        self.num = num
+        self.tot = tot
+        self.flds = sorted(arrays.keys())
+        for k, v in arrays.items():
+            setattr(self, k, v)
+
+    def frame(self, fld):
+        """DataFrame (sets x terms) of fld"""
+        return PD.DataFrame(getattr(self, fld), index=self.sets, columns=self.terms)
+
+    def __repr__(self):
+        return 'BatchResult: %d sets x %d terms (%s)' % (len(self.sets), len(self.terms), ','.join(self.flds))
+
+
 class EnrichmentAnalysis(object):
 
     def __init__(self, population_ids, id2term):
@@ -73,34 +154,67 @@ class EnrichmentAnalysis(object):
             for t in self.i2t[i]:
                 t2i.setdefault(t,set()).add(i)
         self.t2i = t2i
+        # term x id incidence matrix (ids with term association)
+        self.ids = ids = sorted(self.i2t.keys())
+        self.id2x = {x:i for i,x in enumerate(ids)}
+        self.terms = terms = sorted(t2i.keys())
+        t2x = {x:i for i,x in enumerate(terms)}
+        rows = [t2x[t] for i in ids for t in self.i2t[i]]
+        cols = [j for j,i in enumerate(ids) for t in self.i2t[i]]
+        self.M = incidence(rows, cols, (len(terms), len(ids)))
+        self.n1 = N.asarray(self.M.sum(axis=1)).ravel() # number of term t for population
 
     def calculate(self, selected_ids):
         self.sel_ids = sorted(list(set(selected_ids)))
         
-        i2t = self.i2t
-        t2i = self.t2i
-        tot = len(i2t)  # population total (with term association)
-        s2t = {s:i2t[s] for s in self.sel_ids if s in i2t}  # id => term in selected
-        num = len(s2t)
-        t2s = {}
-        for s in s2t:
-            for t in s2t[s]:
-                t2s.setdefault(t,set()).add(s)
-        terms = sorted(list(t2s.keys()))
+        id2x = self.id2x
+        tot = len(self.ids)  # population total (with term association)
+        sidx = N.array(sorted([id2x[s] for s in self.sel_ids if s in id2x]), dtype=int)
+        num = len(sidx)
+        v = N.zeros(tot)
+        v[sidx] = 1
+        n0 = self.M.dot(v).astype(int) # number of selected for each term
+        tidx = N.nonzero(n0>0)[0]
+        terms = [self.terms[x] for x in tidx]
         er = EnrichmentResult(tot, num, terms)
+        if len(tidx)==0:
+            return er
         df = er.df
         p = float(num)/float(tot)
-        for t in terms:
-            if t not in t2s:
-                continue
-            n0 = len(t2s[t]) # number of selected for term t
-            n1 = len(t2i[t]) # number of term t for population
-            pval = N.sum(pmf(range(n0,num+1),tot,n1,num))
-            odds = (float(n0)/float(n1))/p
-            ids = ','.join(t2s[t])
-            df.loc[t] = [n1,float(n1)/tot,n0,float(n0)/num,odds,pval,ids]
+        n0 = n0[tidx]
+        n1 = self.n1[tidx]
+        df['total'] = n1
+        df['total %'] = n1/float(tot)
+        df['selected'] = n0
+        df['selected %'] = n0/float(num)
+        df['odds'] = (n0/n1.astype(float))/p
+        df['p.values'] = hypergeom.sf(n0-1, tot, n1, num)
+        df['ids'] = [','.join(x) for x in members(self.M, tidx, sidx, self.ids)]
         return er
 
+    def calculate_batch(self, S, ids, sets=None, method='BH'):
+        """Enrichment for many selected sets at once.
+
+        Args:
+            S: sets x ids boolean matrix (dense or scipy.sparse)
+            ids: ids corresponding to columns of S
+            sets: names of the sets (default 0,1,...)
+            method: p_adjust method for q-values (per set)
+
+        Returns:
+            BatchResult with arrays (sets x terms): selected, p.values (pval), 
+            odds and q-values (qval, NaN if no selected for the term)
+        """
+        tot = len(self.ids)
+        X = selection_matrix(S, ids, self.id2x, tot)
+        num = N.asarray(X.sum(axis=1)).ravel()
+        n0, pval, odds = hypergeom_batch(X, self.M, self.n1, num, tot)
+        qval = adjust_rows(pval, n0>0, method)
+        if sets is None:
+            sets = list(range(X.shape[0]))
+        return BatchResult(sets, self.terms, num, tot, 
+                           selected=n0, total=self.n1, pval=pval, odds=odds, qval=qval)
+
 
 class EnrichmentResult(object):
 
@@ -135,6 +249,15 @@ class GOSlimEnrichment(object):
         i2s = self.id2slim
         self.rslts = {c: {w: A(e[c],i2s[w]).calculate(s[c]) for w in which} for c in conditions}
 
+    def calculate_batch(self, condition, S, ids, sets=None, method='BH'):
+        """Enrichment of many selected sets (S: sets x ids boolean matrix) against
+        population of condition. Returns dict gob,gom,goc => BatchResult
+        (method: p_adjust method for q-values)."""
+        which = ['gob','gom','goc']
+        e = self.populations[condition]
+        i2s = self.id2slim
+        return {w: EnrichmentAnalysis(e,i2s[w]).calculate_batch(S, ids, sets, method) for w in which}
+
     def plot_goslim_bar(self, conds, flds = ['odds', '-log10(p)','selected %'],gos = ['goc','gom','gob'], **kw):
         # flds 'selected %', 
         # some prep
@@ -335,6 +458,39 @@ class GOSlimEnrichment(object):
 
 
 
+class GOIncidence(object):
+    """Node and tree (node + descendants) GO x id incidence matrices of the population.
+
+    Attributes:
+        ids: ids with GO annotation (columns)
+        gos: GO indices (rows)
+        node: CSR matrix, node[g,s]=1 if s is annotated with g
+        tree: CSR matrix, tree[g,s]=1 if s is annotated with g or its descendants
+        n1, t1: population node, tree counts
+    """
+
+    def __init__(self, s2g, g2s, descendants):
+        self.ids = ids = sorted(s2g.keys())
+        self.id2x = {x:i for i,x in enumerate(ids)}
+        self.gos = gos = sorted(g2s.keys())
+        g2x = {x:i for i,x in enumerate(gos)}
+        shape = (len(gos), len(ids))
+        self.node = incidence([g2x[g] for s in ids for g in s2g[s]],
+                              [j for j,s in enumerate(ids) for g in s2g[s]], shape)
+        des = [[g2x[d] for d in descendants[g] if d in g2x] for g in gos]
+        D = incidence([i for i,x in enumerate(des) for d in x], 
+                      [d for x in des for d in x], (len(gos),len(gos)))
+        tree = D.dot(self.node).tocsr()
+        tree.data[:] = 1
+        self.tree = tree
+        self.n1 = N.asarray(self.node.sum(axis=1)).ravel()
+        self.t1 = N.asarray(self.tree.sum(axis=1)).ravel()
+
+    def index(self, sel_ids):
+        id2x = self.id2x
+        return N.array(sorted([id2x[s] for s in sel_ids if s in id2x]), dtype=int)
+
+
 class GOEnrichmentAnalysis(object):
 
     def __init__(self, population_ids, id2gos, go):
@@ -348,10 +504,12 @@ class GOEnrichmentAnalysis(object):
         self.id2gos = id2gos
         self.go = go
         self.parsed = {}
+        self.incidence = {}
         # parse GO
         for w in ['gob','gom','goc']:
             print("parsing %s... " % (w,))
-            self.parsed[w] = self._parseGO(w)
+            self.parsed[w] = s2g, g2s = self._parseGO(w)
+            self.incidence[w] = GOIncidence(s2g, g2s, go.descendants)
 
     def _parseGO(self, which):
         i2g = self.id2gos[which]
@@ -372,7 +530,7 @@ class GOEnrichmentAnalysis(object):
         go = self.go
         for g in g2s:
             #parents = parents.union(set(go.get_ancestors(g)))
-            parents = parents.union({g2x[x] for x in go.get_ancestors(ids[g])})
+            parents.update(int(x) for x in go.ancestors[g]) # precalculated ancestors
         for p in parents:
             if p not in g2s:
                 g2s[p] = []
@@ -384,61 +542,69 @@ class GOEnrichmentAnalysis(object):
         sel_ids = list(set(selected_ids))
         rslt = GOResult(sel_ids, which, self)
         ids = self.go.ids
-        s2g,g2s = self.parsed[which] # id->go, go->id
-        # first calculate g2s0 the map from GO term -> selected id
-        num = 0
-        tmp = {}
-        g2s0 = {}
-        for s in sel_ids:
-            if s in s2g:
-                num += 1
-                for g in s2g[s]:
-                    tmp.setdefault(g,[]).append(s)
-        for g in tmp:
-            g2s0[g] = list(set(tmp[g]))
-            rslt.g2i_node[ids[g]] = g2s0[g]
-        tot = len(s2g)
+        inc = self.incidence[which]
+        sidx = inc.index(sel_ids)
+        num = len(sidx)
+        tot = len(inc.ids)
         rslt.num = num # number of selected genes with GO associated (total drawn)
         rslt.tot = tot # total number of genes with GO associated  (total in urn)
         p = float(num)/float(tot) # average ratio of selected genes with GO
-        # now calculate node counts (has to do for all of the nodes to accomodate descendant counts)
-        sum = N.sum
-        #hyperg = statsext.hyperg_pdf  # legacy speedup
-        for g in g2s: 
-            n0 = len(g2s0.get(g,[])) # number of selected with specific GO node
-            des = self._descendants(g2s0, g) 
-            t0 = len(des) # number of selected with specific GO tree (white drawn)
-            if n0==0 and t0==0:
-                continue
-            idg = ids[g]
-            rslt.g2i_tree[idg] = des
-            if n0==0:
-                rslt.g2i_node[idg] = []
-            n1 = len(g2s[g]) # number of total with specific GO node
-            t1 = len(self._descendants(g2s, g)) # t1: number of total with specific GO tree (total white)
-            rslt.g2cnt[idg] = (n0,n1,t0,t1)
-            #n2 = tot-n1 # number of total not specific GO node 
-            rslt.g2p_node[idg] = sum(pmf(range(n0,num+1),tot,n1,num))
-            #t2 = tot-t1 # number of total not with specific GO tree (total black)
-            rslt.g2p_tree[idg] = sum(pmf(range(t0,num+1),tot,t1,num))
-            # dhyper(x,m,n,k)
-            # x: white drawn  = t0->num
-            # m: total white  = t1 
-            # n: total black  = t2
-            # k: number drawn = num
-            rslt.g2over[idg] = float(t0)/float(t1) > p
+        v = N.zeros(tot)
+        v[sidx] = 1
+        n0 = inc.node.dot(v).astype(int) # number of selected with specific GO node
+        t0 = inc.tree.dot(v).astype(int) # number of selected with specific GO tree (white drawn)
+        gidx = N.nonzero((n0>0)|(t0>0))[0]
+        n0, t0 = n0[gidx], t0[gidx]
+        n1, t1 = inc.n1[gidx], inc.t1[gidx] # total with specific GO node, tree (total white)
+        # dhyper(x,m,n,k)
+        # x: white drawn  = t0->num
+        # m: total white  = t1 
+        # n: total black  = t2
+        # k: number drawn = num
+        pnode = hypergeom.sf(n0-1, tot, n1, num)
+        ptree = hypergeom.sf(t0-1, tot, t1, num)
+        inode = members(inc.node, gidx, sidx, inc.ids)
+        itree = members(inc.tree, gidx, sidx, inc.ids)
+        for k, g in enumerate(gidx):
+            idg = ids[inc.gos[g]]
+            rslt.g2i_node[idg] = inode[k]
+            rslt.g2i_tree[idg] = itree[k]
+            rslt.g2cnt[idg] = (n0[k],n1[k],t0[k],t1[k])
+            rslt.g2p_node[idg] = pnode[k]
+            rslt.g2p_tree[idg] = ptree[k]
+            rslt.g2over[idg] = float(t0[k])/float(t1[k]) > p
         rslt.make_table()
         return rslt
 
+    def calculate_batch(self, S, ids, which, sets=None, method='BH'):
+        """Node and tree enrichment for many selected sets at once.
 
-    def _descendants(self, g2s, g):
-        des = self.go.descendants[g] # use precalculated descendants
-        count = {}
-        for g in des:
-            if g in g2s:
-                for s in g2s[g]:
-                    count[s] = 1
-        return count.keys()    
+        Args:
+            S: sets x ids boolean matrix (dense or scipy.sparse)
+            ids: ids corresponding to columns of S
+            which: gob,gom,goc
+            sets: names of the sets (default 0,1,...)
+            method: p_adjust method for q-values (per set)
+
+        Returns:
+            BatchResult (terms: GO ids) with arrays (sets x terms) cnt_node, cnt_tree,
+            p_node, p_tree, q_node, q_tree, odds (tree) and population counts 
+            tot_node, tot_tree (terms)
+        """
+        inc = self.incidence[which]
+        tot = len(inc.ids)
+        X = selection_matrix(S, ids, inc.id2x, tot)
+        num = N.asarray(X.sum(axis=1)).ravel()
+        n0, pnode, tmp = hypergeom_batch(X, inc.node, inc.n1, num, tot)
+        t0, ptree, odds = hypergeom_batch(X, inc.tree, inc.t1, num, tot)
+        qnode = adjust_rows(pnode, t0>0, method)
+        qtree = adjust_rows(ptree, t0>0, method)
+        if sets is None:
+            sets = list(range(X.shape[0]))
+        terms = [self.go.ids[g] for g in inc.gos]
+        return BatchResult(sets, terms, num, tot, cnt_node=n0, cnt_tree=t0, 
+                           tot_node=inc.n1, tot_tree=inc.t1, p_node=pnode, p_tree=ptree, 
+                           q_node=qnode, q_tree=qtree, odds=odds)
 
 
 class GOResult(object):
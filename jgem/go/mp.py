@@ -12,6 +12,8 @@ except:
 
 import pandas as PD
 
+from jgem.go.closure import descendants_closure, load_closures, node_levels
+
 
 
 class MP(object):
@@ -90,8 +92,9 @@ class MP(object):
             self.names = nlist
             self.terms = rlist
             self.defs = dlist
-            self.precalc_descendants()
+            # closures are cached separately (memory mapped), see load_closures
             dump(self.__dict__, open(pname,'wb'), 2)
+        self.descendants, self.ancestors = load_closures(obo, self.parents, self.children)
             
     def __getstate__(self):
         return self.obo
@@ -117,27 +120,18 @@ class MP(object):
         return [ids[x] for x in self.children[idx]]
     
     def get_ancestors(self, id):
-        tmp = set()
-        for x in self.get_parents(id):
-            tmp.add(x)
-            tmp = tmp.union(set(self.get_ancestors(x)))
-        return list(tmp)
+        ids = self.ids
+        return [ids[x] for x in self.ancestors[self.id2idx[id]]]
 
     def get_descendants(self, id):
-        tmp = {id}
-        for x in self.get_children(id):
-            tmp = tmp.union(set(self.get_descendants(x)))
-        return list(tmp)
+        ids = self.ids
+        return [ids[x] for x in self.descendants[self.id2idx[id]]]
     
     def _descendants(self, idx):
-        tmp = {idx}
-        children = self.children
-        for x in children[idx]:
-            tmp = tmp.union(set(self._descendants(x)))
-        return list(tmp)
+        return list(self.descendants[idx])
         
     def precalc_descendants(self):
-        self.descendants = [self._descendants(x) for x in range(len(self.ids))]
+        self.descendants = descendants_closure(self.parents, self.children)
                 
     def get_name(self, id):
         return self.names[self.id2idx[id]]
@@ -17,6 +17,8 @@ except:
 
 import pandas as PD
 
+from jgem.go.closure import descendants_closure, load_closures, node_levels
+
 # class Tree(object):
     
 #     def __init__(self,rootid=None,parents={}):
@@ -228,8 +230,9 @@ class GO(object):
             self.names = nlist
             self.terms = rlist
             self.defs = dlist
-            self.precalc_descendants()
+            # closures are cached separately (memory mapped), see load_closures
             dump(self.__dict__, open(pname,'wb'), 2)
+        self.descendants, self.ancestors = load_closures(obo, self.parents, self.children)
             
     def __getstate__(self):
         return self.obo
@@ -255,27 +258,18 @@ class GO(object):
         return [ids[x] for x in self.children[idx]]
     
     def get_ancestors(self, id):
-        tmp = set()
-        for x in self.get_parents(id):
-            tmp.add(x)
-            tmp = tmp.union(set(self.get_ancestors(x)))
-        return list(tmp)
+        ids = self.ids
+        return [ids[x] for x in self.ancestors[self.id2idx[id]]]
 
     def get_descendants(self, id):
-        tmp = {id}
-        for x in self.get_children(id):
-            tmp = tmp.union(set(self.get_descendants(x)))
-        return list(tmp)
+        ids = self.ids
+        return [ids[x] for x in self.descendants[self.id2idx[id]]]
     
     def _descendants(self, idx):
-        tmp = {idx}
-        children = self.children
-        for x in children[idx]:
-            tmp = tmp.union(set(self._descendants(x)))
-        return list(tmp)
+        return list(self.descendants[idx])
         
     def precalc_descendants(self):
-        self.descendants = [self._descendants(x) for x in range(len(self.ids))]
+        self.descendants = descendants_closure(self.parents, self.children)
                 
     def get_name(self, id):
         return self.names[self.id2idx[id]]
@@ -302,19 +296,9 @@ class GO(object):
         x2l = getattr(self, 'minlevels', None)
         if x2l:
             return x2l
-        x2c = self.children
         i2x = self.id2idx
-        x2l = [-1]*len(x2c) # minimum level
-        def _calc(node, level):
-            if x2l[node]>0: # if already visited through different parent(s)
-                minlevel = min(x2l[node], level) # choose smaller
-            else:
-                minlevel = level # first time
-            x2l[node] = minlevel
-            for x in x2c[node]:
-                _calc(x, minlevel+1)
-        for root in self.roots.values():
-            _calc(i2x[root], 0)
+        roots = [i2x[root] for root in self.roots.values()]
+        x2l = node_levels(self.parents, self.children, roots, min) # minimum level
         self.minlevels = x2l
         return x2l
         
@@ -322,19 +306,9 @@ class GO(object):
         x2l = getattr(self, 'maxlevels', None)
         if x2l:
             return x2l
-        x2c = self.children
         i2x = self.id2idx
-        x2l = [-1]*len(x2c) # maximum level
-        def _calc(node, level):
-            if x2l[node]>0: # if already visited through different parent(s)
-                maxlevel = max(x2l[node], level) # choose bigger
-            else:
-                maxlevel = level # first time
-            x2l[node] = maxlevel
-            for x in x2c[node]:
-                _calc(x, maxlevel+1)
-        for root in self.roots.values():
-            _calc(i2x[root], 0)
+        roots = [i2x[root] for root in self.roots.values()]
+        x2l = node_levels(self.parents, self.children, roots, max) # maximum level
         self.maxlevels = x2l
         return x2l
 
@@ -33,6 +33,139 @@ from jgem import utils as UT
 from jgem import bedtools as BT
 
 
+# Union-Find ##################################################################
+
+def union_find(n, a, b):
+    """Vectorized union-find (connected components) over integer edge arrays.
+    Roots are hooked to the smaller label and paths are compressed by pointer 
+    jumping until all edges are within a component. No recursion, no depth limit.
+
+    Args:
+        n (int): number of nodes (0,...,n-1)
+        a, b: integer arrays of edge end points (same length)
+
+    Returns:
+        integer array (length n) of component labels (smallest node in the component)
+    """
+    p = N.arange(n)
+    a = N.asarray(a, dtype=p.dtype)
+    b = N.asarray(b, dtype=p.dtype)
+    while len(a)>0:
+        pa, pb = p[a], p[b]
+        idx = pa!=pb
+        if not N.any(idx):
+            break
+        # only keep edges still crossing components
+        a, b, pa, pb = a[idx], b[idx], pa[idx], pb[idx]
+        m = N.minimum(pa, pb)
+        N.minimum.at(p, pa, m)
+        N.minimum.at(p, pb, m)
+        while True: # pointer jumping
+            pp = p[p]
+            if N.all(pp==p):
+                break
+            p = pp
+    return p
+
+def key_edges(lkeys, rkeys, loffset=0, roffset=0):
+    """Sort-join on keys. Connects each left item and each right item to a 
+    representative right item with the same key (star instead of all pairs).
+
+    Args:
+        lkeys: left keys (integer array)
+        rkeys: right keys (integer array)
+        loffset, roffset: node number offsets for left and right items
+
+    Returns:
+        (a, b) edge arrays
+    """
+    lkeys = N.asarray(lkeys)
+    rkeys = N.asarray(rkeys)
+    if len(rkeys)==0 or len(lkeys)==0:
+        return N.zeros(0,dtype=int), N.zeros(0,dtype=int)
+    order = N.argsort(rkeys, kind='mergesort')
+    sk = rkeys[order]
+    lpos = N.minimum(N.searchsorted(sk, lkeys), len(sk)-1)
+    lhit = N.nonzero(sk[lpos]==lkeys)[0]
+    rrep = order[N.searchsorted(sk, rkeys)] # representative for each right item
+    a = N.concatenate([lhit+loffset, N.arange(len(rkeys))+roffset])
+    b = N.concatenate([order[lpos[lhit]]+roffset, rrep+roffset])
+    return a, b
+
+def junction_edges(e_d, e_a, s_d, s_a):
+    """Make exon-junction edges by joining on donor and acceptor ids. 
+    Nodes 0,...,ne-1 are exons, ne,...,ne+ns-1 are junctions.
+    Only junctions with exons at both the donor and the acceptor side are used.
+
+    Args:
+        e_d, e_a: exon donor, acceptor ids
+        s_d, s_a: junction donor, acceptor ids
+
+    Returns:
+        (a, b) edge arrays
+    """
+    ne = len(e_d)
+    s_d = N.asarray(s_d)
+    s_a = N.asarray(s_a)
+    valid = N.nonzero(N.isin(s_d, e_d) & N.isin(s_a, e_a))[0]
+    a1, b1 = key_edges(e_d, s_d[valid], 0, ne)
+    a2, b2 = key_edges(e_a, s_a[valid], 0, ne)
+    # map back to original junction number
+    nodes = N.concatenate([N.arange(ne), valid+ne])
+    return nodes[N.concatenate([a1,a2])], nodes[N.concatenate([b1,b2])]
+
+def label_components(labels, ids):
+    """Group ids by component labels.
+
+    Args:
+        labels: component labels (from union_find) for each id
+        ids: node ids (e.g. exon _id)
+
+    Returns:
+        list of sets of ids, ordered by labels (i.e. first appearance)
+    """
+    labels = N.asarray(labels)
+    ids = N.asarray(ids)
+    if len(labels)==0:
+        return []
+    order = N.argsort(labels, kind='mergesort')
+    sl = labels[order]
+    bnd = N.nonzero(sl[1:]!=sl[:-1])[0]+1
+    return [set(x) for x in N.split(ids[order], bnd)]
+
+def ad_components(sj, me, extra=None):
+    """Connected components of exons connected by junctions (acceptor/donor ids).
+
+    Args:
+        sj: junction DataFrame (d_id, a_id)
+        me: exon DataFrame (_id, d_id, a_id)
+        extra: additional exon-exon edges as (_id array, _id array) 
+
+    Returns:
+        list of sets of exon _id in the order of first appearance in me
+    """
+    e_d = me['d_id'].values
+    e_a = me['a_id'].values
+    # -1: old null id
+    e_d = N.where(e_d==-1, N.iinfo(N.int64).min, e_d) 
+    e_a = N.where(e_a==-1, N.iinfo(N.int64).min, e_a) 
+    ne = len(me)
+    a, b = junction_edges(e_d, e_a, sj['d_id'].values, sj['a_id'].values)
+    eids = me['_id'].values
+    if extra is not None and len(extra[0])>0:
+        order = N.argsort(eids, kind='mergesort')
+        se = eids[order]
+        x = N.asarray(extra[0])
+        y = N.asarray(extra[1])
+        ix = N.minimum(N.searchsorted(se, x), ne-1)
+        iy = N.minimum(N.searchsorted(se, y), ne-1)
+        ok = (se[ix]==x)&(se[iy]==y)
+        a = N.concatenate([a, order[ix[ok]]])
+        b = N.concatenate([b, order[iy[ok]]])
+    labels = union_find(ne+len(sj), a, b)
+    return label_components(labels[:ne], eids)
+
+
 # Graph #######################################################################
 
 ## MEGraph version 2 (no strand: start/end based)
@@ -285,6 +418,14 @@ class MEGraph3(object):
                 visited.update(self._exx)
         return genes
 
+    def allcomponents_uf(self):
+        # union-find version, linear time no depth limit 
+        self.genes = genes = ad_components(self.sj, self.me, self._extra_edges())
+        return genes
+
+    def _extra_edges(self):
+        return None
+
     def allcomponents_nr(self): # ~44sec (sid1624)
         me = self.me
         self.visited =visited = set()
@@ -344,40 +485,60 @@ class MEGraph3(object):
             right = self.gd.get_group(did)
             return self.me.ix[set(right['e_id_d'].values)]
 
+def exon_overlaps(me, filepre):
+    """Exon self overlaps (bedtools intersect -wao).
+
+    Returns:
+        (all overlaps, same strand overlaps to other exons) DataFrames
+    """
+    a = filepre+'ex1.txt.gz'
+    b = filepre+'ex2.txt.gz'
+    c = filepre+'ov.txt.gz'
+    cols0 = ['chr','st','ed','strand','_id']
+    # single cell data contains float in st,ed in ex ??? 
+    me = UT.check_int_nan(me)
+    a = UT.write_pandas(me[cols0], a, '')
+    b = UT.write_pandas(me[cols0], b, '')
+    c = BT.bedtoolintersect(a,b,c,wao=True)
+    cols1 = cols0+['b_'+x for x in cols0]+['ovl']
+    ov = UT.read_pandas(c, names=cols1)
+    # select same strand overlap to non-self
+    ov1 = ov[(ov['_id']!=ov['b__id'])&(ov['strand']==ov['b_strand'])]
+    # cleanup
+    os.unlink(a)
+    os.unlink(b)
+    os.unlink(c)
+    return ov, ov1
+
+def ad_overlap_components(sj, me, filepre):
+    """Connected components of exons connected by junctions or same strand 
+    overlaps (MEGraph4.allcomponents_uf without the joined tables)."""
+    UT.set_info(sj, me)
+    ov, ov1 = exon_overlaps(me, filepre)
+    return ad_components(sj, me, (ov1['_id'].values, ov1['b__id'].values))
+
 ## MEGraph version 4 (stranded, overlap of exon also counts as connection)
 class MEGraph4(MEGraph3):
 
     def __init__(self, sj, me, filepre, depth=500, maxcnt=10000):
         MEGraph3.__init__(self, sj, me, depth, maxcnt)
         self.pre = filepre
-        a = filepre+'ex1.txt.gz'
-        b = filepre+'ex2.txt.gz'
-        c = filepre+'ov.txt.gz'
         # calculate exon overlap to self 
-        cols0 = ['chr','st','ed','strand','_id']
-        # single cell data contains float in st,ed in ex ??? 
-        me = UT.check_int_nan(me)
-        a = UT.write_pandas(me[cols0], a, '')
-        b = UT.write_pandas(me[cols0], b, '')
-        c = BT.bedtoolintersect(a,b,c,wao=True)
-        cols1 = cols0+['b_'+x for x in cols0]+['ovl']
-        self.ov = ov = UT.read_pandas(c, names=cols1)
-        # select same strand overlap to non-self
-        self.ov1 = ov1 = ov[(ov['_id']!=ov['b__id'])&(ov['strand']==ov['b_strand'])]
+        self.ov, self.ov1 = ov, ov1 = exon_overlaps(me, filepre)
         # make connected dictionary _id => [b__id's]
         tmp = ov1.groupby('_id')['b__id'].apply(lambda x: list(x)).reset_index()
         if 'index' in tmp.columns:
             tmp['_id'] = tmp['index']
         #LOG.debug('graph.MEGraph4.__init__: tmp.columns={0}, len(tmp)={1}'.format(tmp.columns, len(tmp))) 
         self.eoe = dict(UT.izipcols(tmp, ['_id','b__id']))
-        # cleanup
-        os.unlink(a)
-        os.unlink(b)
-        os.unlink(c)
 
     def ex_ex(self, eid):
         # return exons connected to eid
         return self.ex_d_ex(eid)+self.ex_a_ex(eid)+self.eoe.get(eid,[])
+
+    def _extra_edges(self):
+        # same strand overlaps
+        return (self.ov1['_id'].values, self.ov1['b__id'].values)
         
 def _worker2(s,e,c):
     mg = MEGraph2(s,e)
@@ -386,18 +547,18 @@ def _worker2(s,e,c):
     return genes
     
 def _worker3(s,e,c):
-    mg = MEGraph3(s,e)
-    #genes = mg.allcomponents()
-    genes = mg.allcomponents_nr()
+    # mg = MEGraph3(s,e)
+    # genes = mg.allcomponents_nr()
+    genes = ad_components(s,e) # union-find, no need for the joined tables
     #LOG.debug("finished {0}...".format(c))
     #cPickle.dump(genes, open('genes-{0}.pic'.format(c),'w'))
     return genes
 
 def _worker4(s,e,c,fp):
     fpc = fp+c+'.'
-    mg = MEGraph4(s,e,fpc)
-    #genes = mg.allcomponents()
-    genes = mg.allcomponents_nr()
+    # mg = MEGraph4(s,e,fpc)
+    # genes = mg.allcomponents_uf()
+    genes = ad_overlap_components(s,e,fpc) # union-find, no need for the joined tables
     #LOG.debug("finished {0}...".format(c))
     #cPickle.dump(genes, open('genes-{0}.pic'.format(c),'w'))
     return genes    
@@ -433,16 +594,23 @@ def mcore_allcomponents(sj, me, np=4, version=3, depth=500, maxcnt=10000, chroms
             if version==3:
                 s,e,c = d
                 LOG.debug('connected component: processing {0}...'.format(c))
-                mg = MEGraph3(s,e,depth=depth, maxcnt=maxcnt)
+                rslts.append(ad_components(s,e))
+                LOG.debug("finished {0}...".format(c))
+                continue
             elif version==4:
-                s,e,c,filepre = d
+                s,e,c,fp = d
                 LOG.debug('connected component: processing {0}...'.format(c))
-                mg = MEGraph4(s,e,filepre,depth=depth, maxcnt=maxcnt)
+                rslts.append(ad_overlap_components(s,e,fp+c+'.'))
+                LOG.debug("finished {0}...".format(c))
+                continue
             else:
                 s,e,c = d
                 LOG.debug('connected component: processing {0}...'.format(c))
                 mg = MEGraph2(s,e,depth=depth)
-            tmp = mg.allcomponents_nr()
+            if version==2:
+                tmp = mg.allcomponents_nr()
+            else:
+                tmp = mg.allcomponents_uf()
             rslts.append(tmp)
             LOG.debug("finished {0}...".format(c))
             #cPickle.dump(tmp, open('genes-{0}.pic'.format(c),'w'))
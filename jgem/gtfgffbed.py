@@ -11,12 +11,16 @@ import csv
 import subprocess
 import os
 import gzip
+import io
+import re
 import logging
+import multiprocessing
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
-from itertools import repeat, groupby
+from itertools import repeat
 
 import pandas as PD
+from pandas.api.types import union_categoricals
 import numpy as N
 
 from jgem import utils as UT
@@ -94,6 +98,17 @@ def get_gff_attr_col(gff, aname):
     "helper function for read_gff"
     return [dict([y.split('=') for y in line.split(';') if '=' in y]).get(aname,'') for line in gff['attr']]
 
+def gff_attr_pattern(anames):
+    """regex extracting values of GFF3 attributes anames (key=value;...) in one pass, 
+    one (optional lookahead) group per attribute"""
+    return '^'+''.join([r'(?=(?:[^;]*;)*?{0}=([^;]*))?'.format(re.escape(x)) for x in anames])
+
+def get_gff_attr_cols(gff, anames):
+    "helper function for read_gff, returns DataFrame of attributes ('' if missing)"
+    df = gff['attr'].astype(str).str.extract(gff_attr_pattern(anames), expand=True)
+    df.columns = anames
+    return df.fillna('')
+
 def read_gff(gffname, onlytypes=[], parseattrs=[]):
     """ Read in whole GFF, parse id & parent
 
@@ -114,8 +129,10 @@ def read_gff(gffname, onlytypes=[], parseattrs=[]):
     else:
         gff = PD.read_table(gffname, names=GFFCOLS, comment='#')
 
-    for c in ['ID','Parent']+parseattrs:
-        gff[c] = get_gff_attr_col(gff, c)
+    anames = ['ID','Parent']+[x for x in parseattrs if x not in ['ID','Parent']]
+    attrs = get_gff_attr_cols(gff, anames)
+    for c in anames:
+        gff[c] = attrs[c].values
 
     # set gid, tid, eid by default
     gff['gid'] = ''
@@ -123,25 +140,25 @@ def read_gff(gffname, onlytypes=[], parseattrs=[]):
     gff['eid'] = ''
     # genes
     gidx = gff['typ']=='gene'
-    gff.ix[gidx, 'gid'] = gff['ID']
+    gff.loc[gidx, 'gid'] = gff.loc[gidx, 'ID']
     # transcripts
     tidx = gff['typ']=='transcript'
-    gff.ix[tidx, 'gid'] = gff['Parent']
-    gff.ix[tidx, 'tid'] = gff['ID']
+    gff.loc[tidx, 'gid'] = gff.loc[tidx, 'Parent']
+    gff.loc[tidx, 'tid'] = gff.loc[tidx, 'ID']
     # exons
-    tid2gid = dict(gff[tidx][['tid','gid']].values)
+    tid2gid = gff[tidx].drop_duplicates('tid', keep='last').set_index('tid')['gid']
     eidx = gff['typ']=='exon'
-    gff.ix[eidx, 'tid'] = gff['Parent']
-    gff.ix[eidx, 'gid'] = [tid2gid[x] for x in gff[eidx]['tid'].values]
+    gff.loc[eidx, 'tid'] = gff.loc[eidx, 'Parent']
+    gff.loc[eidx, 'gid'] = gff.loc[eidx, 'tid'].map(tid2gid)
     if N.sum(gff[eidx]['ID']=='')==0: # ID already set
-        gff.ix[eidx, 'eid'] = gff['ID']
+        gff.loc[eidx, 'eid'] = gff.loc[eidx, 'ID']
     else: # sometimes exons don't have ID => create
         edf = gff[eidx]
-        en = edf.groupby('tid')['gid'].transform(lambda x: N.arange(1,len(x)+1))
+        en = edf.groupby('tid').cumcount()+1
         eids = edf['tid']+':'+ en.astype(str)
-        gff.ix[eidx, 'eid'] = eids
+        gff.loc[eidx, 'eid'] = eids
         attr = 'ID='+eids+';Parent='+edf['Parent']
-        gff.ix[eidx, 'attr'] = attr
+        gff.loc[eidx, 'attr'] = attr
 
     if onlytypes:
         gff = gff[gff['typ'].isin(onlytypes)]
@@ -160,8 +177,117 @@ def get_gtf_attr_col(gtf, aname):
         return ''
     return [_attr(line) for line in gtf['extra']]
 
-# ~35 sec to read Gencode.vM4
-def read_gtf(gtfname, onlytypes=[], parseattrs=DEFAULT_GTF_PARSE, rename={}):
+# categorical candidates (low cardinality string columns)
+GTF_CATCOLS = [u'chr',u'src',u'typ',u'strand',u'gene_type',u'transcript_type',
+               u'gene_biotype',u'transcript_biotype']
+GTF_CHUNKSIZE = 2**25 # bytes of decompressed GTF per chunk
+_GTF_DTYPE = {u'chr':str,u'src':str,u'typ':str,u'st':N.int64,u'ed':N.int64,
+              u'sc1':str,u'strand':str,u'sc2':str,u'extra':str}
+
+def gtf_chunks(gtfname, chunksize=GTF_CHUNKSIZE):
+    """Generator of byte chunks of (decompressed) GTF, each ending at a line boundary."""
+    fp = gzip.open(gtfname,'rb') if gtfname.endswith('.gz') else open(gtfname,'rb')
+    rest = b''
+    try:
+        while True:
+            buf = fp.read(chunksize)
+            if not buf:
+                break
+            buf = rest+buf
+            i = buf.rfind(b'\n')
+            if i<0:
+                rest = buf
+                continue
+            rest = buf[i+1:]
+            yield buf[:i+1]
+        if rest:
+            yield rest
+    finally:
+        fp.close()
+
+def gtf_attr_pattern(aname):
+    "regex extracting the value of attribute aname from column 9"
+    return r'(?:^|;)\s*{0}\s+"?([^";]*)'.format(re.escape(aname))
+
+def parse_gtf_chunk(data, parseattrs=DEFAULT_GTF_PARSE, onlytypes=[], categorical=False, comment='#'):
+    """Parse a chunk (bytes, whole lines) of GTF into a typed DataFrame.
+
+    Lines starting with comment are skipped, onlytypes are filtered before
+    attributes are extracted. Missing attributes are NaN.
+    """
+    if comment:
+        data = re.sub(b'(?m)^'+re.escape(comment.encode())+b'.*\n?', b'', data)
+    cols = GTFCOLS+list(parseattrs)
+    if len(data.strip())==0:
+        return UT.make_empty_df(cols)
+    df = PD.read_csv(io.BytesIO(data), sep='\t', names=GTFCOLS, header=None, dtype=_GTF_DTYPE,
+                     quoting=csv.QUOTE_NONE, na_filter=False)
+    if onlytypes:
+        df = df[df['typ'].isin(onlytypes)]
+    df = df.reset_index(drop=True)
+    for c in parseattrs:
+        df[c] = df['extra'].str.extract(gtf_attr_pattern(c), expand=False).replace('', N.nan)
+    if categorical:
+        for c in GTF_CATCOLS:
+            if c in df:
+                df[c] = df[c].astype('category')
+    return df
+
+def _concat_chunks(dfs):
+    "concatenate chunk DataFrames, merging categories of categorical columns"
+    dfs = [x for x in dfs if len(x)>0] or dfs[:1]
+    if len(dfs)==1:
+        return dfs[0]
+    cols = dfs[0].columns
+    data = {}
+    for c in cols:
+        if hasattr(dfs[0][c], 'cat'):
+            data[c] = union_categoricals([x[c] for x in dfs])
+        else:
+            data[c] = N.concatenate([x[c].values for x in dfs])
+    return PD.DataFrame(data, columns=cols)
+
+def _parse_gtf_chunk(args):
+    return parse_gtf_chunk(*args)
+
+# ~35 sec to read Gencode.vM4 with read_gtf_helper ==> chunked parse by pandas C reader
+def read_gtf(gtfname, onlytypes=[], parseattrs=DEFAULT_GTF_PARSE, rename={}, 
+             np=1, categorical=False, chunksize=GTF_CHUNKSIZE):
+    """ Read in whole GTF, parse gene_id, transcript_id from column 9
+
+    Args:
+        gtfname: path to GTF file
+        onlytypes: only keep these types. If [] or None, then keep all (default).
+        parseattrs: which column attributes to parse.
+        np: number of processes parsing chunks
+        categorical: make chr, src, typ, strand and type columns Categorical 
+          (default False, object columns)
+        chunksize: bytes of (decompressed) GTF per chunk
+
+    Returns:
+        Pandas DataFrame containing GTF data
+
+    """
+    chunks = gtf_chunks(gtfname, chunksize)
+    args = ((x, parseattrs, onlytypes, categorical) for x in chunks)
+    if np==1:
+        dfs = [_parse_gtf_chunk(a) for a in args]
+    else:
+        p = multiprocessing.Pool(np)
+        try:
+            dfs = list(p.imap(_parse_gtf_chunk, args))
+        finally:
+            p.close()
+            p.join()
+    if len(dfs)==0:
+        return UT.make_empty_df(GTFCOLS+list(parseattrs))
+    df = _concat_chunks(dfs)
+    if rename:
+        df.rename(columns=rename, inplace=True)    
+    return df
+
+# old version using cython helper
+def read_gtf2(gtfname, onlytypes=[], parseattrs=DEFAULT_GTF_PARSE, rename={}):
     """ Read in whole GTF, parse gene_id, transcript_id from column 9
 
     Args:
@@ -395,8 +521,8 @@ def gtf2gff(gtfname,gffname, memt=True):
                     onlytypes=['exon'], 
                     parseattrs=['gene_id','transcript_id','exon_number','gene_name'],
                     rename={'gene_id':'gid','transcript_id':'tid','gene_name':'gname','exon_number':'e#'})
-    if N.sum(eids['e#']=='')>0: # recalculate exon_number
-        eids['e#'] = eids.groupby('tid')['gid'].transform(lambda x: N.arange(1,len(x)+1))
+    if eids['e#'].isnull().any(): # recalculate exon_number
+        eids['e#'] = eids.groupby('tid').cumcount()+1
     else:
         eids['e#'] = eids['e#'].astype(int)
     eids['ID'] = eids['tid']+':'+eids['e#'].astype(str)
@@ -525,17 +651,88 @@ def bed2gtf(fpath, compress=True):
         subprocess.call(['gzip',fpath[:-3]])
     return bdpath
 
+# BED12 block codec  #################################################################
+
+def intlists(col):
+    """Parse comma separated integer lists (e.g. BED12 esizes, estarts; trailing 
+    comma optional) into flat int64 array and number of items per row.
+
+    Args:
+        col: sequence of strings
+
+    Returns:
+        (values, counts)
+    """
+    s = PD.Series(col, dtype=object).astype(str).str.rstrip(',')
+    if len(s)==0:
+        return N.zeros(0, dtype=N.int64), N.zeros(0, dtype=N.int64)
+    cnts = s.str.count(',').values.astype(N.int64)+1
+    vals = N.array(','.join(s).split(','), dtype=N.int64)
+    return vals, cnts
+
+def join_intlists(vals, cnts):
+    """Inverse of intlists: comma joined strings (with trailing comma) per row.
+    All counts should be positive."""
+    if len(cnts)==0:
+        return N.zeros(0, dtype=object)
+    s = N.char.add(N.asarray(vals).astype(str), ',').astype(object)
+    bnd = N.concatenate([[0], N.cumsum(cnts)[:-1]])
+    return N.add.reduceat(s, bnd)
+
+def bed12_blocks(bed):
+    """Flatten BED12 blocks.
+
+    Returns:
+        (row index, block st, block ed), flat arrays
+    """
+    siz, cnts = intlists(bed['esizes'])
+    sta, _ = intlists(bed['estarts'])
+    idx = N.repeat(N.arange(len(bed)), cnts)
+    st = bed['st'].values.astype(N.int64)[idx] + sta
+    return idx, st, st+siz
+
+def blocks_bed12(idx, st, ed):
+    """Collapse blocks (sorted by idx, then st) into BED12 fields.
+
+    Returns:
+        (idx, st, ed, #exons, esizes, estarts) one element per unique idx
+        (ed is the end of the last block)
+    """
+    idx, st, ed = N.asarray(idx), N.asarray(st, dtype=N.int64), N.asarray(ed, dtype=N.int64)
+    bnd = N.nonzero(N.concatenate([[True], idx[1:]!=idx[:-1]]))[0]
+    cnts = N.diff(N.concatenate([bnd, [len(idx)]]))
+    st0 = st[bnd]
+    ed0 = ed[bnd+cnts-1]
+    esizes = join_intlists(ed-st, cnts)
+    estarts = join_intlists(st-N.repeat(st0, cnts), cnts)
+    return idx[bnd], st0, ed0, cnts, esizes, estarts
+
+def pathcode_exons(pathcodes, strands):
+    """Flatten exons of pathcodes (st0,ed0|st1,ed1|...). For '-' strand (pathcode 
+    in descending order) exons are reversed so that blocks are in ascending order.
+
+    Returns:
+        (row index, exon st, exon ed), flat arrays
+    """
+    vals, cnts = intlists(PD.Series(pathcodes, dtype=object).str.replace('|', ',', regex=False))
+    n = cnts//2
+    idx = N.repeat(N.arange(len(n)), n)
+    sted = vals.reshape(-1,2)
+    neg = (N.asarray(strands)=='-')[idx]
+    pos = N.arange(len(idx))
+    gst = N.repeat(N.cumsum(n)-n, n)
+    o = N.where(neg, 2*gst+N.repeat(n,n)-1-pos, pos)
+    sted = sted[o]
+    st = N.where(neg, sted[:,1], sted[:,0])
+    ed = N.where(neg, sted[:,0], sted[:,1])
+    return idx, st, ed
+
 def bed12Tobed6(bed12):
-    def _gen():
-        for rec in bed12.values:
-            esizes = [int(x) for x in rec[-2].split(',') if x!='']
-            estarts = [int(x) for x in rec[-1].split(',') if x!='']
-            for y,z in zip(estarts, esizes):
-                st = rec[1]+y
-                ed = st+z
-                yield (rec[0],st,ed,rec[3],rec[4],rec[5])
-    bed6 = PD.DataFrame([x for x in _gen()], names=['chr','st','ed','name','sc1','strand'])
-    return bed6
+    idx, st, ed = bed12_blocks(bed12)
+    bed6 = bed12[['chr','name','sc1','strand']].iloc[idx].reset_index(drop=True)
+    bed6['st'] = st
+    bed6['ed'] = ed
+    return bed6[['chr','st','ed','name','sc1','strand']]
 
 def unionex2bed12(uex, gidx='_gidx', name='name', sc1='sc1', sc2='sc2'):
     """
@@ -554,20 +751,14 @@ def unionex2bed12(uex, gidx='_gidx', name='name', sc1='sc1', sc2='sc2'):
     if name not in cols0:
         uex[name] = uex[gidx]
     bed = uex[[gidx,'chr','st','ed',name,sc1,'strand',sc2]].sort_values([gidx,'chr','st','ed'])
-    def _gen():
-        for gid, exs in groupby(bed.values, lambda x: x[0]):
-            exs = list(exs)
-            nex = len(exs)
-            st0 = exs[0][2]
-            ed0 = exs[-1][3]
-            esiz = ','.join([str(x[3]-x[2]) for x in exs])+','
-            ests = ','.join([str(x[2]-st0) for x in exs])+','
-            x = exs[0]
-            yield (x[1],st0,ed0,x[4],x[5],x[6],st0,ed0,x[7],nex,esiz,ests)
-    #bcols=['chr','st','ed','name','sc1','strand','tst','ted','sc1','#exons','esizes','estarts']
-    bcols = BEDCOLS
-    df = PD.DataFrame([x for x in _gen()], columns=bcols).sort_values(['chr','st','ed'])
-    return df
+    gi = PD.factorize(bed[gidx].values)[0]
+    bnd, st0, ed0, nex, esiz, ests = blocks_bed12(gi, bed['st'].values, bed['ed'].values)
+    first = bed.iloc[N.searchsorted(gi, bnd)]
+    df = PD.DataFrame({'chr':first['chr'].values, 'st':st0, 'ed':ed0, 'name':first[name].values,
+                       'sc1':first[sc1].values, 'strand':first['strand'].values, 'tst':st0, 
+                       'ted':ed0, 'sc2':first[sc2].values, '#exons':nex, 'esizes':esiz, 
+                       'estarts':ests}, columns=BEDCOLS)
+    return df.sort_values(['chr','st','ed'])
 
 
 
@@ -591,7 +782,7 @@ def chop_chrs_gtf(gtfname, chrs, outdir=None):
     if all([UT.notstale(gtfname, x) for x in outnames]):
         # all files already exist and newer than gtfname
         return outnames
-    gtf = read_gtf(gtfname, parseattrs=[]) # don't parse attrs
+    gtf = read_gtf(gtfname, parseattrs=[], categorical=True) # don't parse attrs
     for c,fname in zip(chrs,outnames):
         LOG.debug( "writing %s to %s..." % (c, fname))
         sub = gtf[gtf['chr']==c]
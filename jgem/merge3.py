@@ -14,6 +14,11 @@ import gzip
 import os
 import time
 import shutil
+import json
+try:
+    import cPickle as pickle
+except:
+    import pickle
 from functools import reduce
 from operator import iadd, iand
 from collections import Counter
@@ -51,20 +56,24 @@ import jgem.cy.bw as cybw
 
 class PrepBWSJ(object):
     
-    def __init__(self, j2pres, genome, dstpre, libsizes=None, np=10):
+    def __init__(self, j2pres, genome, dstpre, libsizes=None, np=10, useshards=True, keepshards=False):
         self.j2pres = j2pres
         self.libsizes = libsizes # scale = 1e6/libsize
         self.genome = genome
         self.dstpre = dstpre
         self.np = np
+        self.useshards = useshards # read each sample once into per chrom shards
+        self.keepshards = keepshards
         
     def __call__(self):
         # exdf => ex.p, ex.n, ex.u
         # sjdf => sj.p, sj.n, sj.u
         # paths => sjpath.bed
         # divide into tasks (exdf,sjdf,paths) x chroms
-        self.server = server = TQ.Server(name='PrepBWSJ', np=self.np)
         self.chroms = chroms = UT.chroms(self.genome)
+        if self.useshards and not self.outputs_exist():
+            make_shards(self.j2pres, self.dstpre, chroms, self.np)
+        self.server = server = TQ.Server(name='PrepBWSJ', np=self.np)
         csizes = UT.df2dict(UT.chromdf(self.genome), 'chr', 'size')
         self.exstatus = exstatus = {}
         self.sjstatus = sjstatus = {}
@@ -152,14 +161,101 @@ class PrepBWSJ(object):
                     if exdone&sjdone&padone&sddone:
                         break
             print('Exit Loop')
+        if self.useshards and not self.keepshards:
+            remove_shards(self.dstpre, chroms)
         print('Done')
+
+    def outputs_exist(self):
+        sufs = ['.{0}.{1}.bw'.format(w,s) for w in ['ex','sj'] for s in ['p','n','u']]
+        sufs += ['.sjpath.bed.gz','.sjdf.txt.gz']
+        return all([os.path.exists(self.dstpre+x) for x in sufs])
+
+
+# per chromosome sample shards:
+# each sample's exdf, sedf, sjdf, paths are read once and split into chromosomes
+# then concatenated (gzip members, byte copy) into one file per chromosome 
+# with sample index (sid) as the last column, so that per chromosome tasks
+# only read their chromosome instead of every sample's genome wide files
+SHARDCOLS = {'exdf':A3.EXDFCOLS, 'sedf':A3.EXDFCOLS, 'sjdf':A3.SJDFCOLS, 'paths':A3.PATHCOLS}
+
+def shard_path(dstpre, kind, chrom, sid=None):
+    if sid is None:
+        return dstpre+'.shard.{0}.{1}.txt.gz'.format(kind, chrom)
+    return dstpre+'.shard.{0}.{1}.{2}.txt.gz'.format(kind, chrom, sid)
+
+def shard_sample(pre, sid, dstpre, chroms=None):
+    """Split one sample's exdf, sedf, sjdf, paths into per chromosome parts
+    (only chroms if given). Returns list of (kind, chrom, sid, path) written."""
+    files = []
+    for kind, cols in SHARDCOLS.items():
+        df = UT.read_pandas(pre+'.{0}.txt.gz'.format(kind), names=cols)
+        if chroms is not None:
+            df = df[df['chr'].isin(chroms)].copy()
+        df['sid'] = sid
+        for chrom, sub in df.groupby('chr'):
+            path = UT.write_pandas(sub, shard_path(dstpre, kind, chrom, sid), '')
+            files.append((kind, chrom, sid, path))
+    return files
+
+def make_shards(j2pres, dstpre, chroms, np=10):
+    """Make per chromosome shards (one file per chromosome per kind, all samples)."""
+    donepath = dstpre+'.shard.done'
+    if os.path.exists(donepath):
+        return
+    args = [(pre, i, dstpre, list(chroms)) for i, pre in enumerate(j2pres)]
+    rslts = UT.process_mp(shard_sample, args, np=np, doreduce=True)
+    # concatenate the parts actually written in sample order
+    parts = {}
+    for kind, chrom, sid, path in sorted(rslts, key=lambda x: x[2]):
+        parts.setdefault((kind, chrom), []).append(path)
+    for (kind, chrom), srcpaths in parts.items():
+        UT.concatenate_gz(srcpaths, shard_path(dstpre, kind, chrom), remove=True)
+    open(donepath,'w').write(UT.today())
+
+def remove_shards(dstpre, chroms):
+    for kind in SHARDCOLS:
+        for chrom in chroms:
+            path = shard_path(dstpre, kind, chrom)
+            if os.path.exists(path):
+                os.unlink(path)
+    if os.path.exists(dstpre+'.shard.done'):
+        os.unlink(dstpre+'.shard.done')
+
+def sample_chrom_dfs(j2pres, dstpre, kind, chrom):
+    """Yields (sample index, DataFrame of chrom) for each sample. 
+    Reads the chromosome shard if available, otherwise each sample's file."""
+    cols = SHARDCOLS[kind]
+    if os.path.exists(dstpre+'.shard.done'):
+        path = shard_path(dstpre, kind, chrom)
+        if not os.path.exists(path): # no data in this chrom
+            return
+        df = UT.read_pandas(path, names=cols+['sid'])
+        for sid, sub in df.groupby('sid', sort=True):
+            yield sid, sub
+        return
+    for sid, pre in enumerate(j2pres):
+        df = UT.read_pandas(pre+'.{0}.txt.gz'.format(kind), names=cols)
+        yield sid, df[df['chr']==chrom]
                         
 
 
+def _prep_wig_chr(intervals, chrom, csize, wigpath, n):
+    # intervals: list of (st,ed,val) arrays => sum => wiggle
+    if len(intervals)==0:
+        st,ed,val = [],[],[]
+    else:
+        st = N.concatenate([x[0] for x in intervals])
+        ed = N.minimum(N.concatenate([x[1] for x in intervals]), csize)
+        val = N.concatenate([x[2] for x in intervals])
+    rst, red, rval = BW.intervals2runs(st, ed, val)
+    if n>1:
+        rval = rval/float(n) # average
+    return BW.runs2wiggle_chr(rst, red, rval, chrom, wigpath, 'w')
+
 def prep_exwig_chr(j2pres, libsizes, dstpre, chrom, csize):
     ss = ['p','n','u']
     s2s = {'p':['+'],'n':['-'],'u':['.+','.-','.']}
-    a = {s:N.zeros(csize) for s in ss}
+    a = {s:[] for s in ss} # (st,ed,ecov*scale) for each sample
     wigpaths = {s:dstpre+'.ex.{0}.{1}.wig'.format(s,chrom) for s in ss}
     if all([os.path.exists(dstpre+'.ex.{0}.bw'.format(s)) for s in ss]):
         return wigpaths
@@ -173,29 +269,20 @@ def prep_exwig_chr(j2pres, libsizes, dstpre, chrom, csize):
     else:
         n = len(j2pres)
         scales = [1e6/float(x) for x in libsizes]
-    for pre,scale in zip(j2pres, scales):
-        exdf = UT.read_pandas(pre+'.exdf.txt.gz',names=A3.EXDFCOLS)
-        exdf = exdf[exdf['chr']==chrom]
-        for s in ss:
-            exsub = exdf[exdf['strand'].isin(s2s[s])]
-            for st,ed,ecov in exsub[['st','ed','ecov']].values:
-                a[s][st:ed] += ecov*scale
-        sedf = UT.read_pandas(pre+'.sedf.txt.gz',names=A3.EXDFCOLS)
-        sedf = sedf[sedf['chr']==chrom]
-        for s in ss:
-            sesub = sedf[sedf['strand'].isin(s2s[s])]
-            for st,ed,ecov in sesub[['st','ed','ecov']].values:
-                a[s][st:ed] += ecov*scale
+    for kind in ['exdf','sedf']:
+        for sid, exdf in sample_chrom_dfs(j2pres, dstpre, kind, chrom):
+            scale = scales[sid]
+            for s in ss:
+                exsub = exdf[exdf['strand'].isin(s2s[s])]
+                a[s].append((exsub['st'].values, exsub['ed'].values, exsub['ecov'].values*scale))
     for s in ['p','n','u']:
-        if libsizes is not None:
-            a[s] /= float(n) # average
-        cybw.array2wiggle_chr64(a[s], chrom,  wigpaths[s], 'w')
+        _prep_wig_chr(a[s], chrom, csize, wigpaths[s], n)
     return wigpaths  
 
 def prep_sjwig_chr(j2pres, libsizes, dstpre, chrom, csize):
     ss = ['p','n','u']
     s2s = {'p':['+'],'n':['-'],'u':['.+','.-']}
-    a = {s:N.zeros(csize) for s in ss}
+    a = {s:[] for s in ss} # (st,ed,tcnt*scale) for each sample
     wigpaths = {s:dstpre+'.sj.{0}.{1}.wig'.format(s,chrom) for s in ss}
     if all([os.path.exists(dstpre+'.sj.{0}.bw'.format(s)) for s in ss]):
         return wigpaths
@@ -209,17 +296,13 @@ def prep_sjwig_chr(j2pres, libsizes, dstpre, chrom, csize):
     else:
         n = len(j2pres)
         scales = [1e6/float(x) for x in libsizes]
-    for pre,scale in zip(j2pres, scales):
-        sjdf = UT.read_pandas(pre+'.sjdf.txt.gz',names=A3.SJDFCOLS)
-        sjdf = sjdf[sjdf['chr']==chrom]
+    for sid, sjdf in sample_chrom_dfs(j2pres, dstpre, 'sjdf', chrom):
+        scale = scales[sid]
         for s in ss:
             sjsub = sjdf[sjdf['strand'].isin(s2s[s])]
-            for st,ed,tcnt in sjsub[['st','ed','tcnt']].values:
-                a[s][st:ed] += tcnt*scale
+            a[s].append((sjsub['st'].values, sjsub['ed'].values, sjsub['tcnt'].values*scale))
     for s in ['p','n','u']:
-        if libsizes is not None:
-            a[s] /= float(n) # average
-        cybw.array2wiggle_chr64(a[s], chrom,  wigpaths[s], 'w')
+        _prep_wig_chr(a[s], chrom, csize, wigpaths[s], n)
     return wigpaths    
 
 def prep_sjpath_chr(j2pres, libsizes, dstpre, chrom):
@@ -247,9 +330,8 @@ def prep_sjpath_chr(j2pres, libsizes, dstpre, chrom):
     else:
         n = len(j2pres)
         scales = [1e6/float(x) for x in libsizes]
-    for pre,scale in zip(j2pres, scales):
-        paths = UT.read_pandas(pre+'.paths.txt.gz', names=A3.PATHCOLS)
-        paths = paths[paths['chr']==chrom]
+    for sid, paths in sample_chrom_dfs(j2pres, dstpre, 'paths', chrom):
+        scale = scales[sid]
         for st,ed,name,s,tst,ted,tcov in paths[cols].values:
             pc = ','.join(name.split(',')[1:-1]) # trim 53exons => intron chain
             if pc=='':
@@ -305,9 +387,8 @@ def prep_sjdf_chr(j2pres, libsizes, dstpre, chrom):
     else:
         n = len(j2pres)
         scales = [1e6/float(x) for x in libsizes]
-    for pre,scale in zip(j2pres, scales):
-        paths = UT.read_pandas(pre+'.sjdf.txt.gz', names=A3.SJDFCOLS)
-        paths = paths[paths['chr']==chrom]
+    for sid, paths in sample_chrom_dfs(j2pres, dstpre, 'sjdf', chrom):
+        scale = scales[sid]
         for st,ed,pc,s,st,ed,tcnt,ucnt in paths[cols].values:
             pc2st[pc] = st
             pc2ed[pc] = ed
@@ -359,13 +440,7 @@ def prep_sjpath(dstpre, chroms):
     dstpath = dstpre+'.sjpath.bed.gz'
     if os.path.exists(dstpath):
         return dstpath
-    files = []
-    with open(dstpath, 'wb') as dst:
-        for c in chroms:
-            srcpath = dstpre+'.sjpath.{0}.bed.gz'.format(c)
-            with open(srcpath,'rb') as src:
-                shutil.copyfileobj(src,dst)
-            files.append(srcpath)
+    files = UT.concatenate_gz([dstpre+'.sjpath.{0}.bed.gz'.format(c) for c in chroms], dstpath)
     # for f in files: # keep separate chr files 
     #     os.unlink(f)
     return dstpath
@@ -374,18 +449,222 @@ def prep_sjdf(dstpre, chroms):
     dstpath = dstpre+'.sjdf.txt.gz'
     if os.path.exists(dstpath):
         return dstpath
-    files = []
-    with open(dstpath, 'wb') as dst:
-        for c in chroms:
-            srcpath = dstpre+'.sjdf.{0}.txt.gz'.format(c)
-            with open(srcpath,'rb') as src:
-                shutil.copyfileobj(src,dst)
-            files.append(srcpath)
+    files = UT.concatenate_gz([dstpre+'.sjdf.{0}.txt.gz'.format(c) for c in chroms], dstpath)
     # for f in files: # keep separate chr files 
     #     os.unlink(f)
     return dstpath
 
 
+############# Incremental Merge ###############################################
+
+# Adding samples to an existing merge:
+# 1. IncrementalPrepBWSJ: aggregate only the new samples (PrepBWSJ) then combine
+#    with the existing merged coverage, sjpath and sjdf
+#    (weighted average if libsizes are given, sum otherwise)
+# 2. reuse_bundles: split the old assembly into per bundle outputs for the bundles
+#    whose merged junction evidence did not change (more than tol), so that
+#    A3.SampleAssembler (bundle_assembler skips existing outputs) re-assembles 
+#    only the changed bundles. Bundle boundaries of the old assembly are kept.
+# 3. CovCollector.append: add new sample columns to the binary (CovMatrix) matrices
+
+class IncrementalPrepBWSJ(object):
+
+    def __init__(self, oldpre, nold, j2pres, genome, dstpre, libsizes=None, np=10):
+        self.oldpre = oldpre # existing merged prefix
+        self.nold = nold # number of samples in the existing merge
+        self.j2pres = j2pres # new samples
+        self.genome = genome
+        self.dstpre = dstpre
+        self.libsizes = libsizes # of new samples
+        self.np = np
+
+    def __call__(self):
+        self.chroms = chroms = UT.chroms(self.genome)
+        csizes = UT.df2dict(UT.chromdf(self.genome), 'chr', 'size')
+        # new samples only
+        self.newpre = newpre = self.dstpre+'.inc'
+        PrepBWSJ(self.j2pres, self.genome, newpre, self.libsizes, self.np)()
+        nnew = len(self.j2pres)
+        if self.libsizes is None: # sum
+            wold, wnew = 1., 1.
+            cmax = 9
+        else: # average
+            wold = self.nold/float(self.nold+nnew)
+            wnew = nnew/float(self.nold+nnew)
+            cmax = 9+N.log2(N.mean([1e6/float(x) for x in self.libsizes]))
+        args = [(self.oldpre, newpre, self.dstpre, w, c, csizes[c], wold, wnew) for w in ['ex','sj'] for c in chroms]
+        UT.process_mp(update_wig_chr, args, np=self.np, doreduce=False)
+        for w in ['ex','sj']:
+            _prep_bw(self.dstpre, chroms, self.genome, w)
+        update_sjpath(self.oldpre, newpre, self.dstpre, chroms, wold, wnew, cmax)
+        update_sjdf(self.oldpre, newpre, self.dstpre, chroms, wold, wnew)
+        print('Done')
+
+def update_wig_chr(oldpre, newpre, dstpre, w, chrom, csize, wold, wnew):
+    wigpaths = {s:dstpre+'.{0}.{1}.{2}.wig'.format(w,s,chrom) for s in ['p','n','u']}
+    for s in ['p','n','u']:
+        intervals = []
+        for pre, wt in [(oldpre, wold), (newpre, wnew)]:
+            st, ed, val = BW.get_bigwig_intervals(pre+'.{0}.{1}.bw'.format(w,s), chrom, 0, csize)
+            intervals.append((st, ed, val*wt))
+        _prep_wig_chr(intervals, chrom, csize, wigpaths[s], 1)
+    return wigpaths
+
+def update_sjpath(oldpre, newpre, dstpre, chroms, wold, wnew, cmax=9):
+    dstpath = dstpre+'.sjpath.bed.gz'
+    if os.path.exists(dstpath):
+        return dstpath
+    cols = ['chr','st','ed','tst','ted','strand','tcov','pc']
+    dfs = []
+    for pre, wt in [(oldpre, wold), (newpre, wnew)]:
+        bed = GGB.read_bed(pre+'.sjpath.bed.gz')
+        bed['tcov'] = bed['sc1']*wt
+        bed['pc'] = [','.join(x.split(',')[1:-1]) for x in bed['name']]
+        dfs.append(bed[cols])
+    df = PD.concat(dfs, ignore_index=True)
+    df = df.groupby(['chr','pc']).agg({'st':'min','ed':'max','tst':'last','ted':'last',
+                                       'strand':'last','tcov':'sum'}).reset_index()
+    # keep the orientation of the intron chain in the input (descending for - strand),
+    # unstranded ones as .+/.- so that path2bed12 removes unstranded duplicates
+    v = [x.replace('|',',').split(',') for x in df['pc']]
+    desc = N.array([int(x[0])>int(x[-1]) for x in v], dtype=bool)
+    idxu = df['strand']=='.'
+    df.loc[idxu&desc, 'strand'] = '.-'
+    df.loc[idxu&~desc, 'strand'] = '.+'
+    df['name'] = ['{0},{1},{2}'.format(s,p,e) for s,p,e in df[['st','pc','ed']].values]
+    df.loc[desc,'name'] = ['{2},{1},{0}'.format(s,p,e) for s,p,e in df[desc][['st','pc','ed']].values]
+    # per chromosome (as in prep_sjpath_chr)
+    bed = PD.concat([A3.path2bed12(sub.copy(), cmax) for c, sub in df.groupby('chr')], 
+                    ignore_index=True)
+    bed['sc1'] = bed['tcov']
+    c2i = {c:i for i,c in enumerate(chroms)}
+    bed['cidx'] = bed['chr'].map(c2i)
+    bed = bed.sort_values(['cidx','st','ed'], kind='mergesort')
+    GGB.write_bed(bed, dstpath, ncols=12)
+    return dstpath
+
+def update_sjdf(oldpre, newpre, dstpre, chroms, wold, wnew):
+    dstpath = dstpre+'.sjdf.txt.gz'
+    if os.path.exists(dstpath):
+        return dstpath
+    dfs = []
+    for pre, wt in [(oldpre, wold), (newpre, wnew)]:
+        df = UT.read_pandas(pre+'.sjdf.txt.gz', names=A3.SJDFCOLS)
+        df['tcnt'] = df['tcnt']*wt
+        df['ucnt'] = df['ucnt']*wt
+        dfs.append(df)
+    df = PD.concat(dfs, ignore_index=True)
+    agg = {c:'last' for c in A3.SJDFCOLS if c not in ['chr','name']}
+    agg.update({'tcnt':'sum','ucnt':'sum'})
+    df = df.groupby(['chr','name']).agg(agg).reset_index()
+    c2i = {c:i for i,c in enumerate(chroms)}
+    df['cidx'] = df['chr'].map(c2i)
+    df = df.sort_values(['cidx','st','ed'], kind='mergesort')
+    UT.write_pandas(df[A3.SJDFCOLS], dstpath, '')
+    return dstpath
+
+def read_bundles(apre, chroms):
+    """Bundles [(chr,st,ed),...] used by the assembly (A3.find_bundles outputs)."""
+    fpath = apre+'.bundles.txt.gz'
+    if os.path.exists(fpath):
+        return [tuple(x) for x in UT.read_pandas(fpath)[['chr','st','ed']].values]
+    bundles = []
+    for chrom in chroms:
+        fpath = apre+'.{0}.bundles.txt.gz'.format(chrom)
+        if os.path.exists(fpath):
+            bundles += [tuple(x) for x in UT.read_pandas(fpath)[['chr','st','ed']].values]
+    return bundles
+
+def _bundle_index(bundles, chrs, sts):
+    """Index of the bundle containing (chr,st) (-1 if none)."""
+    bidx = N.full(len(sts), -1, dtype=int)
+    b = PD.DataFrame(bundles, columns=['chr','st','ed'])
+    b['i'] = N.arange(len(b))
+    chrs = N.asarray(chrs)
+    sts = N.asarray(sts)
+    for chrom, sub in b.sort_values(['chr','st']).groupby('chr'):
+        idx = N.nonzero(chrs==chrom)[0]
+        p = N.searchsorted(sub['st'].values, sts[idx], 'right')-1
+        ok = (p>=0)&(sts[idx]<sub['ed'].values[N.maximum(p,0)])
+        bidx[idx[ok]] = sub['i'].values[p[ok]]
+    return bidx
+
+def changed_bundles(oldbwpre, newbwpre, bundles, tol=0.1):
+    """Bundles whose merged junction evidence changed.
+
+    A bundle is changed if sum of absolute junction count (sjdf tcnt) or
+    junction path coverage (sjpath tcov) differences relative to the old 
+    total is larger than tol. New junctions contribute their whole count.
+
+    Returns:
+        list of changed bundles
+    """
+    changed = N.zeros(len(bundles), dtype=bool)
+    sj0 = UT.read_pandas(oldbwpre+'.sjdf.txt.gz', names=A3.SJDFCOLS)
+    sj1 = UT.read_pandas(newbwpre+'.sjdf.txt.gz', names=A3.SJDFCOLS)
+    p0 = GGB.read_bed(oldbwpre+'.sjpath.bed.gz')
+    p1 = GGB.read_bed(newbwpre+'.sjpath.bed.gz')
+    for d0, d1, fld in [(sj0, sj1, 'tcnt'), (p0, p1, 'sc1')]:
+        # names do not contain chromosome
+        m = PD.merge(d0[['chr','st','name',fld]], d1[['chr','st','name',fld]], 
+                     on=['chr','name'], how='outer', suffixes=['0','1'])
+        m['st'] = m['st1'].fillna(m['st0'])
+        v0 = m[fld+'0'].fillna(0).values
+        v1 = m[fld+'1'].fillna(0).values
+        bidx = _bundle_index(bundles, m['chr'].values, m['st'].values)
+        ok = bidx>=0
+        tot = N.bincount(bidx[ok], weights=v0[ok], minlength=len(bundles))
+        dif = N.bincount(bidx[ok], weights=N.abs(v1-v0)[ok], minlength=len(bundles))
+        changed |= dif > tol*tot
+    return [b for b, c in zip(bundles, changed) if c]
+
+ASMSUFS = ['exdf.txt.gz', 'sjdf.txt.gz', 'exdf2.txt.gz', 'sjdf2.txt.gz',
+           'paths.txt.gz', 'paths.bed.gz', 'tspans.bed.gz', 'unused.sjpath.bed.gz']
+
+def reuse_bundles(oldapre, newapre, oldbwpre, newbwpre, chroms, tol=0.1):
+    """Write per bundle assembly outputs of unchanged bundles from the old assembly.
+
+    Args:
+        oldapre: old assembly prefix
+        newapre: new assembly prefix (A3.SampleAssembler dstpre)
+        oldbwpre: old merged prefix (sjdf, sjpath)
+        newbwpre: new merged prefix (IncrementalPrepBWSJ dstpre)
+        chroms: chromosomes
+        tol: relative change of junction evidence (see changed_bundles)
+
+    Returns:
+        list of changed bundles (to be re-assembled)
+    """
+    bundles = read_bundles(oldapre, chroms)
+    changed = changed_bundles(oldbwpre, newbwpre, bundles, tol)
+    cset = set(changed)
+    # keep bundle boundaries
+    bdf = PD.DataFrame(bundles, columns=['chr','st','ed'])
+    for chrom, sub in bdf.groupby('chr'):
+        UT.write_pandas(sub, newapre+'.{0}.bundles.txt.gz'.format(chrom), 'h')
+    unchanged = [i for i, b in enumerate(bundles) if b not in cset]
+    for suf in ASMSUFS:
+        path = oldapre+'.'+suf
+        if not os.path.exists(path):
+            continue
+        try:
+            df = UT.read_pandas(path, header=None)
+        except PD.errors.EmptyDataError:
+            df = PD.DataFrame(columns=[0,1])
+        bidx = _bundle_index(bundles, df[0].values, df[1].values)
+        # sort rows by bundle once (stable: keeps the order within a bundle)
+        o = N.argsort(bidx, kind='mergesort')
+        sdf, sbidx = df.iloc[o], bidx[o]
+        bst = N.searchsorted(sbidx, unchanged, 'left')
+        bed = N.searchsorted(sbidx, unchanged, 'right')
+        for i, s, e in zip(unchanged, bst, bed):
+            chrom, st, ed = bundles[i]
+            dstpath = '{0}.{1}_{2}_{3}.{4}'.format(newapre, chrom, st, ed, suf)
+            UT.write_pandas(sdf.iloc[s:e], dstpath, '')
+    LOG.info('{0}/{1} bundles changed'.format(len(changed), len(bundles)))
+    return changed
+
+
 ############# SJ Filter #######################################################
 
 SJFILTERPARAMS = dict(
@@ -416,19 +695,11 @@ class SJFilter(object):
         
         rslts = UT.process_mp(filter_sjpath, args, np=self.np, doreduce=False)
         dstpath = self.bwsjpre+'.filtered.sjpath.bed.gz'
-        with open(dstpath,'wb') as dst:
-            for c in chroms:
-                srcpath =  self.bwsjpre+'.filtered.sjpath.{0}.bed.gz'.format(c)
-                with open(srcpath, 'rb') as src:
-                    shutil.copyfileobj(src, dst)
+        UT.concatenate_gz([self.bwsjpre+'.filtered.sjpath.{0}.bed.gz'.format(c) for c in chroms], dstpath)
 
         rslts = UT.process_mp(filter_sjdf, args, np=self.np, doreduce=False)
         dstpath = self.bwsjpre+'.filtered.sjdf.txt.gz'
-        with open(dstpath,'wb') as dst:
-            for c in chroms:
-                srcpath =  self.bwsjpre+'.filtered.sjdf.{0}.txt.gz'.format(c)
-                with open(srcpath, 'rb') as src:
-                    shutil.copyfileobj(src, dst)
+        UT.concatenate_gz([self.bwsjpre+'.filtered.sjdf.{0}.txt.gz'.format(c) for c in chroms], dstpath)
 
         # make sj.bw
         sjfiltered2bw(self.bwsjpre, self.genome, self.np)
@@ -588,49 +859,142 @@ def sjfiltered2bw(bwpre, genome, np=12):
 
 ############# Cov Estimator ######################################################
 
+# Model index: 
+# model paths, exons, junctions and the sample's sjpaths are read once per run,
+# split into chromosomes, sorted by start and pickled. Bundle tasks load only 
+# their chromosome (cached per worker process) and slice their window by 
+# binary search instead of re-reading and filtering genome wide text files.
+MINDEXKINDS = ['paths','sjpaths','sjdf','exdf','sedf']
+MINDEXCOLS = {'paths': GGB.BEDCOLS,
+              'sjpaths': GGB.BEDCOLS,
+              'sjdf': A3.SJDFCOLS+['tst','ted','sc1','sc2'],
+              'exdf': A3.EXDFCOLS,
+              'sedf': A3.EXDFCOLS}
+_MINDEXCACHE = {} # (path, mtime) => dataframes
+
+class ModelIndex(object):
+    
+    def __init__(self, modelpre, bwpre, idxpre):
+        self.modelpre = modelpre
+        self.bwpre = bwpre
+        self.idxpre = idxpre # index files prefix
+
+    def path(self, chrom):
+        return self.idxpre+'.mindex.{0}.pic'.format(chrom)
+
+    def done(self):
+        return os.path.exists(self.idxpre+'.mindex.done')
+
+    def build(self, chroms=None):
+        if self.done():
+            return self
+        _MINDEXCACHE.clear()
+        modelpre, bwpre = self.modelpre, self.bwpre
+        dfs = {}
+        dfs['paths'] = GGB.read_bed(modelpre+'.paths.withse.bed.gz')
+        sjdf = UT.read_pandas(modelpre+'.sjdf.txt.gz', names=A3.SJDFCOLS)
+        sjdf['tst'] = sjdf['st'] # for sjpath compatibility
+        sjdf['ted'] = sjdf['ed']
+        sjdf['sc1'] = sjdf['ucnt']
+        sjdf['sc2'] = sjdf['tcnt']
+        dfs['sjdf'] = sjdf
+        dfs['exdf'] = UT.read_pandas(modelpre+'.exdf.txt.gz', names=A3.EXDFCOLS)
+        if os.path.exists(modelpre+'.sedf.txt.gz'):
+            dfs['sedf'] = UT.read_pandas(modelpre+'.sedf.txt.gz', names=A3.EXDFCOLS)
+        if chroms is None:
+            chroms = dfs['paths']['chr'].unique()
+        tgt3 = bwpre+'.sjpath.bed.gz'
+        sj3 = None
+        for chrom in chroms:
+            tgt1 = bwpre+'.filtered.{0}.bed.gz'.format(chrom)
+            tgt2 = bwpre+'.{0}.bed.gz'.format(chrom)
+            if os.path.exists(tgt1):
+                sj = GGB.read_bed(tgt1)
+            elif os.path.exists(tgt2):
+                sj = GGB.read_bed(tgt2)
+            else:
+                if sj3 is None:
+                    sj3 = GGB.read_bed(tgt3)
+                sj = sj3
+            cdfs = {'sjpaths': self._sort(sj[sj['chr']==chrom], 'tst')}
+            for k, df in dfs.items():
+                stfld = 'tst' if k=='paths' else 'st'
+                cdfs[k] = self._sort(df[df['chr']==chrom], stfld)
+            with open(self.path(chrom), 'wb') as fp:
+                pickle.dump(cdfs, fp, pickle.HIGHEST_PROTOCOL)
+        open(self.idxpre+'.mindex.done','w').write(UT.today())
+        return self
+
+    def _sort(self, df, stfld):
+        # stable sort by start, index (file order) is kept
+        df = df.iloc[N.argsort(df[stfld].values, kind='mergesort')]
+        return (stfld, df)
+
+    def load(self, chrom):
+        path = self.path(chrom)
+        # rebuilt index (same path) has a different mtime
+        key = (path, os.path.getmtime(path) if os.path.exists(path) else None)
+        if key not in _MINDEXCACHE:
+            _MINDEXCACHE.clear() # only keep one chromosome per process
+            if os.path.exists(path):
+                with open(path, 'rb') as fp:
+                    _MINDEXCACHE[key] = pickle.load(fp)
+            else:
+                _MINDEXCACHE[key] = {}
+        return _MINDEXCACHE[key]
+
+    def get(self, kind, chrom, st, ed):
+        """Records of kind within [st,ed) in file order (empty if none)."""
+        cdfs = self.load(chrom)
+        if kind not in cdfs:
+            return PD.DataFrame(columns=MINDEXCOLS[kind])
+        stfld, df = cdfs[kind]
+        edfld = 'ted' if stfld=='tst' else 'ed'
+        sts = df[stfld].values
+        i0 = N.searchsorted(sts, st, 'left')
+        i1 = N.searchsorted(sts, ed, 'right')
+        sub = df.iloc[i0:i1]
+        return sub[sub[edfld]<=ed].sort_index()
+
+    def remove(self, chroms):
+        _MINDEXCACHE.clear()
+        for chrom in chroms:
+            if os.path.exists(self.path(chrom)):
+                os.unlink(self.path(chrom))
+        if self.done():
+            os.unlink(self.idxpre+'.mindex.done')
+
+
 class LocalEstimator(A3.LocalAssembler):
 
-    def __init__(self, modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom=False):
+    def __init__(self, modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom=False, mindex=None):
         self.modelpre = modelpre
         self.tcovth = tcovth
         self.usegeom = usegeom
         A3.LocalAssembler.__init__(self, bwpre, chrom, st, ed, dstpre)
-        bed12 = GGB.read_bed(modelpre+'.paths.withse.bed.gz')
-        assert(all(bed12['tst']<bed12['ted']))
-        idx = (bed12['chr']==chrom)&(bed12['tst']>=st)&(bed12['ted']<=ed)
-        self.paths = bed12[idx].copy()
+        if mindex is None:
+            self._read_model(modelpre, bwpre, chrom, st, ed)
+        else:
+            self.paths = mindex.get('paths', chrom, st, ed).copy()
+            self.sjpaths0 = mindex.get('sjpaths', chrom, st, ed).copy()
+            self._sjdf = mindex.get('sjdf', chrom, st, ed)
+            self._exdf = mindex.get('exdf', chrom, st, ed)
+            self._sedf = mindex.get('sedf', chrom, st, ed)
+        assert(all(self.paths['tst']<self.paths['ted']))
         eids = set()
         sids = set()
         for n in self.paths['name']:
             eids.update(n.split('|'))
             sids.update(n.split(',')[1:-1])
-        tgt1 = bwpre+'.filtered.{0}.bed.gz'.format(chrom)
-        tgt2 = bwpre+'.{0}.bed.gz'.format(chrom)
-        tgt3 = bwpre+'.sjpath.bed.gz'
-        if os.path.exists(tgt1):
-            sj = GGB.read_bed(tgt1)
-        elif os.path.exists(tgt2):
-            sj = GGB.read_bed(tgt2)
-        else:
-            sj = GGB.read_bed(tgt3)
-        idx0 = (sj['chr']==chrom)&(sj['tst']>=st)&(sj['ted']<=ed)        
-        self.sjpaths0 = sj[idx0].copy()        
         # load exdf, sjdf
-        sjdf = UT.read_pandas(modelpre+'.sjdf.txt.gz', names=A3.SJDFCOLS)
-        sjdf['tst'] = sjdf['st'] # for sjpath compatibility
-        sjdf['ted'] = sjdf['ed']
-        sjdf['sc1'] = sjdf['ucnt']
-        sjdf['sc2'] = sjdf['tcnt']
-        sjdf = sjdf[(sjdf['chr']==chrom)&(sjdf['st']>=st)&(sjdf['ed']<=ed)]
+        sjdf = self._sjdf
         sjdf = sjdf[sjdf['name'].isin(sids)]
         self.sjdf = sjdf.groupby(['chr','st','ed','strand']).first().reset_index()
 
-        exdf = UT.read_pandas(modelpre+'.exdf.txt.gz', names=A3.EXDFCOLS)
-        exdf = exdf[(exdf['chr']==chrom)&(exdf['st']>=st)&(exdf['ed']<=ed)]
+        exdf = self._exdf
         exdf = exdf[exdf['name'].isin(eids)]
-        if os.path.exists(modelpre+'.sedf.txt.gz'):
-            sedf = UT.read_pandas(modelpre+'.sedf.txt.gz', names=A3.EXDFCOLS)
-            sedf = sedf[(sedf['chr']==chrom)&(sedf['st']>=st)&(sedf['ed']<=ed)]
+        if len(self._sedf)>0: # SE models
+            sedf = self._sedf
             sedf = sedf[sedf['name'].isin(eids)]
             exdf = PD.concat([exdf,sedf],ignore_index=True)
         self.exdf = exdf.groupby(['chr','st','ed','strand','kind']).first().reset_index()
@@ -649,6 +1013,35 @@ class LocalEstimator(A3.LocalAssembler):
             self.filled[s] = A3.fill_gap(sja, sj, ex, s, self.st)
         # fix_i53completematch(self.exdf, self.paths) # extend 5'3' exons completely matched internal exons
 
+    def _read_model(self, modelpre, bwpre, chrom, st, ed):
+        # read from files (without ModelIndex)
+        bed12 = GGB.read_bed(modelpre+'.paths.withse.bed.gz')
+        idx = (bed12['chr']==chrom)&(bed12['tst']>=st)&(bed12['ted']<=ed)
+        self.paths = bed12[idx].copy()
+        tgt1 = bwpre+'.filtered.{0}.bed.gz'.format(chrom)
+        tgt2 = bwpre+'.{0}.bed.gz'.format(chrom)
+        tgt3 = bwpre+'.sjpath.bed.gz'
+        if os.path.exists(tgt1):
+            sj = GGB.read_bed(tgt1)
+        elif os.path.exists(tgt2):
+            sj = GGB.read_bed(tgt2)
+        else:
+            sj = GGB.read_bed(tgt3)
+        idx0 = (sj['chr']==chrom)&(sj['tst']>=st)&(sj['ted']<=ed)        
+        self.sjpaths0 = sj[idx0].copy()        
+        sjdf = UT.read_pandas(modelpre+'.sjdf.txt.gz', names=A3.SJDFCOLS)
+        sjdf['tst'] = sjdf['st'] # for sjpath compatibility
+        sjdf['ted'] = sjdf['ed']
+        sjdf['sc1'] = sjdf['ucnt']
+        sjdf['sc2'] = sjdf['tcnt']
+        self._sjdf = sjdf[(sjdf['chr']==chrom)&(sjdf['st']>=st)&(sjdf['ed']<=ed)]
+        exdf = UT.read_pandas(modelpre+'.exdf.txt.gz', names=A3.EXDFCOLS)
+        self._exdf = exdf[(exdf['chr']==chrom)&(exdf['st']>=st)&(exdf['ed']<=ed)]
+        self._sedf = PD.DataFrame(columns=A3.EXDFCOLS) # same as ModelIndex (no SE)
+        if os.path.exists(modelpre+'.sedf.txt.gz'):
+            sedf = UT.read_pandas(modelpre+'.sedf.txt.gz', names=A3.EXDFCOLS)
+            self._sedf = sedf[(sedf['chr']==chrom)&(sedf['st']>=st)&(sedf['ed']<=ed)]
+
 
     def process(self):
         self.calculate_ecovs()
@@ -892,7 +1285,7 @@ class LocalEstimator(A3.LocalAssembler):
         self.bed12 = A3.path2bed12(tgt, cmax=9, covfld='tcov')
         GGB.write_bed(self.bed12, pre+'.covs.paths.bed.gz',ncols=12)
 
-def bundle_estimator(modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom):
+def bundle_estimator(modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom, mindexpre=None):
     bname = A3.bundle2bname((chrom,st,ed))
     bsuf = '.{0}_{1}_{2}'.format(chrom,st,ed)
     csuf = '.{0}'.format(chrom)
@@ -910,7 +1303,10 @@ def bundle_estimator(modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom):
         LOG.info('bunle {0} already done, skipping'.format(bname))
         return bname
     LOG.info('processing bunle {0}'.format(bname))
-    la = LocalEstimator(modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom)
+    mindex = None
+    if mindexpre is not None:
+        mindex = ModelIndex(modelpre, bwpre, mindexpre)
+    la = LocalEstimator(modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom, mindex)
     return la.process()    
 
 def concatenate_bundles(bundles, dstpre):
@@ -924,13 +1320,8 @@ def concatenate_bundles(bundles, dstpre):
     for suf in sufs:
         dstpath = '{0}.{1}'.format(dstpre, suf)
         if not os.path.exists(dstpath):
-            with open(dstpath, 'wb') as dst:
-                for chrom, st, ed in bundles:
-                    bname = A3.bundle2bname((chrom,st,ed))
-                    srcpath = '{0}.{1}_{2}_{3}.{4}'.format(dstpre, chrom, st, ed, suf)
-                    files.append(srcpath)
-                    with open(srcpath, 'rb') as src:
-                        shutil.copyfileobj(src, dst)
+            srcpaths = ['{0}.{1}_{2}_{3}.{4}'.format(dstpre, chrom, st, ed, suf) for chrom,st,ed in bundles]
+            files += UT.concatenate_gz(srcpaths, dstpath)
         else:
             files+=['{0}.{1}_{2}_{3}.{4}'.format(dstpre, chrom, st, ed, suf) for chrom,st,ed in bundles]
     # cleanup
@@ -956,12 +1347,14 @@ def estimatecovs(modelpre, bwpre, dstpre, genome, tcovth=1, usegeom=True, np=6):
             edi = min(1000*(i+1), len(uc)-1)
             st = max(uc.iloc[sti]['st'] - 100, 0)
             ed = min(uc.iloc[edi]['ed'] + 100, csizedic[chrom])
-            args.append([modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom])
+            args.append([modelpre, bwpre, chrom, st, ed, dstpre, tcovth, usegeom, dstpre])
             bundles.append((chrom,st,ed))
 
+    mindex = ModelIndex(modelpre, bwpre, dstpre).build(chroms)
     rslts = UT.process_mp(bundle_estimator, args, np=np, doreduce=False)
 
     concatenate_bundles(bundles, dstpre)
+    mindex.remove(chroms)
 
 
 class CovEstimator(object):
@@ -983,6 +1376,8 @@ class CovEstimator(object):
         csizedic = UT.df2dict(UT.chromdf(self.genome), 'chr', 'size')
         self.bundlestatus = bundlestatus = {}
         self.bundles = bundles = []
+        print('making model index')
+        self.mindex = mindex = ModelIndex(self.modelpre, self.bwpre, self.dstpre).build(chroms)
 
         with server:
             print('starting task server')
@@ -1001,7 +1396,7 @@ class CovEstimator(object):
                     edi = min(1000*(i+1), len(uc)-1)
                     st = max(uc.iloc[sti]['st'] - 100, 0)
                     ed = min(uc.iloc[edi]['ed'] + 100, csizedic[chrom])
-                    args = [self.modelpre, self.bwpre, chrom, st, ed, self.dstpre, self.tcovth, self.usegeom]
+                    args = [self.modelpre, self.bwpre, chrom, st, ed, self.dstpre, self.tcovth, self.usegeom, self.dstpre]
                     tname = 'bundle_estimator.{0}'.format(subid)
                     subid += 1
                     task = TQ.Task(tname, bundle_estimator, args)
@@ -1027,6 +1422,7 @@ class CovEstimator(object):
                         print('$$$$$$$$ concatenate_bundles done $$$$$$$$$$$')
                         break
             print('Exit Loop')
+        mindex.remove(chroms)
         print('Done')
 
 
@@ -1034,13 +1430,52 @@ class CovEstimator(object):
 
 class CovCollector(object):
     
-    def __init__(self, covpres, dstpre, np=7):
+    def __init__(self, covpres, dstpre, np=7, binary=False, totxt=True):
         self.covpres = covpres
         self.modelpre = covpres[0]
         self.dstpre = dstpre
         self.np = np
+        self.binary = binary # use CovMatrix (memmap) backend
+        self.totxt = totxt # (binary) also write text tables as the text backend
         
     def run(self):
+        if self.binary:
+            return self.run_binary()
+        return self.run_text()
+
+    def run_binary(self):
+        self.chroms = chroms = {}
+        for which in COVKINDS:
+            cm = CovMatrix(self.dstpre, which)
+            if not cm.exists():
+                cm.create(self.modelpre, self.covpres)
+            chroms[which] = cm.chroms()
+        # each sample writes its own column(s) in place
+        args = [(self.dstpre, which, pre, i) for which in COVKINDS for i, pre in enumerate(self.covpres)]
+        UT.process_mp(collect_cov_column, args, np=self.np, doreduce=False)
+        if self.totxt:
+            args = [(self.dstpre, which, c) for which in COVKINDS for c in chroms[which]]
+            UT.process_mp(covmatrix2txt, args, np=self.np, doreduce=False)
+        print('Done')
+
+    def append(self, covpres):
+        """Add new samples to existing binary matrices (model unchanged)."""
+        for which in COVKINDS:
+            CovMatrix(self.dstpre, which).add_samples(covpres, np=self.np)
+        self.covpres = self.covpres + [x for x in covpres if x not in self.covpres]
+        if self.totxt:
+            args = []
+            for which in COVKINDS:
+                cm = CovMatrix(self.dstpre, which)
+                for c in cm.chroms():
+                    path = self.dstpre+'.{1}.{0}.txt.gz'.format(c, cm.fsuf)
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    args.append((self.dstpre, which, c))
+            UT.process_mp(covmatrix2txt, args, np=self.np, doreduce=False)
+        print('Done')
+
+    def run_text(self):
         self.server = server = TQ.Server(np=self.np)
         self.exdf = ex = UT.read_pandas(self.modelpre+'.covs.exdf.txt.gz', names=A3.EXDFCOLS)
         self.chroms = chroms = ex['chr'].unique()
@@ -1122,6 +1557,158 @@ class CovCollector(object):
                     
                 
         
+# binary sample x feature matrix:
+# for each kind (ex,sj,pa) and chromosome a float32 numpy.memmap (features x columns)
+# in column major order, so that each sample task writes its columns in place 
+# and readers can slice rows or columns without parsing text 
+COVKINDS = {'ex': ('exdf', ['ecov'], 'ecovs', A3.EXDFCOLS),
+            'sj': ('sjdf', ['tcnt'], 'tcnts', A3.SJDFCOLS),
+            'pa': ('paths', ['tcov0','tcov'], 'tcovs', A3.PATHCOLS)}
+
+def _read_covs(pre, which):
+    suf, flds, fsuf, cols = COVKINDS[which]
+    df = UT.read_pandas(pre+'.covs.{0}.txt.gz'.format(suf), names=cols)
+    return df.sort_values(['chr','st','ed','strand'], kind='mergesort')
+
+class CovMatrix(object):
+    
+    def __init__(self, dstpre, which):
+        self.dstpre = dstpre
+        self.which = which
+        self.suf, self.flds, self.fsuf, self.cols = COVKINDS[which]
+        self._meta = None
+
+    def path(self, chrom, ext):
+        return self.dstpre+'.{0}.{1}.{2}'.format(self.fsuf, chrom, ext)
+
+    def metapath(self):
+        return self.dstpre+'.{0}.meta.json'.format(self.fsuf)
+
+    def exists(self):
+        return os.path.exists(self.metapath())
+
+    def create(self, modelpre, covpres):
+        """Allocate matrices and write row (feature) tables from the model."""
+        ex0 = _read_covs(modelpre, self.which)
+        names = []
+        for pre in covpres:
+            name = pre.split('/')[-1]
+            names += ['{0}.{1}'.format(name, f) for f in self.flds]
+        meta = {'cols':names, 'chroms':{}, 'samples':list(covpres)}
+        for chrom, sub in ex0.groupby('chr', sort=False):
+            UT.write_pandas(sub[self.cols], self.path(chrom, 'rows.txt.gz'), 'h')
+            mm = N.memmap(self.path(chrom, 'f32'), dtype=N.float32, mode='w+', 
+                          shape=(len(sub), len(names)), order='F')
+            del mm # flush
+            meta['chroms'][chrom] = len(sub)
+        UT.save_json(meta, self.metapath())
+        self._meta = meta
+        return self
+
+    def meta(self):
+        if self._meta is None:
+            with open(self.metapath()) as fp:
+                self._meta = json.load(fp)
+        return self._meta
+
+    def chroms(self):
+        return list(self.meta()['chroms'].keys())
+
+    def colnames(self):
+        return self.meta()['cols']
+
+    def open(self, chrom, mode='r'):
+        # number of columns from the file size (includes columns being added, see add_samples)
+        nrows = self.meta()['chroms'][chrom]
+        path = self.path(chrom, 'f32')
+        ncols = os.path.getsize(path)//(max(nrows,1)*N.dtype(N.float32).itemsize)
+        return N.memmap(path, dtype=N.float32, mode=mode, shape=(nrows, ncols), order='F')
+
+    def rows(self, chrom):
+        return UT.read_pandas(self.path(chrom, 'rows.txt.gz'))
+
+    def add_samples(self, covpres, np=1):
+        """Append and fill columns for new samples (model rows have to be the same).
+
+        Samples already in the matrix are skipped. Meta data is written after the
+        columns are filled, so an interrupted call can be repeated.
+
+        Returns:
+            sample indices of the new samples 
+        """
+        meta = self.meta()
+        new = []
+        for pre in covpres:
+            if (pre not in meta['samples']) and (pre not in new):
+                new.append(pre)
+        sid0 = len(meta['samples'])
+        sids = list(range(sid0, sid0+len(new)))
+        if len(new)==0:
+            return sids
+        cols = list(meta['cols'])
+        for pre in new:
+            name = pre.split('/')[-1]
+            cols += ['{0}.{1}'.format(name, f) for f in self.flds]
+        # column major: new columns are appended at the end of the file
+        for chrom, nrows in meta['chroms'].items():
+            with open(self.path(chrom, 'f32'), 'r+b') as fp:
+                fp.truncate(nrows*len(cols)*N.dtype(N.float32).itemsize)
+        args = [(self.dstpre, self.which, pre, i) for pre, i in zip(new, sids)]
+        UT.process_mp(collect_cov_column, args, np=np, doreduce=False)
+        meta['cols'] = cols
+        meta['samples'] += new
+        UT.save_json(meta, self.metapath())
+        return sids
+
+    def write_sample(self, covpre, sid):
+        """Write sample sid (index in covpres) columns."""
+        nf = len(self.flds)
+        ex1 = _read_covs(covpre, self.which)
+        for chrom, sub in ex1.groupby('chr', sort=False):
+            if chrom not in self.meta()['chroms']:
+                continue
+            mm = self.open(chrom, 'r+')
+            if len(sub)!=mm.shape[0]:
+                raise ValueError('{0}: #rows {1} does not match the model ({2})'.format(covpre, len(sub), mm.shape[0]))
+            for j, f in enumerate(self.flds):
+                mm[:, sid*nf+j] = sub[f].values
+            mm.flush()
+            del mm
+        return sid
+
+    def get(self, chrom, rows=None, cols=None):
+        """Returns DataFrame (features x sample columns).
+
+        Args:
+            chrom: chromosome
+            rows: row (feature) positions or slice (default all)
+            cols: column names (default all)
+        """
+        mm = self.open(chrom)
+        names = self.colnames()
+        if cols is None:
+            cidx = N.arange(len(names))
+        else:
+            n2i = dict(zip(names, range(len(names))))
+            cidx = N.array([n2i[x] for x in cols])
+        if rows is None:
+            rows = slice(None)
+        return PD.DataFrame(N.array(mm[rows][:, cidx]), columns=[names[i] for i in cidx])
+
+def collect_cov_column(dstpre, which, covpre, sid):
+    return CovMatrix(dstpre, which).write_sample(covpre, sid)
+
+def covmatrix2txt(dstpre, which, chrom):
+    """Write the same table as the text backend (_concatenate_subsets)."""
+    cm = CovMatrix(dstpre, which)
+    dstpath = dstpre+'.{1}.{0}.txt.gz'.format(chrom, cm.fsuf)
+    if os.path.exists(dstpath):
+        return dstpath
+    rows = cm.rows(chrom)
+    df = PD.concat([rows, cm.get(chrom)], axis=1)
+    UT.write_pandas(df, dstpath, 'h')
+    return dstpath
+
 def collect_ecov_subset(modelpre, covpressub, dstpre, subid):
     return _collect_subset(modelpre, covpressub, dstpre, subid, 'ex')
 
@@ -1202,12 +1789,8 @@ def _concatenate_subsets(modelpre, dstpre, subids, which, chrom):
     dstpath0 = dstpre+'.{1}.{0}.tmp.txt.gz'.format(chrom,fsuf)
     dstpath1 = dstpre+'.{1}.{0}.txt.gz'.format(chrom,fsuf)
     if not os.path.exists(dstpath1):
-        with open(dstpath0, 'wb') as dst:
-            for subid in subids:
-                srcpath = dstpre+'.{2}.{0}.{1}.txt.gz'.format(chrom,subid,fsuf)
-                with open(srcpath, 'rb') as src:
-                    shutil.copyfileobj(src,dst)
-                files.append(srcpath)
+        srcpaths = [dstpre+'.{2}.{0}.{1}.txt.gz'.format(chrom,subid,fsuf) for subid in subids]
+        files += UT.concatenate_gz(srcpaths, dstpath0)
         ex0chr = ex0[ex0['chr']==chrom].sort_values(['st','ed','strand'])
         ex1chr = UT.read_pandas(dstpath0,names=ex0chr.index,index_col=[0]).T
         df = PD.concat([ex0chr, ex1chr],axis=1)
@@ -1231,31 +1814,84 @@ import os
 from jgem import gtfgffbed as GGB
 
 
-def collect_one(bwpre):
+def sj_keys(st, ed):
+    """int64 key of junctions (st,ed) within a chromosome (st,ed < 2**31)."""
+    return (N.asarray(st, dtype=N.int64)<<32) | N.asarray(ed, dtype=N.int64)
+
+def sort_sjkeys(cidx, key):
+    """Sort by (cidx, key). Returns (order, sorted cidx, sorted key, chrom boundaries)."""
+    o = N.lexsort((key, cidx))
+    cidx, key = cidx[o], key[o]
+    nc = cidx.max()+1 if len(cidx)>0 else 0
+    bnd = N.searchsorted(cidx, N.arange(nc+1))
+    return o, cidx, key, bnd
+
+def lookup_sjkeys(bnd0, key0, bnd1, key1):
+    """Find positions of sorted junction keys (key0) in sorted keys (key1).
+
+    Args:
+        bnd0, bnd1: chrom boundaries (see sort_sjkeys)
+        key0, key1: keys sorted within each chrom 
+
+    Returns:
+        positions into key1 (-1 if not found)
+    """
+    pos = N.full(len(key0), -1, dtype=N.int64)
+    for c in range(min(len(bnd0), len(bnd1))-1):
+        s0, e0, s1, e1 = bnd0[c], bnd0[c+1], bnd1[c], bnd1[c+1]
+        if s0==e0 or s1==e1:
+            continue
+        k0, k1 = key0[s0:e0], key1[s1:e1]
+        p = N.searchsorted(k1, k0)
+        p[p==len(k1)] = len(k1)-1
+        found = k1[p]==k0
+        pos[s0:e0][found] = p[found]+s1
+    return pos
+
+def collect_one(bwpre, which, c2i):
+    """Read sample junction counts.
+
+    Args:
+        bwpre: sample prefix (bwpre.sjpath.bed.gz)
+        which: tcnt or ucnt
+        c2i: chrom => index dict 
+
+    Returns:
+        (chrom boundaries, sorted keys, counts) see sort_sjkeys
+    """
     # because of unstranded data name (jid) cannot be trusted
     # just use locus (chr:st-ed) (st<ed)
     sjpaths = GGB.read_bed(bwpre+'.sjpath.bed.gz')
-    sjpaths['ucnt'] = sjpaths['sc1']
-    sjpaths['tcnt'] = sjpaths['sc2']
-    sjpaths['jids'] = sjpaths['name'].str.split(',')
-    sj = UT.flattendf(sjpaths, 'jids')
-    sj['sted'] = [[int(y) for y in x.split('|')] for x in sj['jids']]
-    #idxp = sj['strand'].isin(['+','.'])
-    sj['st'] = [min(x) for x in sj['sted']]
-    sj['ed'] = [max(x) for x in sj['sted']]
-    sj['locus'] = UT.calc_locus(sj)
-    l2u = UT.df2dict(sj, 'locus', which)
-    return l2u
+    cnt = sjpaths[{'ucnt':'sc1','tcnt':'sc2'}[which]].values
+    cidx = sjpaths['chr'].map(c2i).fillna(-1).values.astype(N.int64)
+    sted, cnts = GGB.intlists(sjpaths['name'].str.replace('|', ',', regex=False))
+    sted, nj = sted.reshape(-1,2), cnts//2
+    st, ed = sted.min(axis=1), sted.max(axis=1)
+    cidx, cnt = N.repeat(cidx, nj), N.repeat(cnt, nj)
+    idx = cidx>=0
+    o, cidx, key, bnd = sort_sjkeys(cidx[idx], sj_keys(st[idx], ed[idx]))
+    cnt = cnt[idx][o]
+    # duplicated loci: last one wins (as in dict)
+    last = N.ones(len(key), dtype=bool)
+    last[:-1] = (key[1:]!=key[:-1])|(cidx[1:]!=cidx[:-1])
+    return N.searchsorted(N.nonzero(last)[0], bnd), key[last], cnt[last]
     
-def collect_sjcnts_worker(idf, subsi, acode, which, dstpath):
+def collect_sjcnts_worker(idf, subsi, acode, which, dstpath, c2i):
     # which tcnt, ucnt
-    # idf ['locus']
-    cols = []
-    for sname, bwpre in subsi[['name','bwpre']].values:
-        l2u = collect_one(bwpre)
-        idf[sname] = [l2u.get(x,0) for x in idf['locus']]        
-        cols.append(sname)
-    UT.write_pandas(idf[cols], dstpath, 'ih') # don't want non-sample columns
+    # idf ['cidx','key'] sorted by (cidx,key)
+    bnd0 = N.searchsorted(idf['cidx'].values, N.arange(len(c2i)+1))
+    key0 = idf['key'].values
+    names = list(subsi['name'])
+    mat = N.zeros((len(idf), len(names)), dtype=N.int64) # integer counts
+    for j, bwpre in enumerate(subsi['bwpre']):
+        bnd1, key1, cnt1 = collect_one(bwpre, which, c2i)
+        if not N.can_cast(cnt1.dtype, mat.dtype):
+            mat = mat.astype(N.promote_types(mat.dtype, cnt1.dtype))
+        pos = lookup_sjkeys(bnd0, key0, bnd1, key1)
+        found = pos>=0
+        mat[found, j] = cnt1[pos[found]]
+    df = PD.DataFrame(mat, index=idf.index, columns=names)
+    UT.write_pandas(df, dstpath, 'ih') # don't want non-sample columns
     return dstpath
 
 def collect_sjcnts(dataset_code, si, assembly_code, modelpre, which, outdir, np=7):
@@ -1271,11 +1907,12 @@ def collect_sjcnts(dataset_code, si, assembly_code, modelpre, which, outdir, np=
 
     """    
     sj = UT.read_pandas(modelpre+'.sj.txt.gz')
-    #sj['st'] = sj['st-1'] # old format
-    sj['locus'] = UT.calc_locus(sj,'chr','st-1','ed')
-    #sj['uid'] = sj['chr']+':'+sj['name']
-    idf = sj[['_id', 'locus']].set_index('_id')
-    #idf = sj[['_id', 'uid']].copy()
+    # junctions are joined on int64 keys (chrom index, st, ed) instead of locus strings
+    c2i = {c:i for i,c in enumerate(sorted(sj['chr'].unique()))}
+    sj['cidx'] = sj['chr'].map(c2i).values
+    sj['key'] = sj_keys(sj['st-1'].values, sj['ed'].values)
+    o = N.lexsort((sj['key'].values, sj['cidx'].values))
+    idf = sj.iloc[o][['_id', 'cidx', 'key']].set_index('_id')
     dstpre = os.path.join(outdir, '{0}.{1}'.format(dataset_code, assembly_code))
     batchsize = int(N.ceil(len(si)/float(np)))
     args = []
@@ -1285,13 +1922,13 @@ def collect_sjcnts(dataset_code, si, assembly_code, modelpre, which, outdir, np=
         subsi = si1.iloc[i*batchsize:(i+1)*batchsize].copy()
         dstpath = dstpre+'.{0}.part{1}.txt.gz'.format(which, i)
         files.append(dstpath)
-        args.append((idf, subsi, assembly_code, which, dstpath))
+        args.append((idf, subsi, assembly_code, which, dstpath, c2i))
 
     rslts = UT.process_mp(collect_sjcnts_worker, args, np=np, doreduce=False)
 
     # concat part files
     dfs = [UT.read_pandas(fpath, index_col=[0]) for fpath in files]
-    df = PD.concat(dfs, axis=1)
+    df = PD.concat(dfs, axis=1).loc[sj['_id'].values] # original order
     dstpath = dstpre+'.{0}s.txt.gz'.format(which)
     UT.write_pandas(df, dstpath, 'ih')
     
@@ -1493,18 +2130,8 @@ def calc_gcovs(covpre,modelpre,snames,acode,np=7,deletechromfiles=True):
     g5dst0 = covpre+'.tcov5.txt.gz'
     g53dst0 = covpre+'.tcov53.txt.gz'
     files = []
-    with open(g5dst0,'wb') as dst:
-        for c in chroms:
-            g5dst = covpre+'.tcov5.{0}.txt.gz'.format(c)
-            with open(g5dst,'rb') as src:
-                shutil.copyfileobj(src,dst)
-            files.append(g5dst)
-    with open(g53dst0,'wb') as dst:
-        for c in chroms:
-            g53dst = covpre+'.tcov53.{0}.txt.gz'.format(c)
-            with open(g53dst,'rb') as src:
-                shutil.copyfileobj(src,dst)
-            files.append(g53dst)
+    files += UT.concatenate_gz([covpre+'.tcov5.{0}.txt.gz'.format(c) for c in chroms], g5dst0)
+    files += UT.concatenate_gz([covpre+'.tcov53.{0}.txt.gz'.format(c) for c in chroms], g53dst0)
     # add header, tname columns
     g53names = paths.groupby(['chr','tst','ted','strand'])['name'].apply(lambda x:','.join(x)).to_frame()
     g5names = paths.set_index('id').groupby(i2g)['name'].apply(lambda x:','.join(x)).to_frame()
@@ -38,6 +38,57 @@ LOG = logging.getLogger(__name__)
 from jgem import utils as UT
 from jgem import bigwig as BW
 
+BLOCKSIZE = int(1e6) # max span of exon starts read by one get_as_array
+MAXGAP = int(1e5) # start a new block at gaps larger than this
+
+def exon_blocks(st, ed, blocksize=BLOCKSIZE, maxgap=MAXGAP):
+    """Block ids for exons (same chrom, sorted by st). A new block starts at a gap
+    larger than maxgap or every blocksize bp from the start of the segment."""
+    if len(st)==0:
+        return N.zeros(0, dtype=N.int64)
+    med = N.maximum.accumulate(ed)
+    newseg = N.concatenate([[True], st[1:]-med[:-1]>maxgap])
+    seg = N.cumsum(newseg)
+    segst = st[newseg][seg-1]
+    bin_ = (st-segst)//blocksize
+    new = newseg | N.concatenate([[True], bin_[1:]!=bin_[:-1]])
+    return N.cumsum(new)-1
+
+def bw_sums(bw, chrom, st, ed, blocksize=BLOCKSIZE, maxgap=MAXGAP):
+    """Sum of bigwig values (NaN as 0) in [st,ed) for each exon in chrom.
+    Reads one array per block of nearby exons and uses cumulative sums.
+
+    Args:
+        bw: BW.BigWigFile
+        chrom (str): chromosome
+        st, ed: arrays of exon starts, ends (any order)
+
+    Returns:
+        array of sums (same order as st)
+    """
+    st, ed = N.asarray(st, dtype=N.int64), N.asarray(ed, dtype=N.int64)
+    o = N.argsort(st, kind='mergesort')
+    sst, sed = st[o], ed[o]
+    bid = exon_blocks(sst, sed, blocksize, maxgap)
+    bnd = N.searchsorted(bid, N.arange(bid[-1]+2)) if len(bid)>0 else [0]
+    sums = N.zeros(len(st))
+    for i0, i1 in zip(bnd[:-1], bnd[1:]):
+        bst, bed = sst[i0], N.max(sed[i0:i1])
+        a = bw.get_as_array(chrom, bst, bed)
+        if a is None:
+            continue
+        a[N.isnan(a)] = 0.
+        cs = N.concatenate([[0.], N.cumsum(a, dtype=N.float64)])
+        e = N.clip(sed[i0:i1]-bst, 0, len(a))
+        b = N.clip(sst[i0:i1]-bst, 0, len(a))
+        sums[o[i0:i1]] = N.where(e>b, cs[e]-cs[b], 0.)
+    return sums
+
+def _chrom_order(df):
+    "stable order grouping rows by chromosome (first appearance)"
+    return N.lexsort((N.arange(len(df)), PD.factorize(df['chr'].values)[0]))
+
+
 class PhyloCSF(object):
     """ Wrapper to access PhyloCSF bigwig. 
 
@@ -89,9 +140,14 @@ class PhyloCSF(object):
     def calc_scores(self, gbed):
         # gbed : beddf subset containing uexons in one gene
         # adds score+, score- columns to gbed
+        scores = {s:N.zeros(len(gbed)) for s in self.STRANDS}
+        for chrom, idx in gbed.groupby('chr').indices.items():
+            st, ed = gbed['st'].values[idx], gbed['ed'].values[idx]
+            for s in self.STRANDS:
+                fs = [bw_sums(self.bws[s][f], chrom, st, ed) for f in self.FRAMES]
+                scores[s][idx] = N.max(fs, axis=0)
         for s in self.STRANDS:
-            colname = 'score{0}'.format(s)
-            gbed[colname] = [self.maxscore(s,chrom,st,ed) for chrom,st,ed in gbed[['chr','st','ed']].values]
+            gbed['score{0}'.format(s)] = scores[s]
         return gbed
 
     def calculate(self, unionexbed, addcols=['_id','_gidx'], np=10):
@@ -106,17 +162,17 @@ class PhyloCSF(object):
             A dictionary: gene_id => score
 
         """
-        # process chrom wise
-        args = []
-        for chrom in unionexbed['chr'].unique():
-            uechr = unionexbed[unionexbed['chr']==chrom][['chr','st','ed']+addcols].copy()
-            mycopy = PhyloCSF(self.pcdir) # looks like MP doesn't get invoked unless you use a copy...
-            args.append((uechr, mycopy))
+        # chunks sorted by (chr,st) balanced by total bp
+        ue = unionexbed[['chr','st','ed']+addcols].copy()
+        ue['_pos'] = _chrom_order(ue).argsort()
+        ue = ue.sort_values(['chr','st'])
+        cost = (ue['ed']-ue['st']).clip(lower=1).values
+        args = [(c.copy(), PhyloCSF(self.pcdir)) for c in UT.split_balanced(ue, cost, 4*np)]
 
         rslts = UT.process_mp(calc_worker, args, np=np, doreduce=False)
 
         df = PD.concat(rslts, ignore_index=True)
-        return df
+        return df.sort_values('_pos').drop('_pos', axis=1).reset_index(drop=True)
 
 def calc_worker(uex, pcobj):
     with pcobj:
@@ -156,7 +212,10 @@ class Phylo60(object):
         # gbed : beddf subset containing uexons in one gene
         # adds phylo60score column to gbed
         colname = 'phylo60score'
-        gbed[colname] = [self.score(chrom,st,ed) for chrom,st,ed in gbed[['chr','st','ed']].values]
+        score = N.zeros(len(gbed))
+        for chrom, idx in gbed.groupby('chr').indices.items():
+            score[idx] = bw_sums(self.bw, chrom, gbed['st'].values[idx], gbed['ed'].values[idx])
+        gbed[colname] = score
         return gbed
 
     def calculate(self, unionexbed, addcols=['_id','_gidx'], np=10):
@@ -168,15 +227,14 @@ class Phylo60(object):
             np: number of CPU to use
 
         """
-        # process chrom wise
-        args = []
-        for chrom in unionexbed['chr'].unique():
-            uechr = unionexbed[unionexbed['chr']==chrom][['chr','st','ed']+addcols].copy()
-            mycopy = Phylo60(self.path)
-            args.append((uechr, mycopy))
+        # chunks sorted by (chr,st) balanced by total bp
+        ue = unionexbed[['chr','st','ed']+addcols].copy()
+        ue['_pos'] = _chrom_order(ue).argsort()
+        ue = ue.sort_values(['chr','st'])
+        cost = (ue['ed']-ue['st']).clip(lower=1).values
+        args = [(c.copy(), Phylo60(self.path)) for c in UT.split_balanced(ue, cost, 4*np)]
 
         rslts = UT.process_mp(calc_worker, args, np=np, doreduce=False)
 
         df = PD.concat(rslts, ignore_index=True)
-        return df
-
+        return df.sort_values('_pos').drop('_pos', axis=1).reset_index(drop=True)
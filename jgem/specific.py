@@ -27,6 +27,8 @@ from jgem import utils as UT
 # class
 from ponder import plotutils as PU
 
+MEMSIZE = int(2**28) # bytes per gene block of pairwise DMs
+
 def make_dict(df,f1,f2):
     dic = {}
     for k,v in df[[f1,f2]].values:
@@ -34,6 +36,47 @@ def make_dict(df,f1,f2):
     dic = {k:list(dic[k]) for k in dic}
     return dic
 
+def pair_masks(ts, sets):
+    """Within group pair masks (sets x ts x ts) for each set of names in ts."""
+    masks = []
+    for levelnames in sets:
+        i1 = N.array([x in set(levelnames) for x in ts])
+        i2 = ~i1
+        masks.append(i1[:,N.newaxis]*i1[N.newaxis,:]+i2[:,N.newaxis]*i2[N.newaxis,:])
+    return N.array(masks, dtype=float).reshape(len(masks),len(ts),len(ts))
+
+def dm_block(m, gmin, maxdiff):
+    """Normalized logdiff and minmin DMs (genes x groups x groups) of a gene block."""
+    logdiff = N.abs(m[:,:,N.newaxis]-m[:,N.newaxis,:])
+    normdiff = logdiff/maxdiff[:,N.newaxis,N.newaxis] # normalized
+    minmin = N.minimum(gmin[:,:,N.newaxis], gmin[:,N.newaxis,:])
+    return normdiff, minmin
+
+def dm_scores(m, gmin, maxdiff, mask1, zth1, zth2, mmth, memsize=MEMSIZE):
+    """Within (sc1, thresholded) and between (sc2) group sums of normalized logdiff
+    for each gene (rows of m, gmin) and each set (mask1: within pair masks).
+    DMs are calculated in gene blocks of at most memsize bytes.
+
+    Returns:
+        sc1, sc2 (genes x sets)
+    """
+    ng, nt = m.shape
+    mask2 = 1. - mask1
+    sc1 = N.zeros((ng, len(mask1)))
+    sc2 = N.zeros((ng, len(mask1)))
+    bsize = max(1, int(memsize//(nt*nt*8*3)))
+    for st in range(0, ng, bsize):
+        ed = min(ng, st+bsize)
+        dmv, mmv = dm_block(m[st:ed], gmin[st:ed], maxdiff[st:ed])
+        mmmask = mmv>=mmth
+        # ignore pairs within groups with small diffs (zth1 if minmin<mmth else zth2)
+        zero = ((dmv<zth1)&(~mmmask))|((dmv<zth2)&mmmask)
+        dmv1 = N.where(zero, 0., dmv)
+        sc1[st:ed] = N.tensordot(dmv1, mask1, axes=([1,2],[1,2]))
+        sc2[st:ed] = N.tensordot(dmv, mask2, axes=([1,2],[1,2]))
+    return sc1, sc2
+
+
 class SpecificByDM(object):
     """
     Args:
@@ -69,7 +112,11 @@ class SpecificByDM(object):
         
     
     def make_dm(self, targetlevel):
-        """calculate 2 DMs (logdiff and minmin) at specified level """
+        """prepare 2 DMs (logdiff and minmin) at specified level. 
+
+        Only group level values (v: log2 mean, gmin: min) and per gene max logdiff 
+        are kept, DMs are calculated in gene blocks when needed (get_dm, calc_scores).
+        """
         # first make gcovlevel <=> targetlevel mapping
         si = self.si
         gl = self.gcovlevel
@@ -80,44 +127,70 @@ class SpecificByDM(object):
         t2g = make_dict(si, targetlevel, gl)
         
         lgc = N.log2(gc+1)
-        v0 = lgc.groupby(g2t, axis=1).mean() # target level
+        v0 = lgc.T.groupby(g2t).mean().T # target level
         maxe = v0.max(axis=1)
         gids = maxe[maxe>N.log2(self.maxeth+1)].index.values
-        v = v0.ix[gids][ts] # restrict to expressed
-        # do the math in numpy to get normalized logdiff DM
-        m = v.values
-        logdiff = N.abs(m[:,:,N.newaxis]-m[:,N.newaxis,:])
-        maxdiff = logdiff.max(axis=2).max(axis=1)
-        normdiff = logdiff/maxdiff[:,N.newaxis,N.newaxis] # normalized
-        dm = PD.Panel(normdiff, v.index, ts, ts) 
-        # calculate minmin DM
-        gmin = gc.ix[gids].groupby(g2t, axis=1).min()[ts].values
-        a = gmin[:,:,N.newaxis] # i
-        b = gmin[:,N.newaxis,:] # j
-        minmin = N.minimum(a,b)
-        mm = PD.Panel(minmin, v.index, ts, ts)
-        self.dms[targetlevel] = dict(ts=ts,g2t=g2t,t2g=t2g,dm=dm,mm=mm,v=v)
+        v = v0.loc[gids][ts] # restrict to expressed
+        # max of logdiff DM 
+        maxdiff = v.max(axis=1) - v.min(axis=1)
+        # for minmin DM
+        gmin = gc.loc[gids].T.groupby(g2t).min().T[ts]
+        self.dms[targetlevel] = dict(ts=ts,g2t=g2t,t2g=t2g,v=v,gmin=gmin,maxdiff=maxdiff)
+
+    def get_dm(self, targetlevel, gid):
+        """normalized logdiff and minmin DMs (DataFrame groups x groups) of a gene"""
+        d = self.dms[targetlevel]
+        ts = d['ts']
+        dmv, mmv = dm_block(d['v'].loc[[gid]].values, d['gmin'].loc[[gid]].values, 
+                            d['maxdiff'].loc[[gid]].values)
+        return PD.DataFrame(dmv[0], index=ts, columns=ts), PD.DataFrame(mmv[0], index=ts, columns=ts)
+
+    def calc_scores(self, targetlevel, sets, gids=None, np=1, memsize=MEMSIZE):
+        """Within (sc1) and between (sc2) group DM sums for sets of names in targetlevel.
+
+        Args:
+            targetlevel: a column name in sampleinfo dataframe
+            sets: list of list of names in the targetlevel column
+            gids: restrict to these genes (default None: all expressed)
+            np: number of processes (genes are split into np blocks)
+            memsize: max bytes of DMs calculated at once (per process)
+
+        Returns:
+            gene index, sc1, sc2 (genes x sets)
+        """
+        d = self.dms[targetlevel]
+        v, gmin, maxdiff = d['v'], d['gmin'], d['maxdiff']
+        if gids is not None:
+            v, gmin, maxdiff = v.loc[gids], gmin.loc[gids], maxdiff.loc[gids]
+        m, g, md = v.values, gmin.values, maxdiff.values
+        mask1 = pair_masks(v.columns, sets)
+        bnd = N.linspace(0, len(m), np+1).astype(int)
+        args = [(m[s:e], g[s:e], md[s:e], mask1, self.zth1, self.zth2, self.mmth, memsize) 
+                for s,e in zip(bnd[:-1],bnd[1:]) if e>s]
+        rslts = UT.process_mp(dm_scores, args, np=np, doreduce=False)
+        if len(rslts)==0:
+            z = N.zeros((0,len(sets)))
+            return v.index, z, z
+        sc1 = N.concatenate([x[0] for x in rslts])
+        sc2 = N.concatenate([x[1] for x in rslts])
+        return v.index, sc1, sc2
 
     def get_snames(self, targetlevel, levelnames):
         si = self.si
         # [levelnames,...] in targetlevel column (group or cg1) => sample names (name)
         return si[si[targetlevel].isin(levelnames)]['name'].values
     
-    def calc_one_specific(self, targetlevel, levelnames, gids=None):
+    def calc_one_specific(self, targetlevel, levelnames, gids=None, np=1):
         """
         Args:
             targetlevel: a column name in sampleinfo dataframe
             g1: a set of names in the targetlevel column
         """
-        dm = self.dms[targetlevel]['dm']
-        mm = self.dms[targetlevel]['mm']
-        v = self.dms[targetlevel]['v']
-        if gids is not None:
-            dm = dm.ix[gids]
-            mm = mm.ix[gids]
-            v = v.ix[gids]
-        
-        c = dm.major_axis
+        gidx, sc1, sc2 = self.calc_scores(targetlevel, [levelnames], gids, np)
+        return self._specific_df(targetlevel, levelnames, gidx, sc1[:,0], sc2[:,0])
+
+    def _specific_df(self, targetlevel, levelnames, gidx, sc1, sc2):
+        c = PD.Index(self.dms[targetlevel]['ts'])
         i1 = c.isin(levelnames)
         i2 = ~i1
         n1 = N.sum(i1)
@@ -127,20 +200,7 @@ class SpecificByDM(object):
         mask2 = N.ones(len(i1)) - mask1
         sum1 = mask1.sum() - (n1+n2)
         sum2 = mask2.sum()
-        dmv = dm.values
-        dmv1 = dmv*mask1[N.newaxis,:,:]
-        idx1 = dmv1<self.zth1
-        idx2 = dmv1<self.zth2
-        mmv = mm.values
-        mmmask = mmv>=self.mmth
-        idx1 = idx1*(~mmmask)
-        idx2 = idx2*mmmask
-        dmv1[idx1] = 0. # ignore those pairs within groups and min of the pair > minminth
-        dmv1[idx2] = 0.
-        dmv2 = dmv*mask2[N.newaxis,:,:] # don't apply zeroth to between groups
-        sc1 = dmv1.sum(axis=2).sum(axis=1)
-        sc2 = dmv2.sum(axis=2).sum(axis=1)
-        df = PD.DataFrame({'_gidx':dm.items, 'sc1':sc1,'sc2':sc2,})
+        df = PD.DataFrame({'_gidx':gidx, 'sc1':sc1,'sc2':sc2,})
         df['score'] = (df['sc2']-df['sc1'])/(2.*n1*n2)
         df['di1'] = df['sc1']/float(sum1)
         df['di2'] = df['sc2']/float(sum2)
@@ -151,7 +211,7 @@ class SpecificByDM(object):
         #df['gcov'] = v1[levelnames].mean(axis=1).values
         #cmpl = [x for x in v1.columns if x not in levelnames]
         #df['gcov2'] = v1[cmpl].mean(axis=1).values
-        gc = self.gcov.ix[df['_gidx'].values] # align
+        gc = self.gcov.loc[df['_gidx'].values] # align
         sn = self.get_snames(targetlevel, levelnames) # corresponding samples
         df['rd'] = (gc[sn]>self.rdth).mean(axis=1).values
         df['gcov'] = gc[sn].mean(axis=1).values
@@ -164,17 +224,22 @@ class SpecificByDM(object):
         return df
         
     
-    def calc_many_specific(self, targetlevel, key2names, scoreth=None, rdratioth=0.6):
+    def calc_many_specific(self, targetlevel, key2names, scoreth=None, rdratioth=0.6, np=1):
         """
         Args:
             targetlevel: name or cg1
             key2names: dict groupname (key) to names in targetlevel
+            np: number of processes for calculating scores
             
         """
         dfs = []
-        for k, ln in key2names.items():
+        keys = list(key2names.keys())
+        # DMs are calculated once for all groups
+        gidx, sc1, sc2 = self.calc_scores(targetlevel, [key2names[k] for k in keys], np=np)
+        for i, k in enumerate(keys):
+            ln = key2names[k]
             print('{0}...'.format(k))
-            df = self.calc_one_specific(targetlevel, ln)
+            df = self._specific_df(targetlevel, ln, gidx, sc1[:,i], sc2[:,i])
             cols = list(df.columns)
             if scoreth is not None:
                 df = df[df['score']>scoreth].copy()
@@ -200,10 +265,10 @@ class SpecificByDM(object):
         gbed = self.gbed
         gbedcols=['gen9_sym0','glocus','#uexons','#junc','pCSF','p60','gknown']
         for c in gbedcols:
-            df[c] = gbed.ix[df['_gidx']][c].values
+            df[c] = gbed.loc[df['_gidx']][c].values
         df = df.rename(columns={'gen9_sym0':'symbol'}).set_index('_gidx')
         idx = df['symbol'].isnull()
-        df.loc[idx, 'symbol'] = gbed.ix[df[idx].index]['gname']        
+        df.loc[idx, 'symbol'] = gbed.loc[df[idx].index]['gname']        
         return df
     
     def plot_dm(self, targetlevel, gid, key2pos, lvmax, title=None, fontsize=6,
@@ -220,17 +285,16 @@ class SpecificByDM(object):
         args['frameon'] = False
         ax_ex = PU.add_subplot_axes(ax,exrect,args)
         
-        dm1 = self.dms[targetlevel]['dm'].ix[gid]
-        mm1 = self.dms[targetlevel]['mm'].ix[gid]
-        v1 = self.dms[targetlevel]['v'].ix[gid]
-        gc1 = self.gcov.ix[gid]
+        dm1, mm1 = self.get_dm(targetlevel, gid)
+        v1 = self.dms[targetlevel]['v'].loc[gid]
+        gc1 = self.gcov.loc[gid]
         
         cols = [x[1] for x in sorted([(key2pos[x],x) for x in dm1.columns])]
-        dm1 = dm1[cols].ix[cols]
-        mm1 = mm1[cols].ix[cols]
-        v1 = v1.ix[cols]
+        dm1 = dm1[cols].loc[cols]
+        mm1 = mm1[cols].loc[cols]
+        v1 = v1.loc[cols]
         snames = [y for x in cols for y in self.get_snames(targetlevel, [x])]
-        gc1 = gc1.ix[snames]
+        gc1 = gc1.loc[snames]
         
         # main
         dmv = dm1.values.copy()
@@ -303,7 +367,7 @@ class SpecificByDM(object):
         
         def _plot_main(sub,gcov,ax):
             gids = [x for x in sub.index.values]
-            m = gcov.ix[gids].values
+            m = gcov.loc[gids].values
             mmin = m.min(axis=1)
             mmax = m.max(axis=1)
             #mn = (m-mmin[:,N.newaxis])/(mmax-mmin)[:,N.newaxis]
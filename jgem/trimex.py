@@ -6,7 +6,6 @@
 ..  moduleauthor:: Ken Sugino <ken.sugino@gmail.com>
 
 """
-import multiprocessing
 import logging
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
@@ -20,56 +19,63 @@ from jgem import bigwig as BW
 
 
 # Trim from 3' end    
+def trim_ex_df(ex, length, gidfld):
+    """Collect exons from 3' end up to length for each gene (chr, gidfld). 
+
+    Genes shorter than length are kept as is (original order), otherwise exons are 
+    ordered from the 3' end (strand of the first exon), cumulative length is calculated
+    and the exon crossing length is trimmed. If the 3'-most exon is already longer 
+    than length, only that one is kept (trimmed to length).
+
+    Args:
+        ex: exon DataFrame (with len column)
+        length (pos int): length to trim
+        gidfld (str): column name for gene id 
+
+    Returns:
+        DataFrame of trimmed exons (sorted by chr, gidfld)
+    """
+    cols = list(ex.columns.values)
+    ex = ex[ex[gidfld].notnull()].reset_index(drop=True)
+    grp = ex.groupby(['chr',gidfld])
+    gi = grp.ngroup().values
+    plus = (grp['strand'].transform('first')=='+').values
+    short = (grp['len'].transform('sum')<length).values
+    st, ed = ex['st'].values, ex['ed'].values
+    pos = N.arange(len(ex))
+    # order: gene, then original (short) or from 3' end (plus: ed,st descending)
+    s1 = N.where(short, pos, N.where(plus, -ed, st))
+    s2 = N.where(short, 0, N.where(plus, -st, ed))
+    o = N.lexsort((s2, s1, gi))
+    nex = ex.iloc[o].reset_index(drop=True)
+    gi, plus, short = gi[o], plus[o], short[o]
+    clen = nex.groupby(gi)['len'].cumsum().values
+    plen = clen - nex['len'].values
+    rank = nex.groupby(gi).cumcount().values
+    # first: always, next ones: until cumulative length reaches length
+    # (second one is visited even if the first one is exactly length)
+    first0 = (rank==0)&(clen>length) # 3'-most already longer
+    stop = N.zeros(len(nex), dtype=bool)
+    stop[1:] = first0[:-1]&(gi[1:]==gi[:-1])
+    keep = short | (rank==0) | (((plen<length)|((rank==1)&(plen==length)))&~stop)
+    st, ed = nex['st'].values.copy(), nex['ed'].values.copy()
+    over = clen - length
+    # trim first one (keeps 5' side)
+    idx = ~short&first0
+    ed[idx&plus] = st[idx&plus] + length
+    st[idx&~plus] = ed[idx&~plus] - length
+    # trim the one crossing length
+    idx = ~short&(rank>0)&(over>0)
+    st[idx&plus] += over[idx&plus]
+    ed[idx&~plus] -= over[idx&~plus]
+    nex['st'] = st
+    nex['ed'] = ed
+    return nex[keep][cols].reset_index(drop=True)
+
 def trim_ex_worker(args):
     ex,length,gidfld=args
-    # for each gene collect exons from 3' end up to length
-    cols = list(ex.columns.values)
-    idxst = cols.index('st')
-    idxed = cols.index('ed')
-    idxlen = cols.index('len')
-    def _gen():
-        for _gidx, gr in ex.groupby(gidfld):
-            total = gr['len'].sum()
-            if total<length: # too short to trim
-                for v in gr.values:
-                    yield tuple(v)
-            else:
-                # look from 3' end
-                strand = gr['strand'].iloc[0]
-                if strand == '+':
-                    gr = gr.sort_values(['ed','st'],ascending=False)
-                else:
-                    gr = gr.sort_values(['st','ed'],ascending=True)
-                grv = gr.values
-                # if the first one already larger than length?
-                first = grv[0]
-                clen = first[idxlen]
-                if clen>length: # trim this one and go next
-                    if strand == '+':
-                        first[idxed] = first[idxst] + length
-                        yield tuple(first)
-                    else:
-                        first[idxst] = first[idxed] - length
-                        yield tuple(first)
-                # start collecting until it reaches the length
-                else:
-                    yield first
-                    for i in range(1,len(gr)):
-                        cur = grv[i]
-                        clen += cur[idxlen]
-                        if clen<=length: # not enough yet
-                            yield tuple(cur)
-                            if clen==length:
-                                break
-                        else: # exceeded => trim
-                            if strand=='+':
-                                cur[idxst] = cur[idxst] + (clen-length)
-                            else:
-                                cur[idxed] = cur[idxed] - (clen-length)
-                            yield tuple(cur)
-                            break
-    #nex = PD.DataFrame([x for x in _gen()], columns = cols)
-    return [x for x in _gen()]
+    nex = trim_ex_df(ex, length, gidfld)
+    return [tuple(x) for x in nex.values]
 
 def trim_ex(expath, dstpath, dstcipath, length=1000, gidfld='_gidx', np=7):
     """Generate trimmed version of genes for calculating coverage to avoid length bias. 
@@ -80,7 +86,7 @@ def trim_ex(expath, dstpath, dstcipath, length=1000, gidfld='_gidx', np=7):
         dstcipath (str): path to ci (chopped interval) 
         length (pos int): length to trim from 3' end in base pair (default 1000 bp)
         gidfld (str): column name for gene id (default _gidx)
-        np (pos int): number of CPU to use
+        np (pos int): not used (vectorized, single process), kept for compatibility
 
     Generates:
         Two files (dstpath, dstcipath).
@@ -94,22 +100,7 @@ def trim_ex(expath, dstpath, dstcipath, length=1000, gidfld='_gidx', np=7):
     ex = UT.read_pandas(expath)
     if 'len' not in ex.columns:
         ex['len'] = ex['ed'] - ex['st']
-    if np==1:
-        recs = trim_ex_worker((ex, length, gidfld))
-    else:
-        chroms = sorted(ex['chr'].unique())
-        data = [(ex[ex['chr']==c], length, gidfld) for c in chroms]
-        recs = []
-        try:
-            p = multiprocessing.Pool(np)
-            for v in p.map(trim_ex_worker, data):
-                recs += v
-            #recs = reduce(iadd, p.map(trim_ex_worker, *zip(*data)))
-        finally:
-            p.close()
-            # p.join()
-    cols = list(ex.columns.values)
-    nex = PD.DataFrame(recs, columns = cols)
+    nex = trim_ex_df(ex, length, gidfld)
     nex['len'] = nex['ed'] - nex['st']
     # edge case
     nex.loc[nex['st']==nex['ed'],'ed'] = nex['st'] + 1
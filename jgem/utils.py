@@ -8,6 +8,8 @@
 """
 import subprocess
 import gzip
+import zlib
+import struct
 import os
 import errno
 import math
@@ -27,6 +29,7 @@ import json
 import shutil
 import uuid
 import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 import pandas as PD
 import numpy as N
@@ -376,16 +379,167 @@ def make_empty_df(colnames):
 
 
 #### GZIP ###############################################################
-def compress(fname):
-    "Uses gzip to compress file"
+# BGZF (blocked gzip, as in samtools/tabix): a series of independent gzip members
+# each holding <64KB of data with the block size recorded in the extra field.
+# It is a valid gzip stream (gunzip, zcat, gzip.open, pandas read it as usual),
+# blocks can be deflated in parallel (zlib releases the GIL) and the result is
+# random-accessible with tabix style virtual offsets.
+BGZF_BLOCKSIZE = 0xff00 # max uncompressed bytes per block (same as htslib)
+BGZF_EOF = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00\x1b\x00\x03\x00\x00\x00\x00\x00\x00\x00\x00\x00'
+BGZF_BATCH = 64 # number of blocks to deflate per batch (per thread)
+
+def bgzf_block(data, level=6):
+    """Make one BGZF block (gzip member) from data (bytes, len<=BGZF_BLOCKSIZE)."""
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    if len(cdata) > 65536-26: # incompressible, store
+        c = zlib.compressobj(0, zlib.DEFLATED, -15)
+        cdata = c.compress(data) + c.flush()
+    bsize = len(cdata) + 25 # total block size - 1
+    header = b'\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00' + struct.pack('<H', bsize)
+    footer = struct.pack('<II', zlib.crc32(data) & 0xffffffff, len(data) & 0xffffffff)
+    return header + cdata + footer
+
+class BGZFWriter(object):
+    """Binary file-like object writing BGZF (blocked gzip) compressed data.
+    Blocks are deflated in a thread pool.
+
+    Args:
+        fname (str): destination path
+        np (int): number of threads (default 4)
+        level (int): compression level (default 6, same as gzip)
+        mode (str): 'wb' or 'ab' (append new members to an existing file)
+
+    Usage::
+
+        with BGZFWriter('a.txt.gz') as fp:
+            fp.write(b'...')
+    """
+
+    def __init__(self, fname, np=4, level=6, mode='wb'):
+        self.fname = fname
+        self.np = np
+        self.level = level
+        self.fobj = open(fname, mode)
+        self.pool = ThreadPool(np) if np>1 else None
+        self.buf = []
+        self.bufsize = 0
+        self.closed = False
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self.buf.append(data)
+        self.bufsize += len(data)
+        if self.bufsize >= BGZF_BLOCKSIZE*BGZF_BATCH*max(1,self.np):
+            self._flush_blocks(final=False)
+        return len(data)
+
+    def _flush_blocks(self, final):
+        data = b''.join(self.buf)
+        n = len(data)
+        if final:
+            nb = int(math.ceil(n/float(BGZF_BLOCKSIZE)))
+        else:
+            nb = n//BGZF_BLOCKSIZE
+        chunks = [data[i*BGZF_BLOCKSIZE:(i+1)*BGZF_BLOCKSIZE] for i in range(nb)]
+        rest = data[nb*BGZF_BLOCKSIZE:]
+        self.buf = [rest] if rest else []
+        self.bufsize = len(rest)
+        if self.pool is None or len(chunks)<2:
+            blocks = [bgzf_block(x, self.level) for x in chunks]
+        else:
+            blocks = self.pool.map(partial(bgzf_block, level=self.level), chunks)
+        for b in blocks:
+            self.fobj.write(b)
+
+    def flush(self):
+        self.fobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            self._flush_blocks(final=True)
+            self.fobj.write(BGZF_EOF)
+        finally:
+            self.fobj.close()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def bgzf_compress(src, dst, np=4, level=6, chunksize=BGZF_BLOCKSIZE*BGZF_BATCH):
+    """Compress file src into BGZF file dst using np threads."""
+    with open(src, 'rb') as sp:
+        with BGZFWriter(dst, np=np, level=level) as dp:
+            while True:
+                data = sp.read(chunksize)
+                if not data:
+                    break
+                dp.write(data)
+    return dst
+
+def concatenate_gz(srcpaths, dstpath, remove=False, skipmissing=False):
+    """Concatenate gzip files (as gzip members) without recompression.
+    Trailing BGZF EOF markers of sources are dropped and one is added at the end 
+    so that concatenation of BGZF files is again a valid BGZF file.
+
+    Args:
+        srcpaths: list of gzip (BGZF) files
+        dstpath: destination
+        remove (bool): whether to remove sources after concatenation
+        skipmissing (bool): if True, ignore non-existent sources
+
+    Returns:
+        list of concatenated sources
+    """
+    done = []
+    n = len(BGZF_EOF)
+    with open(dstpath, 'wb') as dst:
+        for src in srcpaths:
+            if skipmissing and not os.path.exists(src):
+                continue
+            size = os.path.getsize(src)
+            with open(src, 'rb') as sp:
+                if size>=n:
+                    sp.seek(size-n)
+                    if sp.read(n)==BGZF_EOF:
+                        size -= n
+                    sp.seek(0)
+                while size>0:
+                    data = sp.read(min(size, 1<<20))
+                    if not data:
+                        break
+                    dst.write(data)
+                    size -= len(data)
+            done.append(src)
+        dst.write(BGZF_EOF)
+    if remove:
+        for src in done:
+            os.unlink(src)
+    return done
+
+def compress(fname, np=4):
+    "Compress file into BGZF (gzip compatible) using np threads"
     if fname[-3:]=='.gz':
         return fname
     if os.path.exists(fname+'.gz'):
         os.unlink(fname+'.gz')
-    ret = subprocess.call(['gzip', fname])
-    if ret!=0:
-        LOG.warning('Error compressing file {0}\n'.format(fname))
+    try:
+        bgzf_compress(fname, fname+'.gz', np=np)
+    except (IOError, OSError, zlib.error) as e:
+        LOG.warning('Error compressing file {0}:{1}\n'.format(fname, e))
+        if os.path.exists(fname+'.gz'):
+            os.unlink(fname+'.gz')
         return fname
+    os.unlink(fname)
     return fname+'.gz'
     
 def uncompress(fname):
@@ -845,6 +999,15 @@ def tname2gidx(tname):
 
 #### multiprocessing ##################################################
 
+def split_balanced(df, cost, n):
+    """Split df into at most n contiguous chunks with similar total cost."""
+    cs = N.cumsum(cost)
+    if len(cs)==0:
+        return []
+    bnd = N.searchsorted(cs, cs[-1]*N.arange(1,n)/float(n), 'right')
+    bnd = N.unique(N.concatenate([[0], bnd, [len(df)]]))
+    return [df.iloc[s:e] for s,e in zip(bnd[:-1], bnd[1:]) if e>s]
+
 def mp_worker(args):
     func, arg = args
     return func(*arg)
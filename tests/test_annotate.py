@@ -1,4 +1,5 @@
 import os
+import shutil
 import logging
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
@@ -43,3 +44,81 @@ def test_comparator(datadir, outdir, mergedsjexbase, g4sjexprefix):
 	idx = ex1['gen4_sym0'].astype(str).str.contains(',')
 	assert N.sum(idx)==0 
 
+
+def _write_models(pre, ex, sj):
+	UT.write_pandas(PD.DataFrame(ex, columns=['chr','st','ed','strand','cat','_id','gene_id','gene_name','_gidx']), pre+'.ex.txt.gz', 'h')
+	UT.write_pandas(PD.DataFrame(sj, columns=['chr','st','ed','strand','_gidx']), pre+'.sj.txt.gz', 'h')
+
+@pytest.fixture
+def refindex_models(tmpdir):
+	ref = str(tmpdir.join('ref'))
+	tgt = str(tmpdir.join('tgt'))
+	_write_models(ref, [
+		['chr1',100,200,'+','5',1,'G1','Aa',10], ['chr1',300,400,'+','3',2,'G1','Aa',10],
+		['chr1',1000,1100,'-','3',3,'G2','Bb',20], ['chr1',1200,1300,'-','5',4,'G2','Bb',20],
+		['chr1',380,500,'+','s',5,'G4','Dd',40], # closest to tgt exon 2
+		['chr2',500,800,'+','s',6,'G3','Cc',30]],
+		[['chr1',200,300,'+',10], ['chr1',1100,1200,'-',20]])
+	_write_models(tgt, [
+		['chr1',150,200,'+','5',1,'',0,1], ['chr1',300,420,'+','3',2,'',0,1],
+		['chr1',1050,1100,'+','5',3,'',0,2], ['chr1',1250,1350,'+','3',4,'',0,2],
+		['chr2',600,700,'.','s',5,'',0,3],
+		['chr3',10,50,'+','5',6,'',0,4], ['chr3',80,90,'+','3',7,'',0,4]],
+		[['chr1',200,300,'+',1], ['chr1',1100,1250,'+',2], ['chr3',50,80,'+',4]])
+	return ref, tgt, str(tmpdir)
+
+def _annotate(ref, tgt, outdir, refindex=None):
+	cref = AN.ComparatorNames(ref, 'ref', outdir)
+	ctgt = AN.ComparatorNames(tgt, 'tgt', outdir)
+	cp = AN.Comparator(cref, ctgt, 'gene_name', 'gene_id', refindex=refindex)
+	cp.annotate(save=False)
+	return cp.ex_tgt, cp.sj_tgt
+
+ANCOLS = ['etcode_ref','gtcode_ref','eknown_ref','gknown_ref','intergenic_ref','ex_as_ovl_ref',
+		  'gene_as_ovl_ref','ref_gidxs','ref_gidx0','ref_syms','ref_sym0']
+
+def test_refindex_comparator(refindex_models):
+	ref, tgt, outdir = refindex_models
+	cref = AN.ComparatorNames(ref, 'ref', outdir)
+	ex, sj = _annotate(ref, tgt, outdir, AN.RefIndex.from_model(cref.model('ex'), cref.model('sj')))
+	ex = ex.set_index('_id')
+	assert list(ex['etcode_ref']) == ['k.me','k.me','u.me','u.me','k.se','u.me','u.me']
+	assert list(ex['gtcode_ref']) == ['k.me','k.me','u.me','u.me','k.se','u.me','u.me']
+	assert list(ex['intergenic_ref']) == ['n','n','n','n','n','y','y']
+	assert list(ex['gene_as_ovl_ref']) == ['n','n','y','y','n','n','n']
+	assert set(ex.loc[1,'ref_gidxs'].split(',')) == set(['G1','G4'])
+	assert ex.loc[5,'ref_gidx0'] == 'G3'
+	assert set(ex.loc[1,'ref_syms'].split(',')) == set(['Aa','Dd'])
+	assert ex.loc[5,'ref_sym0'] == 'Cc'
+	assert list(sj['etcode_ref']) == ['k.me','u.me','u.me']
+	assert list(sj['gtcode_ref']) == ['k.me','u.me','u.me']
+	if shutil.which('bedtools') is None:
+		pytest.skip('bedtools not found')
+	ex0, sj0 = _annotate(ref, tgt, outdir)
+	ex0 = ex0.set_index('_id')
+	for c in ANCOLS:
+		assert list(ex0[c].astype(str)) == list(ex[c].astype(str)), c
+	assert list(sj0['etcode_ref']) == list(sj['etcode_ref'])
+	assert list(sj0['gtcode_ref']) == list(sj['gtcode_ref'])
+
+def test_refindex_get(refindex_models):
+	ref, tgt, outdir = refindex_models
+	cref = AN.ComparatorNames(ref, 'ref', outdir)
+	ri = AN.RefIndex.get(cref)
+	assert sorted(ri.g2s.index) == ['G1','G2','G3','G4']
+	# different columns => different index
+	ri = AN.RefIndex.get(AN.ComparatorNames(ref, 'ref', outdir), 'gene_name', '_gidx')
+	assert sorted(ri.g2s.index) == [10,20,30,40]
+	ri = AN.RefIndex.get(AN.ComparatorNames(ref, 'ref', outdir))
+	assert ri.g2s['G1'] == ['Aa']
+	# reference rebuilt => index rebuilt
+	ex = UT.read_pandas(ref+'.ex.txt.gz')
+	ex.loc[ex['gene_id']=='G1','gene_name'] = 'Aa2'
+	UT.write_pandas(ex, ref+'.ex.txt.gz', 'h')
+	prefix = cref.fname('refidx.gene_id.gene_name', category='output')
+	for x in os.listdir(outdir):
+		if x.startswith('ref.refidx'):
+			os.utime(os.path.join(outdir, x), (0,0))
+	ri = AN.RefIndex.get(AN.ComparatorNames(ref, 'ref', outdir))
+	assert ri.g2s['G1'] == ['Aa2']
+	assert os.path.getmtime(prefix+'.sj.txt.gz') > 0
@@ -0,0 +1,330 @@
+import pytest
+import numpy as N
+import pandas as PD
+
+from jgem import assembler3 as AS3
+from jgem import utils as UT
+
+
+def _se_sample(seed, csize=1000, nex=6):
+	rs = N.random.RandomState(seed)
+	# coverage with runs of zeros, positive up to the chromosome end
+	cov = N.repeat(rs.randint(0, 3, csize//10), 10).astype(N.float32)
+	cov *= rs.rand(csize).astype(N.float32)+0.5
+	cov[-25:] = 2.5
+	st = N.sort(rs.randint(0, csize-100, nex))
+	ed = st + rs.randint(10, 80, nex)
+	return cov, st, ed
+
+def _segments_ref(cov, st, ed, minsizeth):
+	# previous implementation: dense whole chromosome mask
+	exa = cov.copy()
+	for s,e in zip(st, ed):
+		exa[s:e] = 0
+	idx = N.nonzero(exa>0)[0]
+	dif = idx[1:]-idx[:-1]
+	idx2 = N.nonzero(dif>1)[0]
+	idxst = N.array([idx[0]]+list(idx[idx2+1]))
+	idxed = N.array(list(idx[idx2])+[idx[-1]])
+	gsize = idxed - idxst + 1
+	idx3 = N.nonzero(gsize>minsizeth)[0]
+	sst = idxst[idx3]
+	sed = sst + gsize[idx3]
+	return sst, sed, N.array([N.mean(exa[x:y]) for x,y in zip(sst,sed)])
+
+def test_interval_mask():
+	st, ed = N.array([3, 8, 15, 25]), N.array([6, 12, 30, 27])
+	a = N.zeros(40, dtype=bool)
+	for s,e in zip(st, ed):
+		a[s:e] = True
+	for wst, wed in [(0,40), (5,20), (10,11), (28,40)]:
+		assert list(AS3.interval_mask(st, ed, wst, wed)) == list(a[wst:wed])
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@pytest.mark.parametrize('winsize', [37, 100, 5000])
+def test_positive_segments(seed, winsize):
+	cov, st, ed = _se_sample(seed)
+	csize = len(cov)
+	sst, sed, ecov = AS3.positive_segments(lambda s,e: cov[s:e].copy(), st, ed, csize, winsize)
+	rst, red, recov = _segments_ref(cov, st, ed, 0)
+	assert list(sst) == list(rst)
+	assert list(sed) == list(red)
+	assert ecov.dtype == cov.dtype
+	assert N.allclose(ecov, recov)
+	assert sed[-1] == csize
+	# segments crossing window boundaries
+	if winsize < csize:
+		assert any((s//winsize)!=((e-1)//winsize) for s,e in zip(sst, sed))
+
+class _BW(object):
+	def __init__(self, cov):
+		self.cov = cov
+
+	def get(self, chrom, st, ed):
+		return self.cov[chrom][st:ed].copy()
+
+class _SjExBigWigs(object):
+	covs = {}
+
+	def __init__(self, bwpre):
+		self.bws = {'ex': {s:_BW(c) for s,c in self.covs.items()}}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		pass
+
+@pytest.mark.parametrize('winsize', [37, 211])
+def test_find_SE_chrom(tmpdir, monkeypatch, winsize):
+	csize, minsizeth = 1000, 20
+	covp, st, ed = _se_sample(0, csize)
+	covn = _se_sample(1, csize)[0]
+	_SjExBigWigs.covs = {'+': {'chr1': covp}, '-': {'chr1': covn}}
+	monkeypatch.setattr(AS3, 'SjExBigWigs', _SjExBigWigs)
+	monkeypatch.setattr(UT, 'chromdf', lambda g: PD.DataFrame({'chr':['chr1'],'size':[csize]}))
+	dstpre = str(tmpdir.join('se'))
+	exdf = PD.DataFrame({'chr':'chr1','st':st,'ed':ed,'strand':'+','name':'x','kind':'i','ecov':1.})
+	UT.write_pandas(exdf[AS3.EXDFCOLS], dstpre+'.chr1.exdf.txt.gz', '')
+	path = AS3.find_SE_chrom('bw', dstpre, 'g', 'chr1', ['+','-'], minsizeth, winsize)
+	df = UT.read_pandas(path, names=['chr','st','ed','ecov','len'])
+	recs = []
+	for c in [covp, covn]:
+		rst, red, recov = _segments_ref(c, st, ed, minsizeth)
+		recs.append(PD.DataFrame({'st':rst,'ed':red,'ecov':recov}))
+	ref = PD.concat(recs, ignore_index=True).groupby(['st','ed']).first().reset_index()
+	assert len(df) > 2
+	assert list(df['st']) == list(ref['st'])
+	assert list(df['ed']) == list(ref['ed'])
+	assert list(df['len']) == list(ref['ed']-ref['st'])
+	assert N.allclose(df['ecov'], ref['ecov'], atol=1e-4)
+	assert df['ed'].max() == csize
+
+def _gaps_ref(arr, gsizeth, bsize, sjth):
+	# previous implementation: gaps within windows of bsize
+	sts, eds = [], []
+	csize = len(arr)
+	for i in range(int(N.ceil(csize/float(bsize)))):
+		st = i*bsize
+		ed = min((i+1)*bsize, csize)
+		idx = N.nonzero(arr[st:ed]<=sjth)[0]
+		if len(idx)==0:
+			continue
+		dif = idx[1:]-idx[:-1]
+		idx2 = N.nonzero(dif>1)[0]
+		gsize = idx[idx2[1:]]-idx[idx2[:-1]+1]
+		idx3 = N.nonzero(gsize>gsizeth)[0]
+		sts += list(idx[idx2[idx3]+1]+st)
+		eds += list(idx[idx2[idx3+1]]+st)
+	return sts, eds
+
+def _runs(a):
+	bp = N.nonzero(N.diff(N.concatenate([[0.], a, [0.]]))!=0)[0]
+	st, ed = bp[:-1], bp[1:]
+	idx = a[st]!=0
+	return st[idx], ed[idx], a[st][idx]
+
+@pytest.mark.parametrize('sjth', [0, 0.5])
+def test_find_gaps(tmpdir, monkeypatch, sjth):
+	csize, gsizeth, minbundlesize = 1000, 20, 250
+	p, n = N.zeros(csize), N.zeros(csize)
+	# no coverage at the chromosome start [0,30) and end [960,1000)
+	p[30:100], p[300:480], p[530:600], p[800:960] = 1, 2, 1, 1
+	n[90:150], n[200:260], n[700:720] = 0.5, 1, 0.5
+	bwpre, sjbwpre = str(tmpdir.join('bw')), str(tmpdir.join('sj'))
+	arrs = {sjbwpre+'.sj.p.bw': p, sjbwpre+'.sj.n.bw': n, 
+			bwpre+'.sj.p.bw': N.ones(csize), bwpre+'.ex.p.bw': N.ones(csize)}
+	for x in arrs:
+		open(x,'w').close()
+	monkeypatch.setattr(AS3.BW, 'get_bigwig_intervals', lambda x,c,s,e: _runs(arrs[x]))
+	gst, ged = AS3.find_gaps(bwpre, 'chr1', csize, gsizeth, minbundlesize, sjbwpre, sjth)
+	# old implementation with one window for the whole chromosome
+	rst, red = _gaps_ref(p+n, gsizeth, csize, sjth)
+	assert gst == rst
+	assert ged == red
+	if sjth==0:
+		assert list(zip(gst, ged)) == [(150,199),(260,299),(480,529),(600,699),(720,799)]
+	else:
+		assert list(zip(gst, ged)) == [(100,199),(260,299),(480,529),(600,799)]
+	# the gap straddling the old window boundary (2*minbundlesize) was missed
+	ost, oed = _gaps_ref(p+n, gsizeth, 2*minbundlesize, sjth)
+	assert 480 not in ost
+	assert [x for x in zip(gst, ged) if x[0]!=480] == list(zip(ost, oed))
+	# bwpre only (sj coverage everywhere)
+	assert AS3.find_gaps(bwpre, 'chr1', csize, gsizeth, minbundlesize, None, sjth) == ([], [])
+
+class _GG(object):
+	# minimal GeneGraph: exon => junctions, junction => exons, exon => exons
+	def __init__(self, sjs):
+		self.edj, self.jae, self.ede = {}, {}, {}
+		self._sjs = sjs
+		for sid, (d, a, p) in enumerate(sjs):
+			self.edj.setdefault(d, []).append(sid)
+			self.jae[sid] = [a]
+			self.ede.setdefault(d, []).append(a)
+
+	def sjs(self, e):
+		return [(j, self._sjs[j]) for j in self.edj.get(e, [])]
+
+def _pathgen(e0name, sjnames):
+	# 5'exons e0, e1 => e2 => (e3 => e4 or e5) or e4
+	enames = [e0name, '600,662', '812,900', '1000,1100', '1200,1300', '1400,1500']
+	kinds = ['5','5','i','i','3','3']
+	sjs = [(0,2,1.), (1,2,1.), (2,3,0.6), (2,4,0.4), (3,4,0.5), (3,5,0.5)]
+	gexdf = PD.DataFrame({'eid':range(6), 'name':enames, 'kind':kinds, 'gid':1, 'id53':0,
+		'chr':'chr1', 'strand':'+', 'tst':10, 'ted':1500, 'pa':1., 'pd':1., 
+		'tcov0':[10.,20.,30.,20.,20.,20.], 'tcov0a':1., 'tcov0b':1., 'tcov0c':1.})
+	gexdf['st'] = [int(x.split(',')[0]) for x in enames]
+	gexdf['ed'] = [int(x.split(',')[1]) for x in enames]
+	gexdf['apos'] = gexdf['st']
+	gexdf['dpos'] = gexdf['ed']
+	jnames = ['{0}|{1}'.format(enames[d].split(',')[1], enames[a].split(',')[0]) for d,a,p in sjs]
+	gsjdf = PD.DataFrame({'sid':range(len(sjs)), 'id53':0, 'p':[x[2] for x in sjs], 'name':jnames})
+	sjpaths = PD.DataFrame({'name':sjnames, 'chr':'chr1', 'strand':'+', 'tst':10, 'ted':1500,
+		'st':10, 'ed':1500, 'sjratio':0.1, 'sc1':1., 'sc2':1.})
+	preselected = PD.DataFrame([], columns=AS3.PATHCOLS)
+	return AS3.PathGenerator(_GG(sjs), gsjdf, gexdf, 'chr1', '+', sjpaths, preselected)
+
+def _select_ref(pg, tcovth, tcovfactor):
+	# previous implementation: substring match of sjpaths in path names
+	sjp = pg.sjpaths
+	npos = AS3.PATHCOLS.index('name')
+	tpos = AS3.PATHCOLS.index('tcov')
+	sjnames = list(sjp['name'].values)
+	nsj = len(sjnames)
+	z = N.zeros(nsj)
+	sjidx = {}
+	for x in pg.pg53s:
+		sjp0 = sjp[(sjp['tst']>=x.e5['tst'])&(sjp['ted']<=x.e5['ted'])]
+		sjidx[x.pgid] = [sjnames.index(y) for y in sjp0['name']]
+	paths = []
+	cscore = 0
+	for p in pg.paths_from_highest_cov(tcovth, tcovfactor):
+		if p[tpos]>=pg.tcovth1:
+			paths.append(p[:-1])
+			for i,sjn in enumerate(sjnames):
+				if z[i]==0:
+					z[i] += (sjn in p[npos])
+			cscore = N.sum(z>0)
+		elif p[tpos]>=pg.tcovth2:
+			if cscore==nsj:
+				break
+			for i,sjn in enumerate(sjnames):
+				if z[i]==0:
+					z[i] += (sjn in p[npos])
+			cscore1 = N.sum(z>0)
+			if cscore1>cscore:
+				paths.append(p[:-1])
+				cscore = cscore1
+		else:
+			break
+		for x in pg.pg53s:
+			if not x.disable:
+				if N.sum([z[i] for i in sjidx[x.pgid]]) == len(sjidx[x.pgid]):
+					x.disable = True
+	return sorted(p[npos] for p in paths)
+
+P1 = '600,662|812,900|1200,1300'
+P2 = '600,662|812,900|1000,1100|1200,1300'
+P3 = '600,662|812,900|1000,1100|1400,1500'
+
+def test_sjpathcover():
+	cover = AS3.SJPathCover(['62|812', '662|812,900|1200', '900|1000,1100|1400', '900|1200'])
+	assert list(cover.add(P1)) == [1, 3]
+	assert list(cover.add(P1)) == []
+	assert list(cover.add(P2)) == [] # not contiguous, '62|812' not a junction of P2
+	assert not cover.complete()
+	assert list(cover.add(P3)) == [2]
+	assert list(cover.add('10,62|812,900')) == [0]
+	assert cover.complete()
+
+@pytest.mark.parametrize('e0', ['10,61', '10,62'])
+def test_select_paths(e0):
+	j0 = e0.split(',')[1]+'|812'
+	sjnames = [j0, '662|812,900|1200', '900|1000,1100|1400', j0+',900|1000']
+	df = _pathgen(e0, sjnames).select_paths(tcovth=1, tcovfactor=0.5)
+	ref = _select_ref(_pathgen(e0, sjnames), 1, 0.5)
+	P4 = e0+'|812,900|1200,1300'
+	P5 = e0+'|812,900|1000,1100|1200,1300'
+	assert sorted(df['name']) == sorted([P1, P3, P4, P5])
+	t = dict(zip(df['name'], df['tcov']))
+	assert N.allclose([t[P1], t[P3], t[P4], t[P5]], [8., 6., 4., 3.])
+	if e0=='10,61':
+		assert sorted(df['name']) == ref
+	else:
+		# '62|812' matched '662|812' in P1, '62|812,900|1000' matched P2
+		assert ref == sorted([P1, P2, P3])
+
+def _pg53(seed, n=12, maxqueue=200000):
+	# random DAG from 5'exon 0, branch probabilities <= 1
+	rs = N.random.RandomState(seed)
+	sjs = []
+	for d in range(n-1):
+		for a in sorted(rs.choice(range(d+1, n), min(3, n-d-1), replace=False)):
+			sjs.append((d, a, rs.rand()))
+	enames = ['{0},{1}'.format(100*i, 100*i+50) for i in range(n)]
+	kinds = ['5']+['i']*(n-3)+['3','3']
+	gexdf = PD.DataFrame({'eid':range(n), 'name':enames, 'kind':kinds, 'gid':1, 'id53':0,
+		'chr':'chr1', 'strand':'+', 'tst':0, 'ted':100*n, 'pa':rs.rand(n), 'pd':1.,
+		'tcov0':100., 'tcov0a':1., 'tcov0b':1., 'tcov0c':1.})
+	gsjdf = PD.DataFrame({'sid':range(len(sjs)), 'id53':0, 'p':[x[2] for x in sjs]})
+	gg = _GG(sjs)
+	return AS3.PathGenerator53(gexdf.iloc[0], gg, gexdf, gsjdf, 0, '+', maxqueue=maxqueue), gg, gexdf
+
+def _paths_ref(gg, gexdf, vmin=0):
+	# exhaustive enumeration: (name, tcov) of all paths from the 5'exon
+	e2p = dict(zip(gexdf['eid'], gexdf['pa']))
+	name = dict(zip(gexdf['eid'], gexdf['name']))
+	kind = dict(zip(gexdf['eid'], gexdf['kind']))
+	paths = []
+	def _walk(e, pre, v):
+		pre = pre+[name[e]]
+		if kind[e]=='3' or len(gg.edj.get(e,[]))==0:
+			paths.append(('|'.join(pre), v))
+			return
+		for j, (d, a, p) in gg.sjs(e):
+			_walk(a, pre, v*p*e2p[a])
+	_walk(0, [], gexdf['tcov0'].values[0]*gexdf['pd'].values[0])
+	return sorted([x for x in paths if x[1]>0 and x[1]>=vmin])
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+def test_best_first(seed):
+	pg, gg, gexdf = _pg53(seed)
+	npos, tpos = AS3.PATHCOLS.index('name'), AS3.PATHCOLS.index('tcov')
+	full = list(pg.best_first())
+	tcovs = [x[tpos] for x in full]
+	assert all(x>=y for x,y in zip(tcovs[:-1], tcovs[1:]))
+	assert all(x[-1]==0 for x in full)
+	ref = _paths_ref(gg, gexdf)
+	assert len(ref) > 10
+	assert sorted(x[npos] for x in full) == [x[0] for x in ref]
+	assert N.allclose(sorted(tcovs), sorted(x[1] for x in ref))
+	# vmin cuts the output at tcov>=vmin
+	vmin = tcovs[len(tcovs)//3]
+	cut = list(pg.best_first(vmin))
+	assert sorted(x[npos] for x in cut) == [x[0] for x in _paths_ref(gg, gexdf, vmin)]
+	assert [x[npos] for x in cut] == [x[npos] for x in full[:len(cut)]]
+	assert list(pg.best_first(1000.)) == []
+	# maxqueue disables the unit, paths until then are the same
+	pg2 = _pg53(seed, maxqueue=3)[0]
+	short = list(pg2.best_first())
+	assert pg2.disable
+	assert len(short) < len(full)
+	assert [x[npos] for x in short] == [x[npos] for x in full[:len(short)]]
+
+def test_paths_from_highest_cov():
+	sjnames = ['61|812']
+	pg = _pathgen('10,61', sjnames)
+	npos, tpos = AS3.PATHCOLS.index('name'), AS3.PATHCOLS.index('tcov')
+	paths = list(pg.paths_from_highest_cov(tcovth=1, tcovfactor=0.5))
+	assert (pg.tcovth1, pg.tcovth2) == (15., 1)
+	tcovs = [x[tpos] for x in paths]
+	assert all(x>=y for x,y in zip(tcovs[:-1], tcovs[1:]))
+	assert N.allclose(tcovs, [8,6,6,4,3,3])
+	assert sorted(x[-1] for x in paths) == [0,0,0,1,1,1]
+	# tcovth2 prunes, disabled units are skipped
+	pg = _pathgen('10,61', sjnames)
+	assert len(list(pg.paths_from_highest_cov(tcovth=5, tcovfactor=0.15))) == 3
+	pg = _pathgen('10,61', sjnames)
+	pg.pg53s[1].disable = True
+	assert N.allclose([x[tpos] for x in pg.paths_from_highest_cov(1, 0.5)], [4,3,3])
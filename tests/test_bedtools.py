@@ -1,9 +1,12 @@
 
 import os
+import shutil
 import pytest
+import pandas as PD
 
 from jgem import bedtools as BT
 from jgem import gtfgffbed as GGB
+from jgem import utils as UT
 import gzip
 
 
@@ -136,6 +139,48 @@ chr1	30	40
 	cdata = open(c1).read()
 	assert cdata == odata
 
+IICOLS = ['chr','st','ed','cat','_id','cov']
+IIREF = """1	10	20	i	1	1.5
+1	50	60	5	2	2.0
+2	10	30	s	3	3.0
+"""
+IIQ = """1	15	55	i	7	0.5
+1	100	110	i	8	0.1
+3	0	10	s	9	0.2
+"""
+# bedtools intersect -a q -b ref -wao
+IIWAO = """1	15	55	i	7	0.5	1	10	20	i	1	1.5	5
+1	15	55	i	7	0.5	1	50	60	5	2	2.0	5
+1	100	110	i	8	0.1	.	-1	-1	.	.	.	0
+3	0	10	s	9	0.2	.	-1	-1	.	.	.	0
+"""
+
+def test_IntervalIndex(tmpdir):
+	ocols = IICOLS+['b_'+x for x in IICOLS]+['ovl']
+	a = tmpdir.join('q.bed')
+	a.write(IIQ)
+	b = tmpdir.join('ref.bed')
+	b.write(IIREF)
+	c = tmpdir.join('wao.txt')
+	c.write(IIWAO)
+	ref = UT.read_pandas(str(b), names=IICOLS, dtype={'chr':str})
+	q = UT.read_pandas(str(a), names=IICOLS, dtype={'chr':str})
+	exp = UT.read_pandas(str(c), names=ocols, dtype={'chr':str,'b_chr':str})
+	idx = BT.IntervalIndex(ref)
+	PD.testing.assert_frame_equal(idx.wao(q, side='b'), exp)
+	# saved index keeps chromosome names as str
+	path = idx.save(str(tmpdir.join('idx.txt.gz')))
+	idx2 = BT.IntervalIndex.load(path)
+	PD.testing.assert_frame_equal(idx2.wao(q, side='b'), exp)
+	# this index as -a
+	qidx = BT.IntervalIndex(q)
+	ov = qidx.wao(ref, side='a')
+	assert list(ov['ovl']) == [5,5,0,0]
+	assert list(ov['b_st']) == [10,50,-1,-1]
+	if shutil.which('bedtools') is not None:
+		d = BT.bedtoolintersect(str(a),str(b),str(tmpdir.join('wao2.txt')),wao=True)
+		assert open(d).read() == IIWAO
+
 def test_calcovlratio(tmpdir):
 	adata = """chr1	10	20
 chr1	30	40
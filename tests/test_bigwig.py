@@ -65,3 +65,86 @@ def test_bw2bed_mp(bigwig,outdir):
 def test_get_totbp_covbp_bw(bigwig):
 	cdf = BW.get_totbp_covbp_bw(bigwig, 'mm10')
 	
+
+def test_intervals2runs(tmpdir):
+	st = N.array([0,5,20,25,40])
+	ed = N.array([10,15,25,30,45])
+	val = N.array([1.,2.,1.,1.,0.])
+	rst, red, rval = BW.intervals2runs(st, ed, val)
+	assert list(rst) == [0,5,10,20]
+	assert list(red) == [5,10,15,30]
+	assert list(rval) == [1.,3.,2.,1.]
+	# same output as dense array version
+	a = N.zeros(50)
+	for s,e,v in zip(st,ed,val):
+		a[s:e] += v
+	wig1 = os.path.join(str(tmpdir), 'test3.wig')
+	wig2 = os.path.join(str(tmpdir), 'test4.wig')
+	BW.array2wiggle_chr(N.array(a,dtype=N.float32), 'chr1', wig1)
+	BW.runs2wiggle_chr(rst, red, rval, 'chr1', wig2)
+	assert open(wig1).read() == open(wig2).read()
+
+def test_intervals2runs_overlaps():
+	# more than two overlapping intervals, cumsum residues
+	st = N.array([27,11,39,22,1,39])
+	ed = N.array([39,18,40,33,2,42])
+	val = N.array([0.3,0.9,0.2,0.4,0.5,0.1])
+	rst, red, rval = BW.intervals2runs(st, ed, val)
+	a = N.zeros(50)
+	for s,e,v in zip(st,ed,val):
+		a[s:e] += v
+	b = N.zeros(50)
+	for s,e,v in zip(rst,red,rval):
+		b[s:e] = v
+	assert N.allclose(a, b, rtol=1e-9, atol=0)
+	# adjacent runs have different values (merged)
+	adj = red[:-1]==rst[1:]
+	assert (rval[:-1][adj]!=rval[1:][adj]).all()
+	assert list(rst) == [1,11,22,27,33,40] # [33,39) and [39,40) are both 0.3
+	assert list(red) == [2,18,27,33,40,42]
+	# random intervals against dense sum
+	rs = N.random.RandomState(0)
+	for i in range(100):
+		st = rs.randint(0,1000,50)
+		ed = st+rs.randint(1,200,50)
+		val = rs.randint(1,100,50)/10.
+		rst, red, rval = BW.intervals2runs(st, ed, val)
+		a = N.zeros(1200)
+		for s,e,v in zip(st,ed,val):
+			a[s:e] += v
+		b = N.zeros(1200)
+		for s,e,v in zip(rst,red,rval):
+			b[s:e] = v
+		assert N.allclose(a, b, rtol=1e-9, atol=0)
+		adj = red[:-1]==rst[1:]
+		assert (rval[:-1][adj]!=rval[1:][adj]).all()
+
+def _runs(a):
+	# dense array => (st, ed, val) of constant non-zero intervals
+	bp = N.nonzero(N.diff(N.concatenate([[0.], a, [0.]]))!=0)[0]
+	st, ed = bp[:-1], bp[1:]
+	val = a[st]
+	idx = val!=0
+	return st[idx], ed[idx], val[idx]
+
+def test_covered_runs(tmpdir, monkeypatch):
+	rs = N.random.RandomState(0)
+	arrs = {}
+	for i in range(3):
+		a = N.repeat(rs.randint(0, 4, 100), rs.randint(5, 20, 100))/2.
+		arrs[str(tmpdir.join('s%d.bw' % i))] = a[:500]
+	for p in arrs:
+		open(p,'w').close()
+	monkeypatch.setattr(BW, 'get_bigwig_intervals', lambda p,c,s,e: _runs(arrs[p]))
+	paths = list(arrs) + [str(tmpdir.join('none.bw'))]
+	tot = N.sum(list(arrs.values()), axis=0)
+	for th in [0, 0.5, 2]:
+		st, ed = BW.covered_runs(paths, 'chr1', 500, th)
+		b = N.zeros(500, dtype=bool)
+		for s,e in zip(st,ed):
+			assert not b[s:e].any() # non-overlapping
+			b[s:e] = True
+		assert (b == (tot>th)).all()
+		assert (st[1:]>=ed[:-1]).all()
+	st, ed = BW.covered_runs(paths[-1:], 'chr1', 500)
+	assert len(st) == len(ed) == 0
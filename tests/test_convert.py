@@ -1,6 +1,9 @@
 import os
+import shutil
 import pytest
 import logging
+import numpy as N
+import pandas as PD
 logging.basicConfig(level=logging.DEBUG)
 LOG = logging.getLogger(__name__)
 
@@ -64,3 +67,90 @@ def test_gtf2sjex2(g4gtfpath, outdir):
 	assert len(ci) == 28776
 
 
+
+
+GTFROWS = [
+	# chr, typ, st, ed, strand, gene_id, transcript_id
+	('chr1','exon',101,200,'+','g1','t1'),
+	('chr1','exon',501,600,'+','g1','t1'),
+	('chr1','exon',301,400,'+','g1','t1'),
+	('chr1','CDS',321,400,'+','g1','t1'),
+	('chr1','exon',101,200,'+','g1','t2'),
+	('chr1','exon',501,650,'+','g1','t2'),
+	('chr1','exon',1201,1300,'-','g2','t3'),
+	('chr1','exon',1001,1100,'-','g2','t3'),
+	('chr1','exon',1401,1500,'-','g2','t5'),
+	('chr1','exon',1201,1300,'-','g2','t5'),
+	('chr1','exon',1001,1100,'-','g2','t5'),
+	('chr2','exon',51,90,'+','g3','t4'),
+]
+
+def _exsj_ref(exons):
+	# previous groupby based kinds and junctions
+	exons = exons.sort_values(['transcript_id','st','ed'])
+	ex_s = exons.groupby('transcript_id').size()
+	tid_s = ex_s[ex_s==1].index
+	ex_m = exons[exons['transcript_id'].isin(ex_s[ex_s>1].index)]
+	ex_f = ex_m.groupby('transcript_id').first()
+	ex_l = ex_m.groupby('transcript_id').last()
+	i5 = list(ex_f[ex_f['strand']=='+']['_id'])+list(ex_l[ex_l['strand']=='-']['_id'])
+	i3 = list(ex_f[ex_f['strand']=='-']['_id'])+list(ex_l[ex_l['strand']=='+']['_id'])
+	exons['kind'] = 'i'
+	exons.loc[exons['transcript_id'].isin(tid_s),'kind'] = 's'
+	exons.loc[exons['_id'].isin(i5),'kind'] = '5'
+	exons.loc[exons['_id'].isin(i3),'kind'] = '3'
+	sjs = []
+	for k, g in exons.groupby('transcript_id'):
+		if len(g)<2:
+			continue
+		g = g.sort_values(['st','ed'])
+		chrom,strand,gid = g.iloc[0][['chr','strand','gene_id']]
+		for st,ed in zip(g['ed'].values[:-1]+1, g['st'].values[1:]-1):
+			sjs.append((chrom,st,ed,gid,strand))
+	exs = set((c,st-1,ed,strand,gid,kind) for c,st,ed,strand,gid,kind in 
+			  exons[['chr','st','ed','strand','gene_id','kind']].values)
+	return exs, set(sjs)
+
+@pytest.mark.skipif(shutil.which('bedtools') is None, reason='bedtools not found')
+def test_gtf2exonsj_vectorized(tmpdir):
+	gtf = PD.DataFrame(GTFROWS, columns=['chr','typ','st','ed','strand','gene_id','transcript_id'])
+	sj, ex = CV.gtf2exonsj(gtf, np=1, graphpre=str(tmpdir.join('g_')))
+	exons = gtf[gtf['typ']=='exon'].sort_values(['chr','st','ed'])
+	exons['_id'] = N.arange(len(exons))
+	exs, sjs = _exsj_ref(exons)
+	assert set(tuple(x) for x in ex[['chr','st','ed','strand','name','kind']].values) == exs
+	assert set(tuple(x) for x in sj[['chr','st','ed','name','strand']].values) == sjs
+	assert len(sj) == len(sjs)
+	assert list(ex['_pid']) == list(ex.groupby(['chr','st','ed']).ngroup())
+	assert ex['_gidx'].nunique() == 3
+
+def test_blocks2exsj():
+	rs = N.random.RandomState(0)
+	recs = []
+	for i in range(100):
+		ne = rs.randint(1, 6)
+		pos = N.sort(rs.choice(N.arange(100, 5000), 2*ne, replace=False))
+		recs.append(('chr%d' % (i%2), 't%d' % i, '+-'[i%2], pos[::2], pos[1::2]))
+	df = PD.DataFrame(recs, columns=['chr','name','strand','est','eed'])
+	idx = N.repeat(N.arange(len(df)), [len(x) for x in df['est']])
+	st = N.concatenate(df['est'].values)
+	ed = N.concatenate(df['eed'].values)
+	ex, sj = CV._blocks2exsj(df, idx, st, ed)
+	# previous generators (single exons with their own coordinates)
+	ex0, sj0 = [], []
+	for chrom,tname,strand,est,eed in df.values:
+		n = len(est)
+		for k,(s,e) in enumerate(zip(est,eed)):
+			if n==1:
+				kind = 's'
+			elif k==0:
+				kind = '5' if strand=='+' else '3'
+			elif k==n-1:
+				kind = '3' if strand=='+' else '5'
+			else:
+				kind = 'i'
+			ex0.append([chrom,s,e,tname,0,strand,kind])
+		for s,e in zip(eed[:-1],est[1:]):
+			sj0.append([chrom,s+1,e,tname,0,strand,'j'])
+	assert ex.values.tolist() == ex0
+	assert sj.values.tolist() == sj0
@@ -0,0 +1,98 @@
+import pytest
+import numpy as N
+import pandas as PD
+
+FP = pytest.importorskip('jgem.findparams')
+
+
+def _sample(strand, n=40, win=30, seed=0):
+	rs = N.random.RandomState(seed)
+	size = 3000
+	# coverage with runs of zeros
+	a = rs.randint(0, 4, size).astype(float)*(rs.rand(size)>0.2)
+	b = rs.randint(0, 3, size).astype(float)
+	st = N.sort(rs.randint(win+20, size-win-200, n))
+	ed = st + rs.randint(15, 150, n)
+	ex = PD.DataFrame({'_id':N.arange(n), 'chr':'chr1', 'st':st, 'ed':ed, 'strand':strand})
+	return ex, a, b
+
+def _params_ref(ex, a, b, bst, strand, win, siz, direction, gapmode, covfactor):
+	# previous per exon implementation
+	recs = []
+	for chrom,st,ed,_id in ex[['chr','st','ed','_id']].values:
+		left = st-win
+		a1 = a[left-bst:ed+win-bst]
+		b1 = b[left-bst:ed+win-bst]
+		stpos, edpos = st-left, ed-left
+		exl10 = N.mean(a1[stpos:stpos+siz])
+		sjl10 = N.mean(b1[stpos-siz:stpos])
+		exr10 = N.mean(a1[edpos-siz:edpos])
+		sjr10 = N.mean(b1[edpos:edpos+siz])
+		sdifl = b1[stpos]-b1[stpos-1]
+		sdifr = b1[edpos]-b1[edpos-1]
+		exmax = N.max(a1[stpos:edpos])
+		exmin = N.min(a1[stpos:edpos])
+		if gapmode=='i':
+			gapth = exmax*covfactor
+		elif direction=='>':
+			gapth = exl10*covfactor
+		else:
+			gapth = exr10*covfactor
+		if ((direction=='>')&(strand=='+'))|((direction!='>')&(strand=='-')):
+			gap = FP.find_maxgap(a1[stpos:edpos],exmin, exmax, gapth, win, gapmode)
+		else:
+			gap = FP.find_maxgap(a1[stpos:edpos][::-1],exmin, exmax, gapth, win, gapmode)
+		maxl, minl = N.max(a1[:stpos]), N.min(a1[:stpos])
+		maxr, minr = N.max(a1[edpos:]), N.min(a1[edpos:])
+		gapl,posl = FP.find_firstgap(a1[:stpos][::-1],minl,maxl,gapth,win)
+		gapr,posr = FP.find_firstgap(a1[edpos:],minr,maxr,gapth,win)
+		mp = float(N.sum(a1[stpos:edpos]>gapth))/(ed-st)
+		if strand=='+':
+			rec = [_id,exmax,exmin,maxl,minl,gapl,posl,maxr,minr,gapr,posr,
+				   exl10,sjl10,sdifl,exr10,sjr10,sdifr]
+		else:
+			rec = [_id,exmax,exmin,maxr,minr,gapr,posr,maxl,minl,gapl,posl,
+				   exr10,sjr10,sdifr,exl10,sjl10,sdifl]
+		recs.append(rec+[gap, mp, chrom, st, ed, strand])
+	return recs
+
+def _compare(recs, ref):
+	assert len(recs) == len(ref)
+	for r0, r1 in zip(recs, ref):
+		assert r0[-4:] == r1[-4:]
+		assert N.allclose(N.array(r0[:-4], dtype=float), N.array(r1[:-4], dtype=float))
+
+@pytest.mark.parametrize('strand', ['+','-'])
+@pytest.mark.parametrize('direction,gapmode,covfactor', [
+	('>','i',0.5), ('>','53',0.5), ('<','53',0.3), ('<','i',0),
+])
+def test_params_block(strand, direction, gapmode, covfactor):
+	win, siz = 30, 10
+	ex, a, b = _sample(strand, win=win)
+	recs = FP._params_block(ex, a, b, 0, strand, win, siz, direction, gapmode, covfactor)
+	ref = _params_ref(ex, a, b, 0, strand, win, siz, direction, gapmode, covfactor)
+	_compare(recs, ref)
+
+@pytest.mark.parametrize('strand', ['+','-'])
+def test_flux_block(strand):
+	ex, a, b = _sample(strand)
+	recs = FP._flux_block(ex, a, b, 0, strand)
+	ref = []
+	for chrom, st, ed, _id in ex[['chr','st','ed', '_id']].values:
+		ecov = a[st-1:ed+1]
+		scov = b[st-1:ed+1]
+		if strand=='+':
+			r = [scov[-1]-scov[0], ecov.mean(), ecov.min(), ecov.max(),
+				 scov[0], scov[-1], ecov[0], ecov[-1], scov[1]-scov[0], scov[-1]-scov[-2]]
+		else:
+			r = [scov[0]-scov[-1], ecov.mean(), ecov.min(), ecov.max(),
+				 scov[-1], scov[0], ecov[-1], ecov[0], -scov[-1]+scov[-2], -scov[1]+scov[0]]
+		ref.append([_id]+r+[chrom, st, ed, strand])
+	_compare(recs, ref)
+
+def test_blocks():
+	ex, a, b = _sample('+', n=100)
+	blks = list(FP._blocks(ex, 500))
+	assert sum(len(x) for x in blks) == len(ex)
+	assert all((x['st'].max()-x['st'].min())<500 for x in blks)
+	assert PD.concat(blks)['_id'].tolist() == ex['_id'].tolist()
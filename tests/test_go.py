@@ -0,0 +1,200 @@
+import os
+import pytest
+import numpy as N
+
+from jgem.go import closure as CL
+
+
+def test_load_closures_stale(tmpdir):
+	obo = str(tmpdir.join('test.obo'))
+	with open(obo,'w') as fp:
+		fp.write('format-version: 1.2\n')
+	# 0 <- 1 <- 2
+	parents = [[],[0],[1]]
+	children = [[1],[2],[]]
+	desc, anc = CL.load_closures(obo, parents, children)
+	assert list(desc[0]) == [0,1,2]
+	assert list(anc[2]) == [0,1]
+	# same number of terms, different graph: 0 <- 1, 0 <- 2
+	parents = [[],[0],[0]]
+	children = [[1,2],[],[]]
+	# cache older than the obo file
+	for pre in [obo+'.desc', obo+'.anc']:
+		for x in ['.indptr.npy', '.indices.npy']:
+			os.utime(pre+x, (0,0))
+	desc, anc = CL.load_closures(obo, parents, children)
+	assert list(desc[1]) == [1]
+	assert list(anc[2]) == [0]
+	# more terms than the cache (cache not older): 0 <- 1, 0 <- 2, 2 <- 3
+	parents = [[],[0],[0],[2]]
+	children = [[1,2],[],[3],[]]
+	desc, anc = CL.load_closures(obo, parents, children)
+	assert len(desc) == 4
+	assert list(desc[0]) == [0,1,2,3]
+	assert list(anc[3]) == [0,2]
+
+
+def _slim_sample():
+	pop = ['g%d' % i for i in range(30)]
+	terms = {'gob': ['b1','b2','b3'], 'gom': ['m1','m2'], 'goc': ['c1','c2','c3','c4']}
+	id2slim = {}
+	for k, w in enumerate(['gob','gom','goc']):
+		t = terms[w]
+		# g29 has no association
+		id2slim[w] = {g: [t[(i+k)%len(t)], t[(i*7+k)%len(t)]] for i,g in enumerate(pop[:-1])}
+	sel = [['g0','g3','g6','g9','g12'], ['g1','g2','g29','gx'], pop[10:25]]
+	return pop, id2slim, sel
+
+@pytest.mark.parametrize('method', ['BH', 'bonferroni'])
+def test_goslim_calculate_batch(method):
+	EN = pytest.importorskip('jgem.go.enrichment')
+	from jgem.dataset.p_adjust import p_adjust
+	pop, id2slim, sel = _slim_sample()
+	ids = pop + ['gx']
+	S = N.array([[x in s for x in ids] for s in sel])
+	gs = EN.GOSlimEnrichment({'c': pop}, id2slim)
+	br = gs.calculate_batch('c', S, ids, method=method)
+	for w in ['gob','gom','goc']:
+		b = br[w]
+		for i, s in enumerate(sel):
+			gs.calculate({'c': s}, ['c'])
+			df = gs.rslts['c'][w].df
+			assert b.num[i] == gs.rslts['c'][w].sel_total
+			tx = [b.terms.index(t) for t in df.index]
+			assert list(b.selected[i][tx]) == list(df['selected'])
+			assert N.allclose(b.pval[i][tx], df['p.values'].astype(float))
+			assert N.allclose(b.odds[i][tx], df['odds'].astype(float))
+			q = b.qval[i]
+			assert N.isnan(q).sum() == len(b.terms) - len(df)
+			assert N.allclose(q[tx], p_adjust(df['p.values'].astype(float).values, method))
+
+
+def _enrichment_ref(pop, id2term, sel):
+	# previous dict based implementation: term => (n1, n0, p-value, ids)
+	from scipy.stats import hypergeom
+	i2t = {k: set(id2term[k]) for k in pop if k in id2term}
+	t2i = {}
+	for i in i2t:
+		for t in i2t[i]:
+			t2i.setdefault(t,set()).add(i)
+	tot = len(i2t)
+	s2t = {s:i2t[s] for s in set(sel) if s in i2t}
+	num = len(s2t)
+	t2s = {}
+	for s in s2t:
+		for t in s2t[s]:
+			t2s.setdefault(t,set()).add(s)
+	rslt = {}
+	for t in t2s:
+		n0, n1 = len(t2s[t]), len(t2i[t])
+		pval = N.sum(hypergeom.pmf(range(n0,num+1),tot,n1,num))
+		rslt[t] = (n1, n0, pval, set(t2s[t]))
+	return tot, num, rslt
+
+def test_enrichment_calculate():
+	EN = pytest.importorskip('jgem.go.enrichment')
+	pop, id2slim, sel = _slim_sample()
+	for w in ['gob','gom','goc']:
+		ea = EN.EnrichmentAnalysis(pop, id2slim[w])
+		for s in sel:
+			er = ea.calculate(s)
+			tot, num, ref = _enrichment_ref(pop, id2slim[w], s)
+			assert (er.pop_total, er.sel_total) == (tot, num)
+			assert sorted(er.df.index) == sorted(ref.keys())
+			for t, (n1, n0, pval, ids) in ref.items():
+				r = er.df.loc[t]
+				assert (r['total'], r['selected']) == (n1, n0)
+				assert N.isclose(r['p.values'], pval)
+				assert set(r['ids'].split(',')) == ids
+
+
+class _GO(object):
+	# minimal GO: 0 <- 1 <- 3, 0 <- 2 <- 3, 2 <- 4, 5 (separate root)
+	def __init__(self, obo):
+		self.ids = ['GO:%07d' % i for i in range(6)]
+		self.id2idx = {x:i for i,x in enumerate(self.ids)}
+		self.parents = [[],[0],[0],[1,2],[2],[]]
+		self.children = [[1,2],[3],[3,4],[],[],[]]
+		self.descendants, self.ancestors = CL.load_closures(obo, self.parents, self.children)
+
+	def get_name(self, g):
+		return 'term'+g[-1]
+
+def test_go_enrichment_calculate(tmpdir):
+	EN = pytest.importorskip('jgem.go.enrichment')
+	from scipy.stats import hypergeom
+	obo = str(tmpdir.join('test.obo'))
+	with open(obo,'w') as fp:
+		fp.write('format-version: 1.2\n')
+	go = _GO(obo)
+	pop = ['g%d' % i for i in range(20)]
+	i2g = {g: [go.ids[[3,4,1,5,2][i%5]]] + ([go.ids[4]] if i%3==0 else []) 
+		   for i,g in enumerate(pop[:-2])}
+	ga = EN.GOEnrichmentAnalysis(pop, {'gob':i2g,'gom':i2g,'goc':i2g}, go)
+	for sel in [['g0','g1','g5','g19'], ['g3','g8','g13'], pop[:12]]:
+		rslt = ga.calculate(sel, 'gob')
+		# previous implementation: walk descendants of each node
+		s2g, g2s = ga.parsed['gob']
+		tot = len(s2g)
+		ss = [s for s in set(sel) if s in s2g]
+		num = len(ss)
+		g2s0 = {}
+		for s in ss:
+			for g in s2g[s]:
+				g2s0.setdefault(g,set()).add(s)
+		def des(g2x, g):
+			return set(s for d in go.descendants[g] for s in g2x.get(int(d),[]))
+		cnt = {}
+		for g in g2s:
+			n0, t0 = len(g2s0.get(g,[])), len(des(g2s0, g))
+			if n0==0 and t0==0:
+				continue
+			n1, t1 = len(g2s[g]), len(des(g2s, g))
+			idg = go.ids[g]
+			cnt[idg] = (n0,n1,t0,t1)
+			assert N.isclose(rslt.g2p_node[idg], N.sum(hypergeom.pmf(range(n0,num+1),tot,n1,num)))
+			assert N.isclose(rslt.g2p_tree[idg], N.sum(hypergeom.pmf(range(t0,num+1),tot,t1,num)))
+			assert set(rslt.g2i_node[idg]) == g2s0.get(g,set())
+			assert set(rslt.g2i_tree[idg]) == des(g2s0, g)
+		assert (rslt.num, rslt.tot) == (num, tot)
+		assert {k:tuple(int(x) for x in v) for k,v in rslt.g2cnt.items()} == cnt
+
+@pytest.mark.parametrize('method', ['BH', 'bonferroni'])
+def test_go_enrichment_calculate_batch(tmpdir, method):
+	EN = pytest.importorskip('jgem.go.enrichment')
+	from jgem.dataset.p_adjust import p_adjust
+	obo = str(tmpdir.join('test.obo'))
+	with open(obo,'w') as fp:
+		fp.write('format-version: 1.2\n')
+	go = _GO(obo)
+	pop = ['g%d' % i for i in range(20)]
+	i2g = {g: [go.ids[[3,4,1,5,2][i%5]]] + ([go.ids[4]] if i%3==0 else []) 
+		   for i,g in enumerate(pop[:-2])}
+	ga = EN.GOEnrichmentAnalysis(pop, {'gob':i2g,'gom':i2g,'goc':i2g}, go)
+	sel = [['g0','g1','g5','g19'], ['g3','g8','g13'], pop[:12], ['g18','gx']]
+	ids = pop + ['gx']
+	S = N.array([[x in s for x in ids] for s in sel])
+	br = ga.calculate_batch(S, ids, 'gob', sets=['s%d' % i for i in range(len(sel))], method=method)
+	assert br.sets == ['s0','s1','s2','s3']
+	for i, s in enumerate(sel):
+		rslt = ga.calculate(s, 'gob')
+		df = rslt.df
+		assert br.num[i] == rslt.num
+		assert br.tot == rslt.tot
+		tx = [br.terms.index(t) for t in df.index]
+		rest = [k for k in range(len(br.terms)) if k not in tx]
+		assert list(br.cnt_node[i][tx]) == list(df['cnt.node'])
+		assert list(br.cnt_tree[i][tx]) == list(df['cnt.tree'])
+		assert list(br.tot_node[tx]) == list(df['tot.node'])
+		assert list(br.tot_tree[tx]) == list(df['tot.tree'])
+		assert (br.cnt_node[i][rest] == 0).all() and (br.cnt_tree[i][rest] == 0).all()
+		assert N.allclose(br.p_node[i][tx], df['p.value.node'].astype(float))
+		assert N.allclose(br.p_tree[i][tx], df['p.value.tree'].astype(float))
+		# q-values over the tested terms (cnt.tree>0)
+		tested = br.cnt_tree[i]>0
+		q = br.q_tree[i]
+		assert N.isnan(q[~tested]).all()
+		assert N.allclose(q[tested], p_adjust(br.p_tree[i][tested], method))
+		if len(df)>0:
+			assert N.allclose(br.odds[i][tx], df['odds'].astype(float))
+	assert br.num[3] == 0 # no association
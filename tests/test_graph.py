@@ -85,3 +85,42 @@ from jgem import graph as GP
 # def test_mcore_allcomponents4():
 # 	pass
 
+
+### union-find
+
+def test_union_find():
+	import numpy as N
+	labels = GP.union_find(6, [4,1,5], [3,2,4])
+	assert list(labels) == [0,1,1,3,3,3]
+	# long chain, no recursion limit
+	n = 100000
+	labels = GP.union_find(n, N.arange(1,n)[::-1], N.arange(n-1)[::-1])
+	assert all(labels==0)
+
+def test_ad_components():
+	# exon 10 -(d1,a1)- exon 11 -(d2,a2)- exon 12, exon 13 dangling donor, exon 14 isolated
+	me = PD.DataFrame({'_id':[10,11,12,13,14],
+					   'd_id':[1,2,0,3,0],
+					   'a_id':[0,1,2,0,0]})
+	sj = PD.DataFrame({'_id':[0,1,2],'d_id':[1,2,3],'a_id':[1,2,4]})
+	genes = GP.ad_components(sj, me)
+	assert genes == [set([10,11,12]), set([13]), set([14])]
+	# overlap edges
+	genes = GP.ad_components(sj, me, ([13],[14]))
+	assert genes == [set([10,11,12]), set([13,14])]
+
+def test_genegraph_allcomponents():
+	from jgem import assembler3 as A3
+	# gene1: e1 -s1- e2 -s2- e3, gene2: e4 -s3- e5 
+	exs = PD.DataFrame({'chr':'chr1',
+						'st':[100,300,500,1000,1200],
+						'ed':[200,400,600,1100,1300],
+						'kind':['5','i','3','5','3']})
+	sjs = PD.DataFrame({'chr':'chr1','st':[200,400,1100],'ed':[300,500,1200]})
+	gg = A3.GeneGraph(sjs, exs, '+')
+	assert gg.allcomponents() == [set([1,2,3]), set([4,5])]
+	assert gg.allcomponents() == gg.allcomponents_nr()
+	# restricted to s1
+	gg1 = gg.restrict([1])
+	assert gg1.allcomponents() == [set([1,2]), set([3]), set([4]), set([5])]
+	assert gg1.allcomponents() == gg1.allcomponents_nr()
@@ -1,6 +1,7 @@
 import os
 import pytest
 import pandas as PD
+import numpy as N
 try:
     from StringIO import StringIO
 except:
@@ -87,4 +88,150 @@ def test_read_gtf(g4gtfpath):
 # def chop_chrs_gtf():
 # 	pass
 
-	
\ No newline at end of file
+	
+GTFTXT = '''#!genome-build test
+#!genome-version 1
+chr1\ttest\tgene\t11\t100\t.\t+\t.\tgene_id "g1"; gene_name "A#1"; gene_type "coding";
+chr1\ttest\ttranscript\t11\t100\t.\t+\t.\tgene_id "g1"; transcript_id "t1"; gene_name "A#1";
+chr1\ttest\texon\t11\t30\t.\t+\t.\tgene_id "g1"; transcript_id "t1"; exon_number 1; gene_name "A#1";
+# comment in the middle
+chr1\ttest\texon\t51\t100\t.\t+\t.\tgene_id "g1"; transcript_id "t1"; exon_number 2; gene_name "A#1";
+chr2\ttest\texon\t1001\t1200\t.\t-\t.\tgene_id "g2"; transcript_id "t2"; exon_number "1";
+#another comment
+chr2\ttest\texon\t801\t900\t.\t-\t.\tgene_id "g2"; transcript_id "t2"; exon_number "2"; gene_type "nc";
+chr2\ttest\tCDS\t1001\t1100\t.\t-\t0\tgene_id "g2"; transcript_id "t2";
+'''
+
+def _write_gtf(tmpdir, gz):
+	import gzip
+	path = str(tmpdir.join('test.gtf'+('.gz' if gz else '')))
+	fp = gzip.open(path, 'wb') if gz else open(path, 'wb')
+	fp.write(GTFTXT.encode())
+	fp.close()
+	return path
+
+@pytest.mark.parametrize('gz', [False, True])
+def test_read_gtf_chunks(tmpdir, gz):
+	path = _write_gtf(tmpdir, gz)
+	# previous line by line parse (quoted values only), comment='#' would cut 'A#1'
+	lines = [x for x in GTFTXT.split('\n') if x and x[0]!='#']
+	ref = PD.DataFrame([x.split('\t') for x in lines], columns=GGB.GTFCOLS)
+	ref['st'] = ref['st'].astype(int)
+	ref['ed'] = ref['ed'].astype(int)
+	gtf = GGB.read_gtf(path)
+	assert len(gtf) == 7
+	assert list(gtf.columns) == GGB.GTFCOLS+GGB.DEFAULT_GTF_PARSE
+	for c in GGB.GTFCOLS:
+		assert list(gtf[c]) == list(ref[c])
+	for c in ['gene_id','transcript_id','gene_name','gene_type']:
+		old = [x if x!='' else N.nan for x in GGB.get_gtf_attr_col(ref, c)]
+		assert gtf[c].fillna('').tolist() == PD.Series(old).fillna('').tolist()
+	assert gtf['exon_number'].fillna('').tolist() == ['','','1','2','1','2','']
+	# chunk boundaries (including chunks shorter than a line) and processes
+	for chunksize in [1, 7, 64, 150]:
+		df = GGB.read_gtf(path, chunksize=chunksize)
+		assert df.equals(gtf)
+	df = GGB.read_gtf(path, chunksize=64, np=2)
+	assert df.equals(gtf)
+	# categorical
+	df = GGB.read_gtf(path, chunksize=64, categorical=True)
+	assert hasattr(df['chr'], 'cat')
+	assert sorted(df['typ'].cat.categories) == ['CDS','exon','gene','transcript']
+	for c in gtf.columns:
+		assert df[c].astype(object).fillna('').tolist() == gtf[c].fillna('').tolist()
+	# onlytypes, rename
+	df = GGB.read_gtf(path, onlytypes=['exon'], rename={'gene_id':'gid'}, chunksize=64)
+	assert len(df) == 4
+	assert list(df['gid']) == ['g1','g1','g2','g2']
+
+def test_gff_attr_pattern():
+	gff = PD.DataFrame({'attr':[
+		'ID=e1;Parent=t1;Name=x',
+		'Parent=t1;ID=e2',
+		'ID=e3',
+		'ID=;Parent=t2;Name=',
+		'Name=a=b;ID=e5;Note=c=d=e',
+		'xID=e6;Parent=t6;myParent=t7',
+		'',
+	]})
+	df = GGB.get_gff_attr_cols(gff, ['ID','Parent','Name','Note'])
+	assert list(df.columns) == ['ID','Parent','Name','Note']
+	assert df['ID'].tolist() == ['e1','e2','e3','','e5','','']
+	assert df['Parent'].tolist() == ['t1','t1','','t2','','t6','']
+	assert df['Name'].tolist() == ['x','','','','a=b','','']
+	assert df['Note'].tolist() == ['','','','','c=d=e','','']
+	# same as previous per attribute parse (without '=' in values)
+	sub = gff.iloc[[0,1,2,3,5,6]]
+	for c in ['ID','Parent','Name']:
+		assert GGB.get_gff_attr_cols(sub, [c])[c].tolist() == GGB.get_gff_attr_col(sub, c)
+
+def test_read_gff(tmpdir):
+	path = str(tmpdir.join('test.gff'))
+	with open(path, 'w') as fp:
+		fp.write('##gff-version 3\n')
+		fp.write('chr1\tt\tgene\t11\t100\t.\t+\t.\tID=g1;Name=A\n')
+		fp.write('chr1\tt\ttranscript\t11\t100\t.\t+\t.\tID=t1;Parent=g1\n')
+		fp.write('chr1\tt\texon\t11\t30\t.\t+\t.\tParent=t1\n')
+		fp.write('chr1\tt\texon\t51\t100\t.\t+\t.\tParent=t1;Note=x=y\n')
+	gff = GGB.read_gff(path, parseattrs=['Name','Note'])
+	assert gff['gid'].tolist() == ['g1']*4
+	assert gff['tid'].tolist() == ['','t1','t1','t1']
+	assert gff['eid'].tolist() == ['','','t1:1','t1:2']
+	assert gff['Name'].tolist() == ['A','','','']
+	assert gff['Note'].tolist() == ['','','','x=y']
+
+def _random_paths(n=200, seed=0):
+	rs = N.random.RandomState(seed)
+	names, strands = [], []
+	for i in range(n):
+		ne = rs.randint(1, 6)
+		pos = N.sort(rs.choice(N.arange(100, 5000), 2*ne, replace=False))
+		strand = ['+','-','.'][i%3]
+		if strand=='-': # descending pathcode
+			pos = pos[::-1]
+		names.append('|'.join([','.join(map(str, pos[2*j:2*j+2])) for j in range(ne)]))
+		strands.append(strand)
+	return names, strands
+
+def test_pathcode_exons_blocks_bed12():
+	names, strands = _random_paths()
+	idx, st, ed = GGB.pathcode_exons(names, strands)
+	ri, st0, ed0, nex, esizes, estarts = GGB.blocks_bed12(idx, st, ed)
+	# previous list based code (assembler3.path2bed12)
+	exonsp = [[[int(z) for z in y.split(',')] for y in x.split('|')] for x in names]
+	exonsn = [[y[::-1] for y in x][::-1] for x in exonsp]
+	exons = [n if s=='-' else p for p,n,s in zip(exonsp, exonsn, strands)]
+	assert list(ri) == list(range(len(names)))
+	assert list(nex) == [len(x) for x in exons]
+	assert list(esizes) == [','.join([str(y[1]-y[0]) for y in x])+',' for x in exons]
+	assert list(estarts) == [','.join([str(y[0]-x[0][0]) for y in x])+',' for x in exons]
+	assert list(st0) == [x[0][0] for x in exons]
+	assert list(ed0) == [x[-1][1] for x in exons]
+	assert list(zip(st, ed)) == [tuple(y) for x in exons for y in x]
+	# BED12 round trip
+	bed = PD.DataFrame({'st':st0, 'esizes':esizes, 'estarts':estarts})
+	idx2, st2, ed2 = GGB.bed12_blocks(bed)
+	assert (idx2==idx).all() and (st2==st).all() and (ed2==ed).all()
+
+def test_intlists():
+	vals, cnts = GGB.intlists(['1,2,3,', '4', '5,6'])
+	assert list(vals) == [1,2,3,4,5,6]
+	assert list(cnts) == [3,1,2]
+	assert list(GGB.join_intlists(vals, cnts)) == ['1,2,3,', '4,', '5,6,']
+	vals, cnts = GGB.intlists([])
+	assert len(vals)==0 and len(cnts)==0
+
+def test_bed12Tobed6():
+	names, strands = _random_paths(50)
+	idx, st, ed = GGB.pathcode_exons(names, strands)
+	ri, st0, ed0, nex, esizes, estarts = GGB.blocks_bed12(idx, st, ed)
+	bed12 = PD.DataFrame({'chr':'chr1', 'st':st0, 'ed':ed0, 'name':['p%d' % i for i in ri],
+						  'sc1':0, 'strand':N.array(strands)[ri], 'tst':st0, 'ted':ed0, 'sc2':0, 
+						  '#exons':nex, 'esizes':esizes, 'estarts':estarts}, columns=GGB.BEDCOLS)
+	bed6 = GGB.bed12Tobed6(bed12)
+	# previous python flatten (cybw.flatten_bed8 mis-trims estarts with trailing comma)
+	recs = []
+	for c,s,e,n,sc1,strand,esi,est in bed12[['chr','st','ed','name','sc1','strand','esizes','estarts']].values:
+		for y,z in zip(esi[:-1].split(','), est[:-1].split(',')):
+			recs.append([c, s+int(z), s+int(z)+int(y), n, sc1, strand])
+	assert bed6.values.tolist() == recs
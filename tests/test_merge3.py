@@ -0,0 +1,360 @@
+import os
+import shutil
+import pytest
+import pandas as PD
+import numpy as N
+
+from jgem import utils as UT
+from jgem import bigwig as BW
+from jgem import gtfgffbed as GGB
+from jgem import assembler3 as A3
+from jgem import merge3 as M3
+
+# two chromosomes with the same coordinates (same path/junction names) on both
+CHROMS = ['chr1','chr2']
+CSIZE = 5000
+# (strand, exons, jitter of 5'/3' ends)
+TRANSCRIPTS = [
+	('+', [(100,200),(300,400),(500,600)], True),
+	('-', [(1100,1200),(1300,1400)], True),
+	('.+', [(2100,2200),(2300,2400),(2500,2600)], False),
+	('.-', [(2100,2200),(2300,2400),(2500,2600)], False), # unstranded duplicate
+	('.-', [(3100,3200),(3300,3400)], True),
+	('+', [(4100,4200)], False), # no junction
+]
+
+def _pathname(exons, strand):
+	if strand in ['-','.-']:
+		return '|'.join(['{1},{0}'.format(s,e) for s,e in exons[::-1]])
+	return '|'.join(['{0},{1}'.format(s,e) for s,e in exons])
+
+def _write_sample(pre, seed, chroms=CHROMS, tids=None):
+	rs = N.random.RandomState(seed)
+	paths, sjs, exs = [], [], []
+	for chrom in chroms:
+		for i, (strand, exons, jitter) in enumerate(TRANSCRIPTS):
+			if tids is not None and i not in tids:
+				continue
+			if tids is None and i==3 and seed%2==1: # duplicate only in some samples
+				continue
+			ex = [list(x) for x in exons]
+			if jitter:
+				ex[0][0] -= rs.randint(0,20)
+				ex[-1][1] += rs.randint(0,20)
+			st, ed = ex[0][0], ex[-1][1]
+			tcov = float(rs.randint(1,50))
+			paths.append([chrom,st,ed,_pathname(ex,strand),strand,st,ed,tcov,tcov,0,0,0])
+			for s,e in ex:
+				exs.append([chrom,s,e,strand,'{0},{1}'.format(s,e),'i',float(rs.randint(1,20))])
+			for (s0,e0),(s1,e1) in zip(ex[:-1],ex[1:]):
+				sjs.append([chrom,e0,s1,strand,'{0}|{1}'.format(e0,s1),'j',rs.randint(1,30),rs.randint(0,5)])
+	UT.write_pandas(PD.DataFrame(paths, columns=A3.PATHCOLS), pre+'.paths.txt.gz', '')
+	UT.write_pandas(PD.DataFrame(sjs, columns=A3.SJDFCOLS), pre+'.sjdf.txt.gz', '')
+	UT.write_pandas(PD.DataFrame(exs, columns=A3.EXDFCOLS), pre+'.exdf.txt.gz', '')
+	UT.write_pandas(PD.DataFrame(exs[:2], columns=A3.EXDFCOLS), pre+'.sedf.txt.gz', '')
+	return pre
+
+def _prep(j2pres, libsizes, dstpre):
+	for chrom in CHROMS:
+		M3.prep_sjpath_chr(j2pres, libsizes, dstpre, chrom)
+		M3.prep_sjdf_chr(j2pres, libsizes, dstpre, chrom)
+		M3.prep_exwig_chr(j2pres, libsizes, dstpre, chrom, CSIZE)
+		M3.prep_sjwig_chr(j2pres, libsizes, dstpre, chrom, CSIZE)
+	M3.prep_sjpath(dstpre, CHROMS)
+	M3.prep_sjdf(dstpre, CHROMS)
+	return dstpre
+
+def _weights(libsizes, nold, nnew):
+	if libsizes is None:
+		return 1., 1.
+	return nold/float(nold+nnew), nnew/float(nold+nnew)
+
+def _read_wig(path):
+	if os.path.getsize(path)==0:
+		return N.array([],dtype=int), N.array([],dtype=int), N.array([])
+	df = PD.read_table(path, header=None, names=['chr','st','ed','val'])
+	return df['st'].values, df['ed'].values, df['val'].values
+
+def _wig2array(path):
+	a = N.zeros(CSIZE)
+	for s,e,v in zip(*_read_wig(path)):
+		a[s:e] += v
+	return a
+
+def _fake_bigwig_intervals(bwfile, chrom, st, ed):
+	# per chromosome wiggle written by prep_(ex|sj)wig_chr instead of BIGWIG
+	return _read_wig(bwfile[:-3]+'.{0}.wig'.format(chrom))
+
+@pytest.fixture(scope='module')
+def samples(tmpdir_factory):
+	d = tmpdir_factory.mktemp('merge3')
+	return [_write_sample(str(d.join('s{0}'.format(i))), i) for i in range(5)]
+
+@pytest.mark.parametrize('libsizes', [None, [1e6,2e6,5e5,1e6,4e6]])
+def test_update_sjpath_sjdf(samples, libsizes, tmpdir):
+	full = _prep(samples, libsizes, str(tmpdir.join('full')))
+	old = _prep(samples[:3], libsizes and libsizes[:3], str(tmpdir.join('old')))
+	new = _prep(samples[3:], libsizes and libsizes[3:], str(tmpdir.join('new')))
+	wold, wnew = _weights(libsizes, 3, 2)
+	inc = str(tmpdir.join('inc'))
+	M3.update_sjpath(old, new, inc, CHROMS, wold, wnew)
+	M3.update_sjdf(old, new, inc, CHROMS, wold, wnew)
+
+	b0 = GGB.read_bed(full+'.sjpath.bed.gz').sort_values(['chr','name']).reset_index(drop=True)
+	b1 = GGB.read_bed(inc+'.sjpath.bed.gz').sort_values(['chr','name']).reset_index(drop=True)
+	assert len(b0)==8 # 4 paths with junctions x 2 chroms (unstranded duplicate removed)
+	assert list(b1['chr'].unique())==CHROMS
+	cols = ['chr','st','ed','name','strand','tst','ted','#exons','esizes','estarts']
+	assert b0[cols].equals(b1[cols])
+	assert N.allclose(b0['sc1'].values, b1['sc1'].values)
+
+	d0 = UT.read_pandas(full+'.sjdf.txt.gz', names=A3.SJDFCOLS)
+	d1 = UT.read_pandas(inc+'.sjdf.txt.gz', names=A3.SJDFCOLS)
+	assert list(d1['chr'].unique())==CHROMS
+	d0 = d0.sort_values(['chr','name']).reset_index(drop=True)
+	d1 = d1.sort_values(['chr','name']).reset_index(drop=True)
+	cols = ['chr','st','ed','strand','name','kind']
+	assert d0[cols].equals(d1[cols])
+	assert N.allclose(d0[['tcnt','ucnt']].values, d1[['tcnt','ucnt']].values)
+
+@pytest.mark.parametrize('libsizes', [None, [1e6,2e6,5e5,1e6,4e6]])
+def test_update_wig_chr(samples, libsizes, tmpdir, monkeypatch):
+	full = _prep(samples, libsizes, str(tmpdir.join('full')))
+	old = _prep(samples[:3], libsizes and libsizes[:3], str(tmpdir.join('old')))
+	new = _prep(samples[3:], libsizes and libsizes[3:], str(tmpdir.join('new')))
+	wold, wnew = _weights(libsizes, 3, 2)
+	inc = str(tmpdir.join('inc'))
+	monkeypatch.setattr(BW, 'get_bigwig_intervals', _fake_bigwig_intervals)
+	for w in ['ex','sj']:
+		for chrom in CHROMS:
+			M3.update_wig_chr(old, new, inc, w, chrom, CSIZE, wold, wnew)
+			for s in ['p','n','u']:
+				a0 = _wig2array(full+'.{0}.{1}.{2}.wig'.format(w,s,chrom))
+				a1 = _wig2array(inc+'.{0}.{1}.{2}.wig'.format(w,s,chrom))
+				assert a0.sum()>0
+				assert N.allclose(a0, a1)
+
+def _bundles():
+	return [(c,s,s+1000) for c in CHROMS for s in range(0,CSIZE,1000)]
+
+def test_changed_reuse_bundles(samples, tmpdir):
+	d = tmpdir
+	# new samples only on chr2, chr1 is unchanged
+	s5 = _write_sample(str(d.join('s5')), 5, chroms=['chr2'], tids=[0,1])
+	old = _prep(samples[:2], None, str(d.join('old')))
+	new = _prep(samples[:2]+[s5], None, str(d.join('new')))
+	bundles = _bundles()
+	changed = M3.changed_bundles(old, new, bundles)
+	assert sorted(changed)==[('chr2',0,1000),('chr2',1000,2000)]
+	assert M3.changed_bundles(old, old, bundles)==[]
+
+	# old assembly: bundles and exdf
+	oapre = str(d.join('oasm'))
+	napre = str(d.join('nasm'))
+	UT.write_pandas(PD.DataFrame(bundles, columns=['chr','st','ed']), oapre+'.bundles.txt.gz', 'h')
+	ex = UT.read_pandas(samples[0]+'.exdf.txt.gz', names=A3.EXDFCOLS)
+	UT.write_pandas(ex, oapre+'.exdf.txt.gz', '')
+	assert M3.reuse_bundles(oapre, napre, old, new, CHROMS)==changed
+	for chrom in CHROMS:
+		b = UT.read_pandas(napre+'.{0}.bundles.txt.gz'.format(chrom))
+		assert len(b)==5
+	for c,s,e in bundles:
+		path = '{0}.{1}_{2}_{3}.exdf.txt.gz'.format(napre,c,s,e)
+		if (c,s,e) in changed:
+			assert not os.path.exists(path)
+			continue
+		n = ((ex['chr']==c)&(ex['st']>=s)&(ex['st']<e)).sum()
+		if n==0:
+			continue
+		df = UT.read_pandas(path, names=A3.EXDFCOLS)
+		assert len(df)==n
+		assert (df['chr']==c).all()
+		# same rows in the same order
+		sub = ex[(ex['chr']==c)&(ex['st']>=s)&(ex['st']<e)]
+		assert df[['st','ed','name']].values.tolist()==sub[['st','ed','name']].values.tolist()
+
+def _write_covs(pre, seed):
+	rs = N.random.RandomState(seed)
+	recs = [[c,s,s+100,'+','{0}'.format(s),'i',float(rs.randint(0,100))]
+			for c in CHROMS for s in range(0,1000,200)]
+	UT.write_pandas(PD.DataFrame(recs, columns=A3.EXDFCOLS), pre+'.covs.exdf.txt.gz', '')
+	return pre
+
+def test_covmatrix_add_samples(tmpdir):
+	pres = [_write_covs(str(tmpdir.join('c{0}'.format(i))), i) for i in range(3)]
+	cm0 = M3.CovMatrix(str(tmpdir.join('all')), 'ex').create(pres[0], pres)
+	for i, pre in enumerate(pres):
+		cm0.write_sample(pre, i)
+	cm1 = M3.CovMatrix(str(tmpdir.join('inc')), 'ex').create(pres[0], pres[:2])
+	for i, pre in enumerate(pres[:2]):
+		cm1.write_sample(pre, i)
+	sids = cm1.add_samples(pres[2:])
+	assert sids==[2]
+	def _check():
+		cm1 = M3.CovMatrix(str(tmpdir.join('inc')), 'ex') # re-read meta
+		assert cm1.colnames()==cm0.colnames()
+		assert cm1.meta()['samples']==pres
+		for chrom in CHROMS:
+			m0 = cm0.get(chrom)
+			m1 = cm1.get(chrom)
+			assert m1.equals(m0)
+			assert m1.iloc[:,0].sum()>0
+			assert cm1.open(chrom).shape==m0.shape
+	_check()
+	# re-append: nothing added
+	assert M3.CovMatrix(str(tmpdir.join('inc')), 'ex').add_samples(pres[1:])==[]
+	_check()
+
+def test_covmatrix_add_samples_interrupted(tmpdir, monkeypatch):
+	pres = [_write_covs(str(tmpdir.join('c{0}'.format(i))), i) for i in range(3)]
+	cm0 = M3.CovMatrix(str(tmpdir.join('all')), 'ex').create(pres[0], pres)
+	for i, pre in enumerate(pres):
+		cm0.write_sample(pre, i)
+	cm1 = M3.CovMatrix(str(tmpdir.join('inc')), 'ex').create(pres[0], pres[:1])
+	cm1.write_sample(pres[0], 0)
+	# crash while filling the new columns: meta is not updated
+	def _fail(dstpre, which, covpre, sid):
+		M3.CovMatrix(dstpre, which).write_sample(covpre, sid)
+		if sid==2:
+			raise RuntimeError('interrupted')
+	monkeypatch.setattr(M3, 'collect_cov_column', _fail)
+	with pytest.raises(RuntimeError):
+		cm1.add_samples(pres[1:])
+	cm1 = M3.CovMatrix(str(tmpdir.join('inc')), 'ex')
+	assert cm1.meta()['samples']==pres[:1]
+	assert len(cm1.colnames())==len(cm1.flds)
+	monkeypatch.undo()
+	# repeat the same call
+	assert cm1.add_samples(pres[1:])==[1,2]
+	cm1 = M3.CovMatrix(str(tmpdir.join('inc')), 'ex')
+	assert cm1.colnames()==cm0.colnames()
+	for chrom in CHROMS:
+		assert cm1.get(chrom).equals(cm0.get(chrom))
+
+@pytest.mark.skipif(shutil.which('wigToBigWig') is None, reason='needs wigToBigWig')
+def test_IncrementalPrepBWSJ(samples, tmpdir, monkeypatch):
+	csizes = str(tmpdir.join('test.chrom.sizes'))
+	UT.write_pandas(PD.DataFrame({'chr':CHROMS,'size':CSIZE})[['chr','size']], csizes, '')
+	monkeypatch.setattr(UT, 'chroms', lambda genome: CHROMS)
+	monkeypatch.setattr(UT, 'chromsizes', lambda genome: csizes)
+	full = str(tmpdir.join('full'))
+	old = str(tmpdir.join('old'))
+	inc = str(tmpdir.join('inc'))
+	M3.PrepBWSJ(samples, 'test', full, np=1)()
+	M3.PrepBWSJ(samples[:3], 'test', old, np=1)()
+	M3.IncrementalPrepBWSJ(old, 3, samples[3:], 'test', inc, np=1)()
+	for w in ['ex','sj']:
+		for s in ['p','n','u']:
+			for chrom in CHROMS:
+				a0 = BW.get_bigwig_as_array(full+'.{0}.{1}.bw'.format(w,s), chrom, 0, CSIZE)
+				a1 = BW.get_bigwig_as_array(inc+'.{0}.{1}.bw'.format(w,s), chrom, 0, CSIZE)
+				assert N.allclose(a0, a1)
+	b0 = GGB.read_bed(full+'.sjpath.bed.gz').sort_values(['chr','name']).reset_index(drop=True)
+	b1 = GGB.read_bed(inc+'.sjpath.bed.gz').sort_values(['chr','name']).reset_index(drop=True)
+	cols = ['chr','st','ed','name','strand','#exons','esizes','estarts']
+	assert b0[cols].equals(b1[cols])
+	assert N.allclose(b0['sc1'].values, b1['sc1'].values)
+	d0 = UT.read_pandas(full+'.sjdf.txt.gz', names=A3.SJDFCOLS).sort_values(['chr','name'])
+	d1 = UT.read_pandas(inc+'.sjdf.txt.gz', names=A3.SJDFCOLS).sort_values(['chr','name'])
+	assert N.allclose(d0['tcnt'].values, d1['tcnt'].values)
+
+def test_ModelIndex(samples, tmpdir):
+	bwpre = _prep(samples[:2], None, str(tmpdir.join('bw')))
+	modelpre = str(tmpdir.join('model'))
+	shutil.copy(bwpre+'.sjpath.bed.gz', modelpre+'.paths.withse.bed.gz')
+	shutil.copy(bwpre+'.sjdf.txt.gz', modelpre+'.sjdf.txt.gz')
+	shutil.copy(samples[0]+'.exdf.txt.gz', modelpre+'.exdf.txt.gz')
+	mi = M3.ModelIndex(modelpre, bwpre, str(tmpdir.join('idx'))).build(CHROMS)
+	# no chr3, no sedf => empty with columns
+	pa = mi.get('paths', 'chr3', 0, 1000)
+	assert len(pa)==0 and list(pa.columns)==GGB.BEDCOLS
+	se = mi.get('sedf', 'chr1', 0, 1000)
+	assert len(se)==0 and list(se.columns)==A3.EXDFCOLS
+	ex = mi.get('exdf', 'chr1', 0, 1000)
+	assert len(ex)==3
+	# rebuilt index is not read from the cache
+	mi.remove(CHROMS)
+	shutil.copy(samples[1]+'.exdf.txt.gz', modelpre+'.exdf.txt.gz')
+	mi = M3.ModelIndex(modelpre, bwpre, str(tmpdir.join('idx'))).build(CHROMS)
+	ex1 = UT.read_pandas(samples[1]+'.exdf.txt.gz', names=A3.EXDFCOLS)
+	ex1 = ex1[(ex1['chr']=='chr1')&(ex1['st']>=0)&(ex1['ed']<=1000)]
+	assert list(mi.get('exdf', 'chr1', 0, 1000)['ed'])==list(ex1['ed'])
+
+def _write_sjpaths(pre, recs):
+	# recs: (chr, name, strand, ucnt, tcnt)
+	rows = []
+	for c, name, strand, u, t in recs:
+		v = [int(x) for x in name.replace('|',',').split(',')]
+		st, ed = min(v), max(v)
+		rows.append([c, st, ed, name, u, strand, st, ed, t, 1, '{0},'.format(ed-st), '0,'])
+	GGB.write_bed(PD.DataFrame(rows, columns=GGB.BEDCOLS), pre+'.sjpath.bed.gz', ncols=12)
+	return pre
+
+@pytest.mark.parametrize('which', ['ucnt','tcnt'])
+def test_collect_sjcnts(tmpdir, which):
+	d = tmpdir
+	samples = [
+		('s0', [('chr1','200|300,400|500','+',3,4), ('chr2','1200|1100','-',5,6), 
+				('chr3','10|20','+',7,8)]),
+		('s1', [('chr1','200|300','+',1,2), ('chr1','200|300,400|600','+',9,10)]), # dup 200|300: last wins
+		('s2', [('chr2','1200|1100,1400|1300','-',11,12)]),
+	]
+	pres = [_write_sjpaths(str(d.join(n)), recs) for n, recs in samples]
+	si = PD.DataFrame({'name':[n for n,r in samples], 'bwpre':pres})
+	# model junctions (not in any sample: chr1 700-800)
+	sj = PD.DataFrame({'chr':['chr2','chr1','chr1','chr1','chr2','chr1'],
+					   'st-1':[1100,200,400,400,1300,700], 'ed':[1200,300,500,600,1400,800]})
+	sj['_id'] = N.arange(len(sj))[::-1]
+	modelpre = str(d.join('model'))
+	UT.write_pandas(sj, modelpre+'.sj.txt.gz', 'h')
+	for np in [1, 2]:
+		df = M3.collect_sjcnts('ds', si, 'asm', modelpre, which, str(d), np=np)
+		# previous locus string join
+		fld = {'ucnt':'sc1','tcnt':'sc2'}[which]
+		loci = UT.calc_locus(sj,'chr','st-1','ed')
+		ref = {}
+		for n, pre in zip(si['name'], pres):
+			l2u = {}
+			for c, name, cnt in GGB.read_bed(pre+'.sjpath.bed.gz')[['chr','name',fld]].values:
+				for jid in name.split(','):
+					v = [int(y) for y in jid.split('|')]
+					l2u['{0}:{1}-{2}'.format(c, min(v), max(v))] = cnt
+			ref[n] = [l2u.get(x,0) for x in loci]
+		assert list(df.index)==list(sj['_id'])
+		assert list(df.columns)==['s0','s1','s2']
+		for n in ['s0','s1','s2']:
+			assert df[n].tolist()==ref[n]
+		# integer counts in the written table
+		path = str(d.join('ds.asm.{0}s.txt.gz'.format(which)))
+		txt = UT.read_pandas(path, index_col=[0])
+		assert all(N.issubdtype(x, N.integer) for x in txt.dtypes)
+
+def test_shards(tmpdir):
+	d = tmpdir
+	# samples with an extra contig not in the genome chromosomes
+	pres = [_write_sample(str(d.join('s{0}'.format(i))), i, chroms=CHROMS+['chrUn_1']) 
+			for i in range(3)]
+	sdir = d.mkdir('shards')
+	spre = str(sdir.join('merged'))
+	M3.make_shards(pres, spre, CHROMS, np=1)
+	# only chromosomes with data, no per sample parts left
+	expected = ['merged.shard.done']
+	for k, cols in M3.SHARDCOLS.items():
+		cs = set()
+		for pre in pres:
+			cs |= set(UT.read_pandas(pre+'.{0}.txt.gz'.format(k), names=cols)['chr'])
+		expected += ['merged.shard.{0}.{1}.txt.gz'.format(k,c) for c in cs if c in CHROMS]
+	assert sorted(os.listdir(str(sdir)))==sorted(expected)
+	npre = str(d.join('noshards'))
+	for kind in M3.SHARDCOLS:
+		for chrom in CHROMS:
+			r0 = list(M3.sample_chrom_dfs(pres, npre, kind, chrom))
+			r1 = list(M3.sample_chrom_dfs(pres, spre, kind, chrom))
+			assert [x[0] for x in r1]==[x[0] for x in r0 if len(x[1])>0]
+			d0 = dict(r0)
+			for sid, df1 in r1:
+				df0 = d0[sid].reset_index(drop=True)
+				df1 = df1.drop('sid', axis=1).reset_index(drop=True)
+				assert df1.equals(df0)
+	M3.remove_shards(spre, CHROMS)
+	assert os.listdir(str(sdir))==[]
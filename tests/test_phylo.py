@@ -0,0 +1,64 @@
+import pytest
+import numpy as N
+import pandas as PD
+
+from jgem import phylo as PH
+
+
+class _BW(object):
+	# in memory bigwig: get_as_array like bx BigWigFile (NaN: no data, None: no chrom)
+	def __init__(self, arrs):
+		self.arrs = arrs
+
+	def get_as_array(self, chrom, st, ed):
+		if chrom not in self.arrs:
+			return None
+		a = N.full(ed-st, N.nan, dtype=N.float32)
+		v = self.arrs[chrom][st:ed]
+		a[:len(v)] = v
+		return a
+
+def _sample(seed=0):
+	rs = N.random.RandomState(seed)
+	arrs = {}
+	for c, size in [('chr1', 50000), ('chr2', 20000)]:
+		a = (rs.rand(size)*10-3).astype(N.float32)
+		a[rs.rand(size)<0.1] = N.nan
+		arrs[c] = a
+	recs = []
+	for i in range(300):
+		c = ['chr1','chr2','chr3'][i%3]
+		st = rs.randint(0, 50000 if c=='chr1' else 20100)
+		recs.append((c, st, st+rs.randint(0, 400), i))
+	return _BW(arrs), PD.DataFrame(recs, columns=['chr','st','ed','_id'])
+
+@pytest.mark.parametrize('blocksize,maxgap', [(PH.BLOCKSIZE, PH.MAXGAP), (1000, 100), (1, 0)])
+def test_bw_sums(blocksize, maxgap):
+	bw, df = _sample()
+	p60 = PH.Phylo60('')
+	p60.bw = bw
+	for c in ['chr1','chr2','chr3']:
+		sub = df[df['chr']==c]
+		sums = PH.bw_sums(bw, c, sub['st'].values, sub['ed'].values, blocksize, maxgap)
+		# previous per exon score
+		ref = [p60.score(c, st, ed) for st, ed in sub[['st','ed']].values]
+		assert N.allclose(sums, ref, rtol=1e-5, atol=1e-3)
+
+def test_exon_blocks():
+	st = N.array([0, 10, 50, 300, 320, 2500, 2600])
+	ed = N.array([400, 20, 60, 310, 330, 2550, 2700])
+	# exon 0 covers up to 400, gap 2500-400 > maxgap
+	assert list(PH.exon_blocks(st, ed, 1000, 500)) == [0,0,0,0,0,1,1]
+	assert list(PH.exon_blocks(st, ed, 100, 500)) == [0,0,0,1,1,2,3]
+	assert list(PH.exon_blocks(st, ed, 1000, 5)) == [0,0,0,0,0,1,2]
+	assert list(PH.exon_blocks(st[1:], ed[1:], 1000, 5)) == [0,1,2,3,4,5]
+	assert len(PH.exon_blocks(st[:0], ed[:0])) == 0
+
+def test_phylo60_calc_scores():
+	bw, df = _sample(1)
+	p60 = PH.Phylo60('')
+	p60.bw = bw
+	ref = [p60.score(c, st, ed) for c, st, ed in df[['chr','st','ed']].values]
+	rslt = p60.calc_scores(df.copy())
+	assert list(rslt['_id']) == list(df['_id'])
+	assert N.allclose(rslt['phylo60score'], ref, rtol=1e-5, atol=1e-3)
@@ -0,0 +1,80 @@
+import pytest
+import numpy as N
+import pandas as PD
+
+SP = pytest.importorskip('jgem.specific')
+
+
+def _sample(ngenes=50, seed=0):
+	rs = N.random.RandomState(seed)
+	groups = ['a','b','c','d','e']
+	si = PD.DataFrame({'name':['s%d' % i for i in range(15)], 'group':[groups[i//3] for i in range(15)]})
+	si['cg1'] = si['group'].map({'a':'r1','b':'r1','c':'r2','d':'r2','e':'r3'})
+	gcov = PD.DataFrame(rs.exponential(5, (ngenes, len(si)))*(rs.rand(ngenes, len(si))>0.3), 
+						index=N.arange(ngenes)+100, columns=si['name'])
+	gcov.iloc[:3] = 0.1 # not expressed
+	gbed = PD.DataFrame({'gen9_sym0':['g%d' % i for i in gcov.index], 'glocus':'chr1:1-2', '#uexons':2,
+						 '#junc':1, 'pCSF':0., 'p60':0., 'gknown':'k', 'gname':'x'}, index=gcov.index)
+	sp = SP.SpecificByDM(si, gcov, gbed)
+	sp.make_dm('group')
+	return sp
+
+def _scores_ref(sp, levelnames):
+	# previous implementation: dense genes x groups x groups DMs
+	d = sp.dms['group']
+	v, ts = d['v'], d['ts']
+	m = v.values
+	logdiff = N.abs(m[:,:,N.newaxis]-m[:,N.newaxis,:])
+	dmv = logdiff/logdiff.max(axis=2).max(axis=1)[:,N.newaxis,N.newaxis]
+	gmin = sp.gcov.loc[v.index].T.groupby(d['g2t']).min().T[ts].values
+	mmv = N.minimum(gmin[:,:,N.newaxis], gmin[:,N.newaxis,:])
+	i1 = N.array([x in levelnames for x in ts])
+	i2 = ~i1
+	mask1 = i1[:,N.newaxis]*i1[N.newaxis,:]+i2[:,N.newaxis]*i2[N.newaxis,:]
+	mask2 = N.ones(len(i1)) - mask1
+	dmv1 = dmv*mask1[N.newaxis,:,:]
+	idx1 = dmv1<sp.zth1
+	idx2 = dmv1<sp.zth2
+	mmmask = mmv>=sp.mmth
+	dmv1[idx1*(~mmmask)] = 0.
+	dmv1[idx2*mmmask] = 0.
+	dmv2 = dmv*mask2[N.newaxis,:,:]
+	return v.index, dmv1.sum(axis=2).sum(axis=1), dmv2.sum(axis=2).sum(axis=1)
+
+SETS = [['a'], ['b','c'], ['a','d','e'], ['e']]
+
+def test_dm_scores():
+	sp = _sample()
+	d = sp.dms['group']
+	nt = len(d['ts'])
+	mask1 = SP.pair_masks(d['ts'], SETS)
+	for memsize in [nt*nt*8*3, nt*nt*8*3*7, SP.MEMSIZE]: # 1, 7, all genes per block
+		sc1, sc2 = SP.dm_scores(d['v'].values, d['gmin'].values, d['maxdiff'].values,
+								mask1, sp.zth1, sp.zth2, sp.mmth, memsize)
+		for i, s in enumerate(SETS):
+			gidx, r1, r2 = _scores_ref(sp, s)
+			assert N.allclose(sc1[:,i], r1)
+			assert N.allclose(sc2[:,i], r2)
+	assert len(d['v']) == 47
+	gidx, sc1, sc2 = sp.calc_scores('group', SETS, np=2, memsize=nt*nt*8*3*5)
+	assert list(gidx) == list(d['v'].index)
+	for i, s in enumerate(SETS):
+		assert N.allclose(sc1[:,i], _scores_ref(sp, s)[1])
+		assert N.allclose(sc2[:,i], _scores_ref(sp, s)[2])
+
+def test_calc_many_specific():
+	sp = _sample()
+	key2names = {'a':['a'], 'b':['b','c'], 'e':['e']}
+	df = sp.calc_many_specific('group', key2names, scoreth=None, rdratioth=None)
+	assert sorted(set(df['key'])) == ['a','b','e']
+	for k, ln in key2names.items():
+		gidx, r1, r2 = _scores_ref(sp, ln)
+		n1 = len(ln)
+		ref = PD.DataFrame({'sc1':r1, 'sc2':r2, 'score':(r2-r1)/(2.*n1*(5-n1))}, index=gidx)
+		dk = df[df['key']==k]
+		assert sorted(dk.index) == sorted(gidx)
+		for c in ['sc1','sc2','score']:
+			assert N.allclose(dk[c].values, ref.loc[dk.index, c].values)
+		assert (N.diff(dk['score'].values)<=0).all()
+		df1 = sp.calc_one_specific('group', ln)
+		assert N.allclose(df1.set_index('_gidx').loc[dk.index, 'score'], dk['score'])
@@ -78,3 +78,66 @@ def test_trim_ex(g4sjex, tmpdir):
 
 
 
+
+def _trim_ref(ex, length, gidfld):
+	# previous per gene walk
+	cols = list(ex.columns.values)
+	idxst, idxed, idxlen = cols.index('st'), cols.index('ed'), cols.index('len')
+	recs = []
+	for _gidx, gr in ex.groupby(gidfld):
+		if gr['len'].sum()<length:
+			recs += [tuple(v) for v in gr.values]
+			continue
+		strand = gr['strand'].iloc[0]
+		if strand == '+':
+			gr = gr.sort_values(['ed','st'],ascending=False)
+		else:
+			gr = gr.sort_values(['st','ed'],ascending=True)
+		grv = gr.values
+		first = grv[0]
+		clen = first[idxlen]
+		if clen>length:
+			if strand == '+':
+				first[idxed] = first[idxst] + length
+			else:
+				first[idxst] = first[idxed] - length
+			recs.append(tuple(first))
+			continue
+		recs.append(tuple(first))
+		for cur in grv[1:]:
+			clen += cur[idxlen]
+			if clen<=length:
+				recs.append(tuple(cur))
+				if clen==length:
+					break
+			else:
+				if strand=='+':
+					cur[idxst] = cur[idxst] + (clen-length)
+				else:
+					cur[idxed] = cur[idxed] - (clen-length)
+				recs.append(tuple(cur))
+				break
+	return recs
+
+@pytest.mark.parametrize('length', [50, 100, 300])
+def test_trim_ex_df(length):
+	rs = N.random.RandomState(length)
+	recs = []
+	for g in range(200):
+		strand = '+-'[g%2]
+		ne = rs.randint(1, 6)
+		pos = N.sort(rs.choice(N.arange(0, 2000, 10), 2*ne, replace=False))
+		for k in range(ne):
+			recs.append(('chr%d' % (g%3), pos[2*k], pos[2*k+1], strand, g))
+	# exact length boundaries: single exon of length, two exons summing to length
+	recs += [('chr1', 1000, 1000+length, '+', 1000), ('chr1', 0, length//2, '-', 1001),
+			 ('chr1', 500, 500+length-length//2, '-', 1001), ('chr1', 700, 760, '-', 1001)]
+	ex = PD.DataFrame(recs, columns=['chr','st','ed','strand','_gidx'])
+	ex['len'] = ex['ed'] - ex['st']
+	nex = TE.trim_ex_df(ex, length, '_gidx')
+	# previous default path (per chromosome)
+	ref = []
+	for c in sorted(ex['chr'].unique()):
+		ref += _trim_ref(ex[ex['chr']==c], length, '_gidx')
+	assert list(nex.columns) == list(ex.columns)
+	assert [tuple(x) for x in nex.values] == ref
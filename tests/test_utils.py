@@ -154,3 +154,39 @@ def test_chromsizes():
 	assert os.path.exists(UT.chromsizes('mm10'))
 	assert os.path.exists(UT.chromsizes('dm3'))
 	assert os.path.exists(UT.chromsizes('hg19'))
+
+def test_compress_bgzf(tmpdir):
+	import gzip
+	data = ''.join(['chr1\t{0}\t{1}\n'.format(i,i+10) for i in range(100000)]).encode('utf-8')
+	path = os.path.join(str(tmpdir), 'a.txt')
+	open(path,'wb').write(data)
+	gzpath = UT.compress(path)
+	assert gzpath == path+'.gz'
+	assert not os.path.exists(path)
+	assert gzip.open(gzpath).read() == data
+	assert open(gzpath,'rb').read().endswith(UT.BGZF_EOF)
+
+def test_concatenate_gz(tmpdir):
+	import gzip
+	paths = []
+	for i in range(3):
+		path = os.path.join(str(tmpdir), 'b{0}.txt.gz'.format(i))
+		with UT.BGZFWriter(path, np=2) as fp:
+			fp.write('line{0}\n'.format(i))
+		paths.append(path)
+	dst = os.path.join(str(tmpdir), 'b.txt.gz')
+	done = UT.concatenate_gz(paths, dst, remove=True)
+	assert done == paths
+	assert gzip.open(dst).read() == b'line0\nline1\nline2\n'
+	assert open(dst,'rb').read().count(UT.BGZF_EOF) == 1
+	assert not any([os.path.exists(x) for x in paths])
+
+def test_split_balanced():
+	df = PD.DataFrame({'a':N.arange(10)})
+	cost = N.array([1,1,1,1,1,1,1,1,10,10])
+	chunks = UT.split_balanced(df, cost, 4)
+	assert PD.concat(chunks)['a'].tolist() == list(range(10))
+	assert [len(x) for x in chunks] == [7,1,1,1]
+	assert [len(x) for x in UT.split_balanced(df, N.ones(10), 3)] == [3,3,4]
+	assert len(UT.split_balanced(df, N.ones(10), 20)) == 10
+	assert UT.split_balanced(df.iloc[:0], N.ones(0), 3) == []